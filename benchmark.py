@@ -0,0 +1,206 @@
+import argparse  # Module for reading command-line options
+import contextlib  # Used to silence the messages printed by the timed operations
+import json  # Results are written as JSON so runs can be compared by scripts
+import multiprocessing  # Each dataset size is measured in a fresh process
+import os  # Module for working with directories
+import platform  # Python version recorded with the results
+import random  # Picks which records each operation touches
+import tempfile  # Each run gets an empty library in a scratch directory
+import time  # High-resolution timers
+from data_initialiser import DataInitialiser  # Fills the library with generated data
+from library import LibraryService  # Opens the members, items and loans tables together
+from storage import CsvStorage, SqliteStorage  # The two storage backends
+
+try:
+    import resource  # Peak memory of the process (not available on Windows)
+except ImportError:
+    resource = None
+
+# Version of the JSON layout, bumped if the layout changes
+FORMAT = 1
+SIZES = [10_000, 100_000, 1_000_000]
+
+
+class Timings:
+    """
+    Latencies of one benchmarked operation, in nanoseconds.
+    """
+    def __init__(self):
+        self.samples = []
+
+    @contextlib.contextmanager
+    def measure(self):
+        # Time one call of the operation
+        start = time.perf_counter_ns()
+        yield
+        self.samples.append(time.perf_counter_ns() - start)
+
+    def percentile(self, p: float) -> float:
+        """
+        Return the latency (in milliseconds) that p percent of calls were faster than.
+        """
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] / 1e6
+
+    def to_dict(self):
+        # Summary of the samples, e.g. for the JSON report
+        total = sum(self.samples) / 1e9
+        return {
+            'count': len(self.samples),
+            'p50_ms': round(self.percentile(50), 4),
+            'p99_ms': round(self.percentile(99), 4),
+            'ops_per_second': round(len(self.samples) / total, 1) if total else None
+        }
+
+
+def peak_memory() -> int:
+    """
+    Return the most memory this process has used so far, in bytes (None if unknown).
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def open_backend(name: str):
+    # Storage for a benchmark run, inside the current (scratch) directory
+    return SqliteStorage() if name == 'sqlite' else CsvStorage()
+
+
+def run_size(size: int, ops: int = 1000, slow_ops: int = 20, storage: str = 'csv', seed: int = 0) -> dict:
+    """
+    Generate a library of `size` members and items in a scratch directory and
+    time each operation on it. Fast operations run `ops` times; operations
+    that rewrite or print a whole table (members update/delete with CSV
+    storage, list()) run `slow_ops` times.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        previous = os.getcwd()
+        os.chdir(directory)  # Repositories use paths relative to the working directory
+        try:
+            return _run_size(size, ops, slow_ops, storage, seed)
+        finally:
+            os.chdir(previous)
+
+
+def _run_size(size, ops, slow_ops, storage, seed):
+    started = time.perf_counter()
+    service = LibraryService(open_backend(storage))
+    loans = size // 10
+    DataInitialiser.seed_synthetic(service, size, loans=loans, seed=seed)
+    setup_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed)
+    item_ids = [f'B{n:07}' for n in range(size)]
+    member_ids = [f'M{n:07}' for n in range(size)]
+    # Items past the first `loans` are available, so they can be borrowed
+    borrowable = rng.sample(item_ids[loans:], min(ops, size - loans))
+    timings = {name: Timings() for name in (
+        'items.get', 'items.update', 'members.get', 'members.update', 'members.delete',
+        'library.borrow_book', 'library.return_book', 'items.list', 'members.list')}
+    items_repo, members_repo = service.items_repo, service.members_repo
+
+    # The operations print confirmations; keep them off the console
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for item_id in rng.choices(item_ids, k=ops):
+            with timings['items.get'].measure():
+                items_repo.get(item_id)
+        for item_id in rng.choices(item_ids, k=ops):
+            item = items_repo.get(item_id)
+            with timings['items.update'].measure():
+                items_repo.update(item)
+        for member_id in rng.choices(member_ids, k=ops):
+            with timings['members.get'].measure():
+                members_repo.get(member_id)
+        for member_id in rng.choices(member_ids, k=slow_ops):
+            member = members_repo.get(member_id)
+            member.name += ' Jr'
+            with timings['members.update'].measure():
+                members_repo.update(member)
+        # Borrow and then return the same items, each to a random member
+        borrowers = rng.choices(member_ids, k=len(borrowable))
+        for item_id, member_id in zip(borrowable, borrowers):
+            with timings['library.borrow_book'].measure():
+                service.borrow_book(member_id, item_id)
+        for item_id, member_id in zip(borrowable, borrowers):
+            with timings['library.return_book'].measure():
+                service.return_book(item_id, member_id)
+        for _ in range(slow_ops):
+            with timings['items.list'].measure():
+                items_repo.list()
+            with timings['members.list'].measure():
+                members_repo.list()
+        # Deleted last, so every other operation runs on the full table
+        for member_id in rng.sample(member_ids, min(slow_ops, size)):
+            with timings['members.delete'].measure():
+                members_repo.delete(member_id)
+
+    return {
+        'size': size,
+        'setup_seconds': round(setup_seconds, 3),
+        'peak_memory_bytes': peak_memory(),
+        'operations': {name: t.to_dict() for name, t in timings.items()}
+    }
+
+
+def run(sizes=None, ops: int = 1000, slow_ops: int = 20, storage: str = 'csv', seed: int = 0) -> dict:
+    """
+    Benchmark every size, each in a fresh process so its peak memory is its own.
+    Returns the report as a dictionary.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in sizes or SIZES:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_size, (size, ops, slow_ops, storage, seed)))
+    return {
+        'format': FORMAT,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': storage,
+        'seed': seed,
+        'results': results
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.25):
+    """
+    Return a message for every operation whose p99 latency got more than
+    `tolerance` (25% by default) slower than in the baseline report.
+    """
+    before = {result['size']: result['operations'] for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        for name, now in result['operations'].items():
+            then = before.get(result['size'], {}).get(name)
+            if then and then['p99_ms'] and now['p99_ms'] > then['p99_ms'] * (1 + tolerance):
+                regressions.append(f"{name} at {result['size']} rows: p99 "
+                                   f"{then['p99_ms']} ms -> {now['p99_ms']} ms")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time repository and loan operations on generated data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='rows per table')
+    parser.add_argument('--ops', type=int, default=1000, help='calls per fast operation')
+    parser.add_argument('--slow-ops', type=int, default=20, help='calls per whole-table operation')
+    parser.add_argument('--storage', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated data')
+    parser.add_argument('--output', help='write the JSON report to this file instead of printing it')
+    parser.add_argument('--baseline', help='earlier JSON report to check for regressions')
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.ops, args.slow_ops, args.storage, args.seed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(json.load(f), report)
+        for message in regressions:
+            print(f"Regression: {message}")
+        raise SystemExit(1 if regressions else 0)
@@ -0,0 +1,234 @@
+import argparse  # Module for reading command-line options
+import csv  # Module for reading and writing CSV files
+import time  # Module for measuring elapsed time
+from datetime import datetime  # Used to check membership dates
+from columns import STATUS_CODES  # Every item status the tables can hold
+from items import ItemsRepository  # Repository that imported items are written to
+from members import MembersRepository  # Repository that imported members are written to
+
+
+class BulkStats:
+    """
+    Progress and throughput counters for one bulk import or export.
+    """
+    # Only the first few rejected rows are kept, so memory stays flat
+    MAX_ERRORS = 100
+
+    def __init__(self):
+        self.rows_read = 0       # Rows read from the source
+        self.rows_written = 0    # Rows written to the destination
+        self.rows_rejected = 0   # Rows that failed validation
+        self.rows_duplicate = 0  # Rows whose ID was already stored or repeated in the input
+        self.errors = []         # (row number, reason) for the first MAX_ERRORS rejected rows
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def reject(self, row_number: int, reason: str):
+        # Count a row that failed validation and remember why
+        self.rows_rejected += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append((row_number, reason))
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def elapsed(self) -> float:
+        """
+        Seconds since the transfer started (or how long it took, once finished).
+        """
+        return (self.finished or time.perf_counter()) - self.started
+
+    def rows_per_second(self) -> float:
+        """
+        Throughput so far, counted in rows read.
+        """
+        elapsed = self.elapsed()
+        return self.rows_read / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        # Convert the counters into a dictionary, e.g. for logging
+        return {
+            'rows_read': self.rows_read,
+            'rows_written': self.rows_written,
+            'rows_rejected': self.rows_rejected,
+            'rows_duplicate': self.rows_duplicate,
+            'elapsed_seconds': round(self.elapsed(), 3),
+            'rows_per_second': round(self.rows_per_second(), 1)
+        }
+
+
+def read_chunks(path: str, chunk_size: int):
+    """
+    Read a CSV file lazily and yield its rows in lists of at most chunk_size,
+    so only one chunk is held in memory at a time.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        chunk = []
+        for row in csv.DictReader(f):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _required(row: dict, column: str) -> str:
+    # Return a stripped, non-empty column value or raise ValueError
+    value = (row.get(column) or '').strip()
+    if not value:
+        raise ValueError(f"missing {column}")
+    return value
+
+
+def validate_item(row: dict) -> dict:
+    """
+    Return a clean item row, or raise ValueError saying what is wrong with it.
+    """
+    status = (row.get('status') or '').strip() or 'available'
+    if status not in STATUS_CODES:
+        raise ValueError(f"unknown status '{status}'")
+    return {
+        'id': _required(row, 'id'),
+        'title': _required(row, 'title'),
+        'author': _required(row, 'author'),
+        'status': status
+    }
+
+
+def validate_member(row: dict) -> dict:
+    """
+    Return a clean member row, or raise ValueError saying what is wrong with it.
+    """
+    date = _required(row, 'membership_date')
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"membership_date '{date}' is not YYYY-MM-DD")
+    return {
+        'id': _required(row, 'id'),
+        'name': _required(row, 'name'),
+        'membership_date': date
+    }
+
+
+class BulkLoader:
+    """
+    Streams records from a CSV file into a repository in buffered batches.
+    Each chunk is validated, checked for IDs that are already stored (using
+    the repository's index) or repeated in the input, and written with one
+    append. Only one chunk of the source is in memory at a time.
+    """
+    CHUNK_SIZE = 5000
+
+    def __init__(self, repo, validate, chunk_size: int = None, progress=None):
+        self.table = repo.table              # Table the records are written to
+        self.validate = validate             # validate_item or validate_member
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.progress = progress             # Called with the BulkStats after each chunk
+
+    def load(self, path: str) -> BulkStats:
+        """
+        Import every valid, new record from the CSV file at `path`.
+        """
+        stats = BulkStats()
+        # Fold any journaled changes first so the new rows go straight to the table
+        self.table.checkpoint()
+        for chunk in read_chunks(path, self.chunk_size):
+            clean = {}  # ID -> validated row, in input order
+            for row in chunk:
+                stats.rows_read += 1
+                try:
+                    row = self.validate(row)
+                except ValueError as e:
+                    stats.reject(stats.rows_read, str(e))
+                    continue
+                if row['id'] in clean:
+                    stats.rows_duplicate += 1  # Repeated within this chunk
+                    continue
+                clean[row['id']] = row
+            # IDs written by earlier chunks are already in the index
+            existing = self.table.get_many(clean)
+            batch = [row for key, row in clean.items() if key not in existing]
+            stats.rows_duplicate += len(clean) - len(batch)
+            if batch:
+                self.table.append_many(batch)
+                stats.rows_written += len(batch)
+            if self.progress:
+                self.progress(stats)
+        stats.finish()
+        return stats
+
+
+class BulkExporter:
+    """
+    Streams every record of a repository to a CSV file in buffered batches.
+    """
+    CHUNK_SIZE = 5000
+
+    def __init__(self, repo, chunk_size: int = None, progress=None):
+        self.table = repo.table              # Table the records are read from
+        self.fieldnames = repo.FIELDNAMES    # Columns of the output file
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.progress = progress             # Called with the BulkStats after each batch
+
+    def export(self, path: str) -> BulkStats:
+        """
+        Write every record to the CSV file at `path`.
+        """
+        stats = BulkStats()
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames)
+            writer.writeheader()
+            buffer = []
+            for row in self.table.iter_rows():
+                stats.rows_read += 1
+                buffer.append(row)
+                if len(buffer) == self.chunk_size:
+                    self._flush(writer, buffer, stats)
+                    buffer = []
+            if buffer:
+                self._flush(writer, buffer, stats)
+        stats.finish()
+        return stats
+
+    def _flush(self, writer, buffer, stats):
+        # Write one batch of rows and report progress
+        writer.writerows(buffer)
+        stats.rows_written += len(buffer)
+        if self.progress:
+            self.progress(stats)
+
+
+# Repository class and row validator for each kind of record
+KINDS = {
+    'items': (ItemsRepository, validate_item),
+    'members': (MembersRepository, validate_member),
+}
+
+
+def print_progress(stats: BulkStats):
+    """
+    Print a one-line progress report.
+    """
+    print(f"{stats.rows_read} read, {stats.rows_written} written "
+          f"({stats.rows_per_second():.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import or export items and members.')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('kind', choices=sorted(KINDS))
+    parser.add_argument('path', help='CSV file to read from (import) or write to (export)')
+    parser.add_argument('--chunk-size', type=int, default=None, help='rows per batch')
+    args = parser.parse_args()
+
+    repo_class, validate = KINDS[args.kind]
+    repo = repo_class()
+    if args.action == 'import':
+        result = BulkLoader(repo, validate, args.chunk_size, print_progress).load(args.path)
+        for row_number, reason in result.errors:
+            print(f"Row {row_number} rejected: {reason}")
+    else:
+        result = BulkExporter(repo, args.chunk_size, print_progress).export(args.path)
+    print(result.to_dict())
@@ -0,0 +1,214 @@
+import array  # Compact arrays of machine integers, one per column
+import sys  # sys.intern shares one copy of each distinct string
+from collections import Counter  # Counts how often each code occurs
+from datetime import date  # Loan dates are stored as day numbers
+from enum import IntEnum  # Small integer codes with names
+from itertools import islice  # Reads rows a batch at a time
+from operator import itemgetter  # Pulls one column out of a batch of rows in C
+from items import Item  # Rows are turned back into Items on request
+
+
+class Status(IntEnum):
+    """
+    Item status as a one-byte code instead of a string.
+    """
+    AVAILABLE = 0
+    ON_LOAN = 1
+    ON_HOLD = 2
+
+    @classmethod
+    def parse(cls, text: str) -> 'Status':
+        # 'on_loan' -> Status.ON_LOAN
+        return cls[text.upper()]
+
+    def __str__(self):
+        # Status.ON_LOAN -> 'on_loan', the value stored in the tables
+        return self.name.lower()
+
+
+class Strings:
+    """
+    Dictionary encoding for a column with few distinct values: each distinct
+    string is stored once and the column holds its number.
+    """
+    def __init__(self):
+        self.values = []  # code -> string
+        self.codes = {}   # string -> code
+
+    def code(self, value: str) -> int:
+        """
+        Return the number for a string, assigning the next one if it is new.
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+    def codes_of(self, values):
+        """
+        Return the numbers for many strings at once, as an iterator.
+        """
+        # Number the new strings in the order they first appear, all at once
+        new = [value for value in dict.fromkeys(values) if value not in self.codes]
+        self.codes.update(zip(new, range(len(self.values), len(self.values) + len(new))))
+        self.values.extend(map(sys.intern, new))
+        return map(self.codes.__getitem__, values)
+
+    def __getitem__(self, code: int) -> str:
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+
+# Status text -> one-byte code, for converting whole batches at once
+STATUS_CODES = {str(status): status.value for status in Status}
+# Rows are converted this many at a time
+BATCH_SIZE = 65536
+
+
+def _batches(rows):
+    # Split an iterable of rows into lists of at most BATCH_SIZE
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+class ItemColumns:
+    """
+    A read-only, column-by-column copy of the items table for bulk analytics.
+    Statuses are one byte each and authors are stored as 4-byte codes, so
+    counting or filtering by either runs over a flat array instead of a
+    million objects. Build it with from_rows(repo.table.iter_rows()).
+    """
+    def __init__(self):
+        self.ids = []                         # Item IDs, in table order
+        self.titles = []                      # Titles (mostly distinct, so kept as strings)
+        self.authors = Strings()              # Distinct author names
+        self.author_codes = array.array('I')  # Author code of each item
+        self.statuses = array.array('B')      # Status code of each item
+
+    @classmethod
+    def from_rows(cls, rows) -> 'ItemColumns':
+        """
+        Build the columns from item rows (dicts with the items table columns).
+        """
+        columns = cls()
+        for batch in _batches(rows):
+            columns.extend(batch)
+        return columns
+
+    def append(self, row: dict):
+        """
+        Add one item row to the end of the columns.
+        """
+        self.extend([row])
+
+    def extend(self, rows):
+        """
+        Add a list of item rows to the end of the columns. Each column is
+        converted in one pass over the batch rather than row by row.
+        """
+        authors = list(map(itemgetter('author'), rows))
+        self.ids.extend(map(itemgetter('id'), rows))
+        self.titles.extend(map(itemgetter('title'), rows))
+        self.author_codes.extend(self.authors.codes_of(authors))
+        self.statuses.extend(map(STATUS_CODES.__getitem__, map(itemgetter('status'), rows)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def item(self, position: int) -> Item:
+        """
+        Return the item at a position as an Item object.
+        """
+        return Item(self.ids[position], self.titles[position],
+                    self.authors[self.author_codes[position]],
+                    str(Status(self.statuses[position])))
+
+    def status_counts(self) -> dict:
+        """
+        Return how many items have each status.
+        """
+        # array.count runs in C over the raw bytes
+        return {status: self.statuses.count(status) for status in Status}
+
+    def ids_with_status(self, status: Status):
+        """
+        Return the IDs of every item with the given status.
+        """
+        return [item_id for item_id, code in zip(self.ids, self.statuses) if code == status]
+
+    def author_counts(self) -> Counter:
+        """
+        Return how many items each author has.
+        """
+        counts = Counter(self.author_codes)
+        return Counter({self.authors[code]: n for code, n in counts.items()})
+
+
+class LoanColumns:
+    """
+    A read-only, column-by-column copy of the loans table for bulk analytics.
+    Member IDs are stored as 4-byte codes and loan and due dates as 4-byte
+    day numbers (date.toordinal()), so date ranges compare integers.
+    """
+    def __init__(self):
+        self.item_ids = []                    # Borrowed item IDs, in table order
+        self.members = Strings()              # Distinct member IDs
+        self.member_codes = array.array('I')  # Member code of each loan
+        self.days = array.array('I')          # Loan date of each loan, as a day number
+        self.due_days = array.array('I')      # Due date of each loan, as a day number
+
+    @classmethod
+    def from_rows(cls, rows) -> 'LoanColumns':
+        """
+        Build the columns from loan rows (dicts with the loans table columns).
+        """
+        columns = cls()
+        for batch in _batches(rows):
+            columns.extend(batch)
+        return columns
+
+    def append(self, row: dict):
+        """
+        Add one loan row to the end of the columns.
+        """
+        self.extend([row])
+
+    def extend(self, rows):
+        """
+        Add a list of loan rows to the end of the columns. Each column is
+        converted in one pass over the batch rather than row by row.
+        """
+        member_ids = list(map(itemgetter('borrowed_by'), rows))
+        dates = list(map(itemgetter('loan_date'), rows))
+        due_dates = list(map(itemgetter('due_date'), rows))
+        self.item_ids.extend(map(itemgetter('item_id'), rows))
+        self.member_codes.extend(self.members.codes_of(member_ids))
+        # Many loans share a date, so each distinct date is parsed once
+        days = {text: date.fromisoformat(text).toordinal() for text in set(dates).union(due_dates)}
+        self.days.extend(map(days.__getitem__, dates))
+        self.due_days.extend(map(days.__getitem__, due_dates))
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def loans_per_member(self) -> Counter:
+        """
+        Return how many loans each member has.
+        """
+        counts = Counter(self.member_codes)
+        return Counter({self.members[code]: n for code, n in counts.items()})
+
+    def borrowed_before(self, day: date):
+        """
+        Return (item ID, member ID) for every loan made before the given day.
+        """
+        cutoff = day.toordinal()
+        return [(self.item_ids[i], self.members[self.member_codes[i]])
+                for i, loan_day in enumerate(self.days) if loan_day < cutoff]
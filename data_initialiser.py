@@ -1,11 +1,13 @@
-import os  # Module for interacting with the operating system (e.g., file paths)
-import csv  # Module for reading and writing CSV files
-from datetime import datetime  # Module for working with dates and times (not yet used here)
+import random  # Seeded random numbers, so generated data is the same on every run
+from datetime import date, datetime, timedelta  # Module for working with dates and times
+from itertools import islice  # Takes generated records a chunk at a time
 
 # Import the Member class and repository for members
 from members import Member, MembersRepository
 # Import the Item class and repository for items
 from items import Item, ItemsRepository
+# Import the loan record class written by the synthetic data generator
+from library import LoanRecord
 
 class DataInitialiser:
     """
@@ -18,35 +20,112 @@ class DataInitialiser:
         """
         Add sample Member records to the repository if it has no existing entries.
         """
-        # Open the members CSV file for reading
-        with open(repo.CSV_PATH, newline='', encoding='utf-8') as f:
-            # If there is any row in the CSV, skip seeding
-            if any(csv.DictReader(f)):
-                return  # Repository already has data
+        # If the repository already holds any records, skip seeding
+        if repo.count():
+            return  # Repository already has data
         # Define some sample members to add
         samples = [
             Member('M001', 'Alice', '2024-01-10'),
             Member('M002', 'Bob', '2024-02-12')
         ]
-        # Add each sample member to the repository
-        for m in samples:
-            repo.add(m)
+        # Add all sample members to the repository in one write
+        repo.add_many(samples)
 
     @staticmethod
     def seed_items(repo: ItemsRepository):
         """
         Add sample Item records to the repository if it has no existing entries.
         """
-        # Open the items CSV file for reading
-        with open(repo.CSV_PATH, newline='', encoding='utf-8') as f:
-            # If there is any row in the CSV, skip seeding
-            if any(csv.DictReader(f)):
-                return  # Repository already has data
+        # If the repository already holds any records, skip seeding
+        if repo.count():
+            return  # Repository already has data
         # Define some sample items (e.g., books) to add
         samples = [
             Item('B001', '1984', 'George Orwell'),
             Item('B002', 'To Kill a Mockingbird', 'Harper Lee')
         ]
-        # Add each sample item to the repository
-        for i in samples:
-            repo.add(i)  # Note: ensure the add method name matches exactly in ItemsRepository
+        # Add all sample items to the repository in one write
+        repo.add_many(samples)
+
+    @staticmethod
+    def seed_synthetic(service, size: int, loans: int = None, seed: int = 0, chunk_size: int = 10000):
+        """
+        Fill an empty library with `size` generated members and `size` generated
+        items, of which `loans` (a tenth of the items by default) are on loan.
+        The same seed always produces the same library.
+        """
+        if loans is None:
+            loans = size // 10
+        data = SyntheticData(seed)
+        # Records are generated and written a chunk at a time, so a million
+        # rows never have to be held in memory as objects
+        for repo, records in ((service.members_repo, data.members(size)),
+                              (service.items_repo, data.items(size, on_loan=loans))):
+            while repo.add_many(islice(records, chunk_size)):
+                pass
+        records = data.loans(loans, size)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            service.ledger.add_many(chunk)
+
+
+class SyntheticData:
+    """
+    Generates realistic-looking members, items and loans from a seeded random
+    number generator, for benchmarks and load tests. Member IDs are M0000000,
+    M0000001, ... and item IDs B0000000, B0000001, ...
+    """
+    FIRST_NAMES = ['Alice', 'Bob', 'Chen', 'Dana', 'Emil', 'Farah', 'George', 'Hana', 'Ivan', 'Jane',
+                   'Kofi', 'Lena', 'Mateo', 'Nia', 'Oscar', 'Priya', 'Quinn', 'Rosa', 'Sven', 'Tara']
+    LAST_NAMES = ['Austen', 'Brontë', 'Cervantes', 'Dickens', 'Eliot', 'Fitzgerald', 'García', 'Hugo',
+                  'Ishiguro', 'Joyce', 'Kafka', 'Lee', 'Morrison', 'Nabokov', 'Orwell', 'Pratchett',
+                  'Rowling', 'Shelley', 'Tolstoy', 'Woolf']
+    TITLE_WORDS = ['Animal', 'Bright', 'City', 'Dark', 'Empire', 'Farm', 'Garden', 'House', 'Island',
+                   'Journey', 'Kingdom', 'Light', 'Mockingbird', 'Night', 'Ocean', 'Pride', 'Queen',
+                   'River', 'Silent', 'Time', 'Under', 'Voyage', 'War', 'Winter', 'Years', 'Zero']
+    AUTHORS = 2000  # Distinct authors to draw from, so authors repeat like in a real catalogue
+    FIRST_DAY = date(2020, 1, 1)  # Membership and loan dates are spread over the following years
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+
+    def _random(self, stream: str) -> random.Random:
+        # Each kind of record has its own generator, so e.g. the items are
+        # the same whether or not the members were generated first
+        return random.Random(f'{self.seed}:{stream}')
+
+    def _name(self, rng: random.Random) -> str:
+        return f"{rng.choice(self.FIRST_NAMES)} {rng.choice(self.LAST_NAMES)}"
+
+    def _day(self, rng: random.Random, years: int = 5) -> str:
+        return (self.FIRST_DAY + timedelta(days=rng.randrange(365 * years))).isoformat()
+
+    def members(self, count: int):
+        """
+        Yield `count` Members.
+        """
+        rng = self._random('members')
+        for n in range(count):
+            yield Member(f'M{n:07}', self._name(rng), self._day(rng))
+
+    def items(self, count: int, on_loan: int = 0):
+        """
+        Yield `count` Items. The first `on_loan` of them are on loan (see loans()).
+        """
+        rng = self._random('items')
+        authors = [self._name(rng) for _ in range(self.AUTHORS)]
+        for n in range(count):
+            title = ' '.join(rng.sample(self.TITLE_WORDS, rng.randint(1, 4)))
+            status = 'on_loan' if n < on_loan else 'available'
+            yield Item(f'B{n:07}', title, rng.choice(authors), status)
+
+    def loans(self, count: int, members: int):
+        """
+        Yield a LoanRecord for each of the first `count` items, each borrowed
+        by one of the first `members` members.
+        """
+        rng = self._random('loans')
+        for n in range(count):
+            yield LoanRecord(f'B{n:07}', f'M{rng.randrange(members):07}', self._day(rng))
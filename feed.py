@@ -0,0 +1,178 @@
+import json  # Each change is one JSON line
+import os  # File sizes, paths and the lock file
+import threading  # Keeps writers in different threads apart
+from metrics import count  # Opt-in counters of bytes written and read
+
+try:
+    import fcntl  # Unix file locks, used to keep writers in different processes apart
+except ImportError:
+    fcntl = None  # Not available on Windows: writers are only kept apart within a process
+
+# Bytes read at a time when looking for the last line of the feed
+TAIL_CHUNK = 64 * 1024
+
+
+def _parse(line: bytes):
+    # Return the Change on a whole line, or None for a line a crashed writer cut short
+    try:
+        return Change.parse(line)
+    except (ValueError, KeyError):
+        return None
+
+
+class Change:
+    """
+    One sequenced change to a table: a row was added or replaced ('put'),
+    or removed ('del'). Sequence numbers start at 1 and have no gaps.
+    """
+    # Fixed attributes instead of a per-instance __dict__, as a catch-up can read many changes
+    __slots__ = ('seq', 'table', 'op', 'key', 'row')
+
+    def __init__(self, seq: int, table: str, op: str, key, row: dict):
+        self.seq = seq      # Position in the feed
+        self.table = table  # Name of the changed table, e.g. 'items'
+        self.op = op        # 'put' or 'del'
+        self.key = key      # Key of the row: a string, or a tuple for a composite key
+        self.row = row      # The whole row after a put, or the removed row
+
+    @classmethod
+    def parse(cls, line: bytes) -> 'Change':
+        # Create a Change from one line of the feed file
+        record = json.loads(line)
+        key = record['key']
+        return cls(record['seq'], record['table'], record['op'], tuple(key) if isinstance(key, list) else key,
+                   record['row'])
+
+    def to_dict(self):
+        # Convert this change into a dictionary, e.g. for the feed file or JSON output
+        return {'seq': self.seq, 'table': self.table, 'op': self.op, 'key': self.key, 'row': self.row}
+
+
+class ChangeFeed:
+    """
+    An append-only log of every change written to the tables it is attached
+    to (see CsvStorage), one JSON line per change, numbered in the order the
+    changes were made. Tables publish while still holding their own write
+    lock, so two changes to the same row appear in the order they were applied.
+
+    Several processes can publish to one feed: they take an fcntl lock on
+    <path>.lock and continue from the last sequence number in the file.
+    Readers never lock. Lines are sorted by sequence number, so read(after)
+    finds its starting point by binary search over the file instead of
+    reading it from the start.
+    """
+    PATH = os.path.join('csv', 'changes.log')
+
+    def __init__(self, path: str = None):
+        self.path = path or self.PATH
+        self.lock_path = self.path + '.lock'  # File that publishers lock across processes
+        self._lock = threading.Lock()         # Held by the thread publishing
+        self._seq = 0                         # Last sequence number in the file
+        self._size = None                     # File size at which _seq was last known
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        open(self.path, 'ab').close()
+
+    def publish(self, table: str, changes):
+        """
+        Append (op, key, row) changes to one table to the feed, numbering them,
+        in a single write.
+        """
+        with self._lock, open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                size = os.path.getsize(self.path)
+                if size != self._size:
+                    self._seq = self.last_seq()  # Someone else published since, or first use
+                lines = []
+                for op, key, row in changes:
+                    self._seq += 1
+                    lines.append(json.dumps({'seq': self._seq, 'table': table, 'op': op, 'key': key, 'row': row},
+                                            separators=(',', ':')))
+                if not lines:
+                    return
+                data = ('\n'.join(lines) + '\n').encode('utf-8')
+                with open(self.path, 'a+b') as f:
+                    # Finish off a line a crashed writer left without its line ending
+                    if f.tell() > 0:
+                        f.seek(f.tell() - 1)
+                        if f.read(1) != b'\n':
+                            data = b'\n' + data
+                    f.write(data)
+                    self._size = f.tell()
+                count('bytes_written', os.path.basename(self.path), len(data))
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def last_seq(self) -> int:
+        """
+        Return the sequence number of the latest change (0 if there is none),
+        reading backwards from the end of the file.
+        """
+        with open(self.path, 'rb') as f:
+            position = f.seek(0, os.SEEK_END)
+            tail = b''
+            while position > 0:
+                start = max(0, position - TAIL_CHUNK)
+                f.seek(start)
+                tail = f.read(position - start) + tail
+                position = start
+                # Drop what follows the last line ending (nothing, or a line cut
+                # short), and the first piece unless it starts the file
+                lines = tail.split(b'\n')[:-1]
+                if position > 0:
+                    lines = lines[1:]
+                for line in reversed(lines):
+                    change = _parse(line + b'\n')
+                    if change is not None:
+                        return change.seq
+        return 0
+
+    def _offset_after(self, f, size: int, after: int) -> int:
+        # Binary search for the start of the first line with a sequence number
+        # above `after`. lo is always the start of a line. A line left by a
+        # crashed writer counts as part of the whole line that follows it.
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid > lo:
+                f.seek(mid - 1)
+                f.readline()  # Skip to the first line starting at or after mid
+            else:
+                f.seek(mid)
+            start = f.tell()
+            if start >= hi:
+                hi = mid
+                continue
+            change = None
+            while change is None:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break  # End of the file, or a line still being written
+                change = _parse(line)
+            if change is not None and change.seq <= after:
+                lo = f.tell()
+            else:
+                hi = start
+        return lo
+
+    def read(self, after: int = 0, limit: int = None):
+        """
+        Return the changes numbered after `after`, oldest first, at most
+        `limit` of them. A change still being written is left for next time.
+        """
+        changes = []
+        with open(self.path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(self._offset_after(f, size, after))
+            read = 0
+            for line in f:
+                if not line.endswith(b'\n') or (limit is not None and len(changes) >= limit):
+                    break  # A change still being written, or enough for now
+                read += len(line)
+                change = _parse(line)
+                if change is not None:
+                    changes.append(change)
+        count('bytes_read', os.path.basename(self.path), read)
+        return changes
@@ -0,0 +1,275 @@
+import heapq  # Ready holds ordered by the day they run out
+import threading  # Keeps callers and table change hooks from different threads apart
+from collections import OrderedDict  # FIFO waitlist that can also drop any member in O(1)
+from datetime import date, timedelta  # Placement days and collection deadlines
+from storage import ConflictError  # Raised when another desk promoted or removed a hold first
+from metrics import timed  # Opt-in timing of hold operations
+
+
+class Hold:
+    """
+    A member's place in the queue for an item. While the member is waiting
+    ready_until is empty; once the item is set aside for them it holds the
+    last day (YYYY-MM-DD) they can collect it.
+    """
+    # Fixed attributes instead of a per-instance __dict__, as there can be many holds
+    __slots__ = ('item_id', 'member_id', 'placed', 'ready_until')
+
+    def __init__(self, item_id: str, member_id: str, placed: str, ready_until: str = ''):
+        self.item_id = item_id          # ID of the item being waited for
+        self.member_id = member_id      # ID of the waiting member
+        self.placed = placed            # Day the hold was placed (YYYY-MM-DD)
+        self.ready_until = ready_until  # Last day to collect the item, or '' while waiting
+
+    def to_dict(self):
+        # Convert this hold into a dictionary matching our table columns
+        return {
+            'item_id': self.item_id,
+            'member_id': self.member_id,
+            'placed': self.placed,
+            'ready_until': self.ready_until
+        }
+
+
+class HoldQueue:
+    """
+    Holds on items, stored in the holds table (for CSV storage:
+    csv/holds.csv, with a journal) and mirrored in memory as:
+
+    - one FIFO waitlist per item (an OrderedDict of member IDs), so placing,
+      cancelling and taking the next member are all O(1);
+    - the ready hold of each item, i.e. the member the item is set aside for;
+    - a heap of (deadline, item, member) for ready holds, so finding expired
+      holds is O(log n) each and never looks at holds that are not due.
+
+    The table is read once, on first use; after that the memory copy follows
+    the table's change hooks, so changes made by other desks are picked up
+    too. Waitlist order is the order the holds were added to the table.
+    """
+    # Name of the holds table and its columns
+    TABLE = 'holds'
+    FIELDNAMES = ['item_id', 'member_id', 'placed', 'ready_until']
+    # Days a returned item is kept aside for the member at the head of its queue
+    HOLD_DAYS = 7
+    # Times a rebuild is retried when the table changes while it reads it
+    REBUILD_ATTEMPTS = 5
+
+    def __init__(self, storage):
+        self.table = storage.table(self.TABLE, self.FIELDNAMES, key=('item_id', 'member_id'),
+                                   journal=True, indexes=['member_id'],
+                                   shared=['member_id', 'placed', 'ready_until'])
+        self.listeners = []             # Called with the Hold when an item is set aside for someone
+        # Held while the memory copy is read or changed. Never held while the
+        # table is used, as the table holds its own lock while calling us.
+        self._lock = threading.RLock()
+        self._stale = True              # Rebuild from the table before the next use
+        self._version = 0               # Bumped by every change we are told about
+        self._install({}, {}, [])
+        self.table.watch(self._on_change)
+
+    def _install(self, waiting, ready, expiry):
+        self.waiting = waiting  # item ID -> OrderedDict of waiting member ID -> None, oldest first
+        self.ready = ready      # item ID -> Hold the item is set aside for
+        self.expiry = expiry    # Heap of (deadline day number, item ID, member ID)
+
+    def _rebuild(self):
+        # Read every hold from the table into fresh structures, keeping them
+        # only if no change arrived while we were reading
+        for attempt in range(self.REBUILD_ATTEMPTS):
+            with self._lock:
+                version = self._version
+            waiting, ready, expiry = {}, {}, []
+            for row in self.table.iter_rows():
+                if row['ready_until']:
+                    ready[row['item_id']] = self._hold(row)
+                    expiry.append((date.fromisoformat(row['ready_until']).toordinal(),
+                                   row['item_id'], row['member_id']))
+                else:
+                    waiting.setdefault(row['item_id'], OrderedDict())[row['member_id']] = None
+            heapq.heapify(expiry)
+            with self._lock:
+                if self._version == version or attempt == self.REBUILD_ATTEMPTS - 1:
+                    self._install(waiting, ready, expiry)
+                    self._stale = False
+                    return
+
+    def _sync(self):
+        # Pick up changes made by other processes, then rebuild if the table
+        # was reloaded. Called without holding our lock (see __init__).
+        self.table.refresh()
+        if self._stale:
+            self._rebuild()
+
+    @staticmethod
+    def _hold(row: dict) -> Hold:
+        # Create a Hold object from a table row
+        return Hold(row['item_id'], row['member_id'], row['placed'], row['ready_until'])
+
+    def _on_change(self, key, old, new):
+        # Keep the memory copy in step with one change to the holds table
+        with self._lock:
+            self._version += 1
+            if key is None:
+                self._stale = True  # Table reloaded: rebuild before the next use
+                return
+            item_id, member_id = key
+            if old is not None:
+                if old['ready_until']:
+                    hold = self.ready.get(item_id)
+                    if hold is not None and hold.member_id == member_id:
+                        del self.ready[item_id]  # Its heap entry is skipped when it comes up
+                else:
+                    queue = self.waiting.get(item_id)
+                    if queue is not None:
+                        queue.pop(member_id, None)
+                        if not queue:
+                            del self.waiting[item_id]
+            if new is not None:
+                if new['ready_until']:
+                    self.ready[item_id] = self._hold(new)
+                    heapq.heappush(self.expiry, (date.fromisoformat(new['ready_until']).toordinal(),
+                                                 item_id, member_id))
+                else:
+                    self.waiting.setdefault(item_id, OrderedDict())[member_id] = None
+
+    def listen(self, callback):
+        """
+        Call callback(hold) whenever an item is set aside for a member, e.g.
+        to send them a notice.
+        """
+        self.listeners.append(callback)
+
+    @timed('holds.place')
+    def place(self, item_id: str, member_id: str, today: date = None) -> int:
+        """
+        Put a member at the back of an item's waitlist. Returns their position
+        (1 = next in line). Raises ValueError if they already hold the item.
+        """
+        if self.get(item_id, member_id) is not None:
+            raise ValueError("Member already has a hold on this book.")
+        placed = (today or date.today()).isoformat()
+        self.table.append(Hold(item_id, member_id, placed).to_dict())
+        with self._lock:
+            return len(self.waiting.get(item_id, ()))
+
+    def get(self, item_id: str, member_id: str):
+        """
+        Return the member's hold on the item (waiting or ready), or None.
+        """
+        self._sync()
+        with self._lock:
+            hold = self.ready.get(item_id)
+            if hold is not None and hold.member_id == member_id:
+                return hold
+            if member_id not in self.waiting.get(item_id, ()):
+                return None
+        row = self.table.get((item_id, member_id))
+        return self._hold(row) if row is not None else None
+
+    def position(self, item_id: str, member_id: str) -> int:
+        """
+        Return the member's place in the item's waitlist (1 = next), or 0 if
+        they are not waiting for it.
+        """
+        self._sync()
+        with self._lock:
+            for position, waiting in enumerate(self.waiting.get(item_id, ()), start=1):
+                if waiting == member_id:
+                    return position
+            return 0
+
+    def waitlist(self, item_id: str):
+        """
+        Return the IDs of the members waiting for an item, next in line first.
+        """
+        self._sync()
+        with self._lock:
+            return list(self.waiting.get(item_id, ()))
+
+    def has_waiting(self, item_id: str) -> bool:
+        """
+        Return True if anyone is waiting for the item.
+        """
+        self._sync()
+        with self._lock:
+            return item_id in self.waiting
+
+    def ready_for(self, item_id: str):
+        """
+        Return the ID of the member the item is set aside for, or None.
+        """
+        self._sync()
+        with self._lock:
+            hold = self.ready.get(item_id)
+            return hold.member_id if hold is not None else None
+
+    def holds_for_member(self, member_id: str):
+        """
+        Return every hold a member has, waiting or ready.
+        """
+        return [self._hold(row) for row in self.table.find('member_id', member_id)]
+
+    @timed('holds.promote')
+    def promote(self, item_id: str, today: date = None):
+        """
+        Set the item aside for the member at the head of its waitlist, for
+        HOLD_DAYS days. Returns their Hold, or None if nobody is waiting.
+        """
+        today = today or date.today()
+        while True:
+            self._sync()
+            with self._lock:
+                queue = self.waiting.get(item_id)
+                if not queue:
+                    return None
+                member_id = next(iter(queue))
+            ready_until = (today + timedelta(days=self.HOLD_DAYS)).isoformat()
+            try:
+                # Only if the hold is still waiting: another desk may have got there first
+                self.table.update((item_id, member_id), {'ready_until': ready_until},
+                                  expected={'ready_until': ''})
+            except ConflictError:
+                continue
+            hold = self._hold(self.table.get((item_id, member_id)))
+            for callback in self.listeners:
+                callback(hold)
+            return hold
+
+    def remove(self, item_id: str, member_id: str) -> bool:
+        """
+        Drop a hold, e.g. once the member has borrowed the item or cancelled.
+        Returns False if there was no such hold.
+        """
+        return self.table.delete((item_id, member_id))
+
+    @timed('holds.expire')
+    def expire(self, today: date = None):
+        """
+        Remove every ready hold whose collection deadline has passed and
+        return them, oldest deadline first. Only holds that are due are
+        looked at.
+        """
+        cutoff = (today or date.today()).toordinal()
+        self._sync()
+        expired = []
+        while True:
+            with self._lock:
+                if not self.expiry or self.expiry[0][0] >= cutoff:
+                    break
+                deadline, item_id, member_id = heapq.heappop(self.expiry)
+                hold = self.ready.get(item_id)
+                if hold is None or hold.member_id != member_id \
+                        or date.fromisoformat(hold.ready_until).toordinal() != deadline:
+                    continue  # Collected, cancelled or moved since this entry was pushed
+            if self.remove(item_id, member_id):
+                expired.append(hold)
+        return expired
+
+    def checkpoint(self):
+        """
+        Fold journaled holds into the holds table (and save its snapshot).
+        """
+        self.table.checkpoint()
+
+    def __len__(self):
+        return len(self.table)
@@ -0,0 +1,216 @@
+import argparse  # Module for reading command-line options
+from collections import Counter  # Finds items lent to more than one member
+from operator import itemgetter  # Pulls key columns out of whole tables in C
+from library import LibraryService  # Opens the members, items, loans and holds tables together
+from metrics import timed  # Opt-in timing of checks and repairs
+from storage import ConflictError  # Raised when an item changed while being repaired
+
+# Every kind of problem the checker finds, and what repair() does about it
+KINDS = {
+    'loan_without_member': "loan by a member who does not exist (loan removed)",
+    'loan_without_item': "loan of an item that does not exist (loan removed)",
+    'loan_of_item_not_on_loan': "loan of an item not marked on loan, left by a return cut short (loan removed)",
+    'item_on_loan_without_loan': "item marked on loan without a loan, left by a borrow cut short "
+                                 "(item shelved, or set aside if members are waiting)",
+    'item_lent_twice': "item with loans to several members (reported only)",
+    'hold_without_member': "hold by a member who does not exist (hold removed)",
+    'hold_without_item': "hold on an item that does not exist (hold removed)",
+    'item_on_hold_without_hold': "item set aside for nobody (passed to the next member, or shelved)",
+}
+
+
+class Problem:
+    """
+    One inconsistency between the tables: its kind (see KINDS), the key of
+    the row concerned (an item ID, or (item ID, member ID) for loans and
+    holds) and a short description.
+    """
+    # Fixed attributes instead of a per-instance __dict__, as a damaged library can have many problems
+    __slots__ = ('kind', 'key', 'detail')
+
+    def __init__(self, kind: str, key, detail: str):
+        self.kind = kind      # One of KINDS
+        self.key = key        # Key of the loan, hold or item concerned
+        self.detail = detail  # What is wrong, for people
+
+    def to_dict(self):
+        # Convert this problem into a dictionary, e.g. for JSON output
+        return {'kind': self.kind, 'key': list(self.key) if isinstance(self.key, tuple) else self.key,
+                'detail': self.detail}
+
+
+class IntegrityChecker:
+    """
+    Cross-checks members, items, loans and holds. check() reads each table
+    once, keeping only key sets and an item ID -> status dict in memory, and
+    joins the loans and holds against them by hash lookup, so the whole check
+    is linear in the number of rows.
+
+    repair() fixes what can be fixed, one batch write per table, while
+    holding the writer lock of all four tables (see Table.exclusive), so no
+    borrow, return or hold from another desk or process lands in the middle
+    of it; they wait until it is done. Problems passed in are checked again
+    under the lock, and only the fixes written are returned. On SQLite the
+    whole repair is one transaction; on CSV storage a repair that is cut
+    short by a crash only leaves problems the next run fixes.
+    """
+    def __init__(self, service: LibraryService):
+        self.service = service
+        self.members = service.members_repo.table  # Members table
+        self.items = service.items_repo.table      # Items table
+        self.loans = service.ledger.table          # Active loans table
+        self.holds = service.holds.table           # Holds table
+
+    @timed('integrity.check')
+    def check(self):
+        """
+        Return every Problem found, loans first, then items, then holds.
+        """
+        members = set(map(itemgetter('id'), self.members.iter_rows()))
+        status = dict(map(itemgetter('id', 'status'), self.items.iter_rows()))
+        problems = []
+        lent = Counter()  # item ID -> loans of it
+        for item_id, member_id in map(itemgetter('item_id', 'borrowed_by'), self.loans.iter_rows()):
+            lent[item_id] += 1
+            if member_id not in members:
+                problems.append(Problem('loan_without_member', (item_id, member_id),
+                                        f"Loan of {item_id} to unknown member {member_id}."))
+            item_status = status.get(item_id)
+            if item_status is None:
+                problems.append(Problem('loan_without_item', (item_id, member_id),
+                                        f"Loan of unknown item {item_id} to {member_id}."))
+            elif item_status != 'on_loan':
+                problems.append(Problem('loan_of_item_not_on_loan', (item_id, member_id),
+                                        f"Loan of {item_id} to {member_id}, but the item is {item_status}."))
+        for item_id, n in lent.items():
+            if n > 1:
+                problems.append(Problem('item_lent_twice', item_id, f"Item {item_id} is lent {n} times."))
+        for item_id, item_status in status.items():
+            if item_status == 'on_loan' and item_id not in lent:
+                problems.append(Problem('item_on_loan_without_loan', item_id,
+                                        f"Item {item_id} is on loan, but nobody has it."))
+        ready = set()
+        for item_id, member_id, ready_until in map(itemgetter('item_id', 'member_id', 'ready_until'),
+                                                   self.holds.iter_rows()):
+            if member_id not in members:
+                problems.append(Problem('hold_without_member', (item_id, member_id),
+                                        f"Hold on {item_id} by unknown member {member_id}."))
+            elif item_id not in status:
+                problems.append(Problem('hold_without_item', (item_id, member_id),
+                                        f"Hold on unknown item {item_id} by {member_id}."))
+            elif ready_until:
+                ready.add(item_id)
+        for item_id, item_status in status.items():
+            if item_status == 'on_hold' and item_id not in ready:
+                problems.append(Problem('item_on_hold_without_hold', item_id,
+                                        f"Item {item_id} is on hold, but not for anyone."))
+        return problems
+
+    @timed('integrity.repair')
+    def repair(self, problems=None):
+        """
+        Fix the given problems (default: run check() first) and return the
+        ones that were fixed. Items lent twice are left for a person to sort out.
+        """
+        # Lock the tables in one fixed order, so two repairs cannot deadlock
+        with self.members.exclusive(), self.items.exclusive(), self.loans.exclusive(), \
+                self.holds.exclusive():
+            return self._repair(self.check() if problems is None else list(problems))
+
+    def _repair(self, problems):
+        # Called with every table locked. The problems may have been found
+        # before the lock was taken, so each is checked again before its fix
+        # is written, and only fixes actually written are returned.
+        fixed = []
+        kinds = {}
+        for problem in problems:
+            kinds.setdefault(problem.kind, []).append(problem)
+
+        # 1. Loans that should not exist, in one write. Each is dropped only
+        # if it is still there and its member or item is still missing, or
+        # its item still is not on loan.
+        loans = [problem for kind in ('loan_without_member', 'loan_without_item', 'loan_of_item_not_on_loan')
+                 for problem in kinds.get(kind, [])]
+        present = self.loans.get_many({problem.key for problem in loans})
+        members = self.members.get_many({problem.key[1] for problem in loans})
+        statuses = self.items.get_many({problem.key[0] for problem in loans})
+        loans = [problem for problem in loans if problem.key in present and (
+            problem.key[1] not in members if problem.kind == 'loan_without_member' else
+            problem.key[0] not in statuses if problem.kind == 'loan_without_item' else
+            problem.key[0] in statuses and statuses[problem.key[0]]['status'] != 'on_loan')]
+        self.loans.delete_many({problem.key for problem in loans})
+        fixed += loans
+
+        # 2. Holds that still refer to a missing member or item, in one write
+        holds = kinds.get('hold_without_member', []) + kinds.get('hold_without_item', [])
+        present = self.holds.get_many({problem.key for problem in holds})
+        members = self.members.get_many({problem.key[1] for problem in holds})
+        known = self.items.get_many({problem.key[0] for problem in holds})
+        holds = [problem for problem in holds if problem.key in present and (
+            problem.key[1] not in members if problem.kind == 'hold_without_member' else
+            problem.key[0] not in known)]
+        self.holds.delete_many({problem.key for problem in holds})
+        fixed += holds
+
+        # 3. Items marked on loan that nobody has: shelved, or set aside if
+        # members are waiting, in one compare-and-set write
+        missing = [problem for problem in kinds.get('item_on_loan_without_loan', [])
+                   if not self.service.ledger.is_lent(problem.key)]
+        items = self.service.items_repo.get_many([problem.key for problem in missing])
+        for item in items.values():
+            item.status = 'on_hold' if self.service.holds.has_waiting(item.id) else 'available'
+        lost = set()
+        changed = list(items.values())
+        while changed:
+            try:
+                self.service.items_repo.update_many(changed, expected_status='on_loan')
+                break
+            except ConflictError as conflict:
+                # Borrowed or returned since the problems were found: no longer ours to fix
+                lost.update(conflict.keys)
+                changed = [item for item in changed if item.id not in lost]
+        fixed += [problem for problem in missing if problem.key in items and problem.key not in lost]
+
+        # 4. Items set aside for nobody, including those just put on hold. An
+        # item counts as fixed once it is set aside for someone or shelved.
+        for item_id in [item.id for item in changed if item.status == 'on_hold']:
+            self._hand_off(item_id)
+        fixed += [problem for problem in kinds.get('item_on_hold_without_hold', [])
+                  if self._hand_off(problem.key)]
+        return fixed
+
+    def _hand_off(self, item_id: str) -> bool:
+        # Pass on an item that is on hold for nobody; True if that was written
+        item = self.items.get(item_id)
+        if item is None or item['status'] != 'on_hold' or self.service.holds.ready_for(item_id) is not None:
+            return False  # Dealt with since the problem was found
+        if self.service.hand_off(item_id) is not None:
+            return True
+        return self.items.get(item_id)['status'] == 'available'  # False if the write hit a conflict
+
+
+def print_problems(problems, limit: int = 20):
+    """
+    Print how many problems of each kind there are and the first `limit` of them.
+    """
+    if not problems:
+        print("No problems found.")
+        return
+    for kind, n in Counter(problem.kind for problem in problems).items():
+        print(f"{n} {KINDS[kind]}")
+    for problem in problems[:limit]:
+        print(f"  {problem.detail}")
+    if len(problems) > limit:
+        print(f"  ... and {len(problems) - limit} more")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cross-check members, items, loans and holds.')
+    parser.add_argument('--repair', action='store_true', help='fix the problems that can be fixed')
+    args = parser.parse_args()
+    checker = IntegrityChecker(LibraryService())
+    problems = checker.check()
+    print_problems(problems)
+    if args.repair and problems:
+        # Check again under the tables' locks, as desks may have changed them since
+        print(f"Repaired {len(checker.repair())} problems.")
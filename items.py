@@ -1,17 +1,24 @@
-import csv  # Module for reading and writing CSV files
-import os   # Module for file and directory operations
+import sys  # sys.intern shares one copy of strings that repeat across items
+import threading  # Guards the search index version against concurrent changes
 from typing import Optional  # For type hints indicating a function might return None
+from storage import ConflictError, open_storage  # Storage backend selection and update conflicts
+from search import SearchIndex  # Word index over titles and authors
+from metrics import timed  # Opt-in timing of repository operations
 
 class Item:
     """
     Represents an item in the library (e.g., a book) with its details and status.
     """
+    # Fixed attributes instead of a per-instance __dict__, to keep items small
+    __slots__ = ('id', 'title', 'author', 'status')
+
     def __init__(self, item_id: str, title: str, author: str, status: str = 'available'):
         # Initialize the item with ID, title, author, and availability status
         self.id = item_id     # Unique identifier for the item
         self.title = title    # Title of the item
-        self.author = author  # Author or creator of the item
-        self.status = status  # Current status: 'available' or 'on_loan'
+        # Authors and statuses repeat across many items, so share one copy of each
+        self.author = sys.intern(author)  # Author or creator of the item
+        self.status = sys.intern(status)  # Current status: 'available', 'on_loan' or 'on_hold'
 
     def to_dict(self):
         # Convert this Item into a dictionary matching the CSV columns
@@ -24,64 +31,192 @@ class Item:
 
 class ItemsRepository:
     """
-    Manages storage and retrieval of Item records in a CSV file.
+    Manages storage and retrieval of Item records in a storage backend
+    (CSV files by default, or SQLite).
     """
-    # Define where the items CSV file will be stored
-    CSV_PATH = os.path.join('csv', 'items.csv')
-
-    def __init__(self):
-        # Ensure the directory for the CSV file exists
-        os.makedirs(os.path.dirname(self.CSV_PATH), exist_ok=True)
-        # If the CSV file doesn't exist yet, create it with a header row
-        if not os.path.exists(self.CSV_PATH):
-            with open(self.CSV_PATH, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['id', 'title', 'author', 'status'])
-                writer.writeheader()
+    # Name of the table (for CSV storage: csv/items.csv) and its columns
+    TABLE = 'items'
+    FIELDNAMES = ['id', 'title', 'author', 'status']
+    # Number of journaled status changes that triggers a checkpoint (CSV storage only)
+    CHECKPOINT_EVERY = 1000
+    # Times a search index rebuild is retried when the table changes while it reads it
+    REBUILD_ATTEMPTS = 5
+
+    def __init__(self, storage=None):
+        # Use the storage backend chosen in the environment unless one is given
+        storage = storage or open_storage()
+        # Item status changes are journaled rather than rewriting the whole file
+        self.table = storage.table(self.TABLE, self.FIELDNAMES, journal=True,
+                                   checkpoint_every=self.CHECKPOINT_EVERY, shared=['author', 'status'])
+        # Title/author search index, built the first time search() is called
+        self._search = None
+        self._search_stale = False  # Set when the table was reloaded and the index must be rebuilt
+        self._search_version = 0    # Bumped by every change we are told about
+        self._search_lock = threading.Lock()  # Held while the version or stale flag is read or changed
 
+    @timed('items.get')
     def get(self, item_id: str) -> Optional[Item]:
         """
         Retrieve an Item by its ID. Returns None if not found.
         """
-        with open(self.CSV_PATH, newline='', encoding='utf-8') as f:
-            for row in csv.DictReader(f):
-                if row['id'] == item_id:
-                    # Create and return an Item object from the row data
-                    return Item(row['id'], row['title'], row['author'], row['status'])
-        return None  # No matching item found
-
-    def update(self, item: Item):
-        """
-        Update the status (or other fields) of an existing Item in the CSV.
-        """
-        rows = []
-        # Read all rows and modify the one matching our item ID
-        with open(self.CSV_PATH, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['id'] == item.id:
-                    row['status'] = item.status  # Update status field
-                rows.append(row)
-        # Write all rows back to the CSV, including our updated row
-        with open(self.CSV_PATH, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
+        row = self.table.get(item_id)
+        if row is None:
+            return None  # No matching item found
+        # Create and return an Item object from the row data
+        return Item(row['id'], row['title'], row['author'], row['status'])
+
+    @timed('items.get_many')
+    def get_many(self, item_ids) -> dict:
+        """
+        Retrieve several Items at once. Returns a dict of ID -> Item for the IDs that exist.
+        """
+        rows = self.table.get_many(item_ids)
+        return {item_id: Item(row['id'], row['title'], row['author'], row['status'])
+                for item_id, row in rows.items()}
+
+    @timed('items.update')
+    def update(self, item: Item, expected_status: str = None) -> bool:
+        """
+        Update the status (or other fields) of an existing Item.
+        The change is appended to the journal as a single line.
+        If expected_status is given, the update only happens if the stored
+        item still has that status (compare-and-set); returns False if it
+        was changed by someone else in the meantime.
+        """
+        expected = {'status': expected_status} if expected_status else None
+        try:
+            self.table.update(item.id, {'status': item.status}, expected)
+        except ConflictError:
+            return False  # Someone else changed the status first
         print(f"Item {item.id} status updated to {item.status}.")  # Confirmation message
+        return True
 
+    @timed('items.update_many')
+    def update_many(self, items, expected_status: str = None) -> int:
+        """
+        Update the status of several Items in one write, without printing.
+        If expected_status is given, every stored item must still have that
+        status; otherwise nothing is written and ConflictError lists the
+        items that had changed.
+        Returns how many items were found and updated.
+        """
+        items = list(items)
+        expected = {item.id: {'status': expected_status} for item in items} if expected_status else None
+        return self.table.update_many(((item.id, {'status': item.status}) for item in items), expected)
+
+    @timed('items.add')
     def add(self, item: Item):
         """
-        Add a new Item to the CSV file.
+        Add a new Item to the repository.
         """
-        with open(self.CSV_PATH, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=item.to_dict().keys())
-            writer.writerow(item.to_dict())  # Write the item data as a new row
+        self.table.append(item.to_dict())  # Write the item data as a new row
         print(f"Item {item.id} added.")  # Confirmation message
-    
-    def list(self):
+
+    @timed('items.add_many')
+    def add_many(self, items) -> int:
+        """
+        Add several new Items in one write, without printing.
+        Returns how many items were written.
         """
-        Print all items to the console in a readable format.
+        rows = [item.to_dict() for item in items]
+        self.table.append_many(rows)
+        return len(rows)
+
+    def iter_items(self, status: str = None, author: str = None, offset: int = 0,
+                   limit: int = None, after: str = None):
+        """
+        Yield Items one at a time in the order they were added, optionally only
+        those with the given status and/or author. The first `offset` matches
+        are skipped and at most `limit` are yielded. To fetch the next page,
+        pass the ID of the last item of the previous page as `after`.
+        """
+        equal = {column: value for column, value in (('status', status), ('author', author))
+                 if value is not None}
+        for row in self.table.scan(after, offset, limit, equal):
+            yield Item(row['id'], row['title'], row['author'], row['status'])
+
+    @timed('items.list')
+    def list(self, status: str = None, author: str = None, offset: int = 0, limit: int = None):
         """
-        with open(self.CSV_PATH, newline='', encoding='utf-8') as f:
-            for row in csv.DictReader(f):
-                # Print each item as "ID: Title (Author) - Status"
-                print(f"{row['id']}: {row['title']} ({row['author']}) - {row['status']}")
+        Print items to the console in a readable format, optionally filtered
+        and limited to one page.
+        """
+        for item in self.iter_items(status, author, offset, limit):
+            # Print each item as "ID: Title (Author) - Status"
+            print(f"{item.id}: {item.title} ({item.author}) - {item.status}")
+
+    @timed('items.count')
+    def count(self) -> int:
+        """
+        Return how many items are stored.
+        """
+        return len(self.table)
+
+    @timed('items.checkpoint')
+    def checkpoint(self):
+        """
+        Fold any journaled status changes into the stored items and save a
+        snapshot of them for a fast next start.
+        """
+        self.table.checkpoint()
+
+    @timed('items.search')
+    def search(self, query: str, limit: int = 10):
+        """
+        Find items whose title or author contains every word of the query,
+        either whole or as the start of a word (so 'mock' finds 'Mockingbird').
+        Case and accents are ignored. Returns up to `limit` Items, best first.
+        """
+        index = self._search_index()
+        item_ids = index.search(query, limit)
+        rows = self.table.get_many(item_ids)
+        return [Item(rows[i]['id'], rows[i]['title'], rows[i]['author'], rows[i]['status'])
+                for i in item_ids if i in rows]
+
+    def print_search(self, query: str, limit: int = 10):
+        """
+        Print the best matches for a partial title or author.
+        """
+        items = self.search(query, limit)
+        if not items:
+            print("No matching items.")
+        for item in items:
+            print(f"{item.id}: {item.title} ({item.author}) - {item.status}")
+
+    def _search_index(self) -> SearchIndex:
+        # Build the search index on first use; after that the table tells us
+        # about every change, so only a reload forces a rebuild
+        if self._search is None:
+            self._search = SearchIndex()
+            self._search_stale = True
+            self.table.watch(self._on_change)
+        self.table.refresh()  # Pick up changes made elsewhere
+        if self._search_stale:
+            self._rebuild_search()
+        return self._search
+
+    def _rebuild_search(self):
+        # Reindex every item, again if a change arrived while we were reading
+        # the table (it may be missing from what we read)
+        for attempt in range(self.REBUILD_ATTEMPTS):
+            with self._search_lock:
+                version = self._search_version
+            self._search.rebuild((row['id'], row['title'], row['author'])
+                                 for row in self.table.iter_rows())
+            with self._search_lock:
+                if self._search_version == version or attempt == self.REBUILD_ATTEMPTS - 1:
+                    self._search_stale = False
+                    return
+
+    def _on_change(self, item_id, old, new):
+        # Keep the search index in step with one change to the items table
+        with self._search_lock:
+            self._search_version += 1
+            if item_id is None:
+                self._search_stale = True  # Table reloaded: rebuild before the next search
+                return
+        if new is None:
+            self._search.remove(item_id)
+        elif old is None or (old['title'], old['author']) != (new['title'], new['author']):
+            # Status changes (borrow/return) don't affect the words indexed
+            self._search.add(item_id, new['title'], new['author'])
@@ -2,22 +2,61 @@ from members import Member, MembersRepository  # Import Member and repository cl
 from items import Item, ItemsRepository      # Import Item and repository classes for items
 from library import LibraryService           # Import the main service handling library operations
 from data_initialiser import DataInitialiser # Import the class that seeds initial data
+from reports import LibraryReports           # Import the live statistics
+from storage import open_storage             # Import the storage backend selection
+import metrics                               # Import the opt-in timers and counters
 
 # A list to hold menu options as tuples of (label, function)
 MENU_OPTIONS = []
 
+# Number of records shown at a time by the list options
+PAGE_SIZE = 20
+
 def register_menu(label, func):
     """
     Register a menu option by adding a tuple of its label and function.
     """
     MENU_OPTIONS.append((label, func))
 
+def page_through(fetch, show):
+    """
+    Print records one page at a time. fetch(after) returns the next page of
+    records after the one with ID `after` (from the start if None), and
+    show(record) prints one record. Only one page is held in memory.
+    """
+    after = None
+    while True:
+        page = list(fetch(after))
+        for record in page:
+            show(record)
+        if len(page) < PAGE_SIZE:
+            break  # That was the last page
+        if input("Press Enter for more, or q to stop: ").strip().lower() == 'q':
+            break
+        after = page[-1].id
+
+def list_items(repo: ItemsRepository):
+    """
+    Ask for an optional status, then print the matching items a page at a time.
+    """
+    status = input('Status (blank for all): ').strip() or None
+    page_through(
+        lambda after: repo.iter_items(status=status, limit=PAGE_SIZE, after=after),
+        lambda item: print(f"{item.id}: {item.title} ({item.author}) - {item.status}")
+    )
+
 if __name__ == '__main__':
-    # Initialize repositories for members and items
-    members_repo = MembersRepository()
-    items_repo = ItemsRepository()
-    # Initialize the service that uses these repositories
-    service = LibraryService()
+    # Open the storage backend once, and the repositories for members and items on it
+    storage = open_storage()
+    members_repo = MembersRepository(storage)
+    items_repo = ItemsRepository(storage)
+    # Initialize the service that uses these repositories, sharing them so
+    # every table is loaded (from its snapshot when one is up to date) only once
+    service = LibraryService(storage, members_repo, items_repo)
+
+    # Once a minute, pass on items whose holds ran out and fold journaled
+    # loans and returns into library.csv
+    service.start_housekeeping()
 
     # Seed sample data only if the CSV stores are empty
     DataInitialiser.seed_members(members_repo)
@@ -30,7 +69,10 @@ if __name__ == '__main__':
     )
     register_menu(
         'List members',
-        lambda: members_repo.list()  # Print all members
+        lambda: page_through(
+            lambda after: members_repo.iter_members(limit=PAGE_SIZE, after=after),
+            lambda m: print(f"{m.id}: {m.name} ({m.membership_date})")
+        )  # Print members a page at a time
     )
     register_menu(
         'Add member',
@@ -44,12 +86,38 @@ if __name__ == '__main__':
     )
     register_menu(
         'List items',
-        lambda: items_repo.list()  # Print all items
+        lambda: list_items(items_repo)  # Print items a page at a time
+    )
+    register_menu(
+        'Search items',
+        lambda: items_repo.print_search(input('Title or author: ').strip())  # Print the best matches
     )
     register_menu(
         'Borrow book',
         lambda: service.borrow_book()  # Call borrow operation in service
     )
+    register_menu(
+        'Renew book',
+        lambda: service.renew_book()  # Extend a loan's due date
+    )
+    register_menu(
+        'Show overdue loans',
+        lambda: service.print_overdue()  # Print loans past their due date
+    )
+    register_menu(
+        'Place hold',
+        lambda: service.place_hold()  # Join the waitlist for a book that is out
+    )
+    reports = LibraryReports(service)
+    register_menu(
+        'Show statistics',
+        lambda: reports.print_summary()  # Print loans, overdue items and busiest members
+    )
+    if metrics.ENABLED:
+        register_menu(
+            'Show metrics',
+            lambda: print(metrics.REGISTRY.to_prometheus())  # Print timers and counters (LIBRARY_METRICS=1)
+        )
 
     # Main loop: display menu and handle user input
     while True:
@@ -65,6 +133,16 @@ if __name__ == '__main__':
         label, action = MENU_OPTIONS[int(choice) - 1]
         # If action is None, user chose 'Quit'
         if action is None:
+            # Fold any journaled item status changes, loans and holds into the CSV files
+            # and save the snapshots before exiting
+            service.stop_housekeeping()
+            members_repo.checkpoint()
+            items_repo.checkpoint()
+            service.ledger.compact()
+            service.holds.checkpoint()
+            # Save the sampled profiles, if any operations were profiled (LIBRARY_PROFILE)
+            if metrics.PROFILED:
+                metrics.REGISTRY.write_profiles(metrics.PROFILE_DIR)
             print("Goodbye!")
             break  # Exit the loop and end program
         # Otherwise, call the selected function
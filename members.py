@@ -1,17 +1,21 @@
-import csv  # Module for reading and writing CSV files
-import os   # Module for interacting with the operating system (e.g., file paths)
 from datetime import datetime  # Module for working with dates and times (not yet used here)
+import sys  # sys.intern shares one copy of dates that repeat across members
 from typing import Optional  # For type hints (indicating that a function might return None)
+from storage import open_storage  # Chooses the CSV or SQLite storage backend
+from metrics import timed  # Opt-in timing of repository operations
 
 class Member:
     """
     A simple class to represent a library member with an ID, name, and membership date.
     """
+    # Fixed attributes instead of a per-instance __dict__, to keep members small
+    __slots__ = ('id', 'name', 'membership_date')
+
     def __init__(self, mid: str, name: str, date: str):
         # Store the provided values in instance variables
         self.id = mid  # Unique identifier for the member
         self.name = name  # Member's full name
-        self.membership_date = date  # Date when membership started (as a string)
+        self.membership_date = sys.intern(date)  # Date when membership started (as a string)
 
     def to_dict(self):
         # Convert this Member object into a dictionary, matching our CSV columns
@@ -23,111 +27,139 @@ class Member:
 
 class MembersRepository:
     """
-    Handles storage and retrieval of Member records in a CSV file.
+    Handles storage and retrieval of Member records in a storage backend
+    (CSV files by default, or SQLite).
     """
-    # Define where the CSV file will be stored (in a folder named 'csv')
-    CSV_PATH = os.path.join('csv', 'members.csv')
-
-    def __init__(self):
-        # Ensure that the folder for our CSV file exists
-        os.makedirs(os.path.dirname(self.CSV_PATH), exist_ok=True)
-        # If the CSV file does not exist yet, create it and write the header row
-        if not os.path.exists(self.CSV_PATH):
-            with open(self.CSV_PATH, 'w', newline='', encoding='utf-8') as f:
-                # csv.DictWriter writes dictionaries into CSV rows
-                writer = csv.DictWriter(f, fieldnames=['id', 'name', 'membership_date'])
-                writer.writeheader()  # Write the header row with column names
+    # Name of the table (for CSV storage: csv/members.csv) and its columns
+    TABLE = 'members'
+    FIELDNAMES = ['id', 'name', 'membership_date']
+
+    def __init__(self, storage=None):
+        # Use the storage backend chosen in the environment unless one is given
+        storage = storage or open_storage()
+        # Open the members table, indexed by member ID (join dates repeat, so are shared)
+        self.table = storage.table(self.TABLE, self.FIELDNAMES, shared=['membership_date'])
+        # Called with a member ID before it is deleted; a non-empty return is the reason to refuse
+        self.guards = []
 
+    def add_guard(self, callback):
+        """
+        Call callback(member_id) before a member is deleted. If it returns a
+        message, the member is kept and the message printed instead, e.g.
+        because they still have books on loan.
+        """
+        self.guards.append(callback)
+
+    @timed('members.get')
     def get(self, member_id: str) -> Optional[Member]:
         """
         Retrieve a Member by their ID. Return None if not found.
         """
-        # Open the CSV file for reading
-        with open(self.CSV_PATH, newline='', encoding='utf-8') as f:
-            # csv.DictReader reads each row as a dict with keys from the header
-            for row in csv.DictReader(f):
-                # Check if this row's 'id' matches the requested member_id
-                if row['id'] == member_id:
-                    # Create and return a Member object from the row data
-                    return Member(row['id'], row['name'], row['membership_date'])
-        # If we reach the end of the file without a match, return None
-        return None
+        # Look the ID up in the index instead of scanning every record
+        row = self.table.get(member_id)
+        if row is None:
+            return None
+        # Create and return a Member object from the row data
+        return Member(row['id'], row['name'], row['membership_date'])
 
-    def list(self):
+    @timed('members.get_many')
+    def get_many(self, member_ids) -> dict:
         """
-        Print all members to the console in a readable format.
+        Retrieve several Members at once. Returns a dict of ID -> Member for the IDs that exist.
         """
-        with open(self.CSV_PATH, newline='', encoding='utf-8') as f:
-            for row in csv.DictReader(f):
-                # Print each member as "ID: Name (Date)"
-                print(f"{row['id']}: {row['name']} ({row['membership_date']})")
+        rows = self.table.get_many(member_ids)
+        return {member_id: Member(row['id'], row['name'], row['membership_date'])
+                for member_id, row in rows.items()}
 
+    def iter_members(self, joined_from: str = None, joined_to: str = None, offset: int = 0,
+                     limit: int = None, after: str = None):
+        """
+        Yield Members one at a time in the order they were added, optionally
+        only those who joined between two dates (YYYY-MM-DD, both inclusive).
+        The first `offset` matches are skipped and at most `limit` are yielded.
+        To fetch the next page, pass the ID of the last member of the previous
+        page as `after`.
+        """
+        between = {'membership_date': (joined_from, joined_to)} if joined_from or joined_to else None
+        for row in self.table.scan(after, offset, limit, between=between):
+            yield Member(row['id'], row['name'], row['membership_date'])
+
+    @timed('members.list')
+    def list(self, joined_from: str = None, joined_to: str = None, offset: int = 0, limit: int = None):
+        """
+        Print members to the console in a readable format, optionally filtered
+        and limited to one page.
+        """
+        for member in self.iter_members(joined_from, joined_to, offset, limit):
+            # Print each member as "ID: Name (Date)"
+            print(f"{member.id}: {member.name} ({member.membership_date})")
+
+    @timed('members.add')
     def add(self, member: Member):
         """
-        Add a new Member to the CSV file.
+        Add a new Member to the repository.
         """
-        # Open the CSV in append mode ('a') so we add rows to the end
-        with open(self.CSV_PATH, 'a', newline='', encoding='utf-8') as f:
-            # Use the keys of member.to_dict() as fieldnames for writing
-            writer = csv.DictWriter(f, fieldnames=member.to_dict().keys())
-            writer.writerow(member.to_dict())  # Write the member data as a new row
+        # Append the member data as a new row
+        self.table.append(member.to_dict())
         # Let the user know the member was added successfully
         print(f"Member {member.id} added.")
+
+    @timed('members.add_many')
+    def add_many(self, members) -> int:
+        """
+        Add several new Members in one write, without printing.
+        Returns how many members were written.
+        """
+        rows = [member.to_dict() for member in members]
+        self.table.append_many(rows)
+        return len(rows)
     
+    @timed('members.update')
     def update(self, member: Member):
         """
-        Update an existing Member in the CSV file.
-        """
-        rows = []   # List to hold all rows, including the updated one      
-        # Open the CSV file for reading
-        with open(self.CSV_PATH, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            # Read each row and check if it matches the member ID we want to update
-            for row in reader:
-                if row['id'] == member.id:
-                    # Update the row with new member data
-                    row['name'] = member.name
-                    row['membership_date'] = member.membership_date
-                rows.append(row)
-        # Open the CSV file for writing (overwriting the old data)
-        with open(self.CSV_PATH, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
-            writer.writeheader()  # Write the header row
-            writer.writerows(rows)  # Write all rows back to the CSV, including our updated row
+        Update an existing Member in the repository.
+        """
+        # Change the stored row for this member
+        self.table.update(member.id, {
+            'name': member.name,
+            'membership_date': member.membership_date
+        })
         # Let the user know the member was updated successfully
         print(f"Member {member.id} updated.")
 
-    def delete(self, member_id: str):
-        # """
-        # Delete a Member from the CSV file by their ID.
-        # """
-        
-        """Delete a member by ID from csv/members.csv."""
-        member_id = input("Enter the ID of the member to delete: ").strip()
-        path = os.path.join('csv', 'members.csv')
-
-        # Check file exists
-        if not os.path.exists(path):
-            print("No members found. File does not exist.")
-            return
-
-        # Read all members
-        with open(path, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
+    @timed('members.delete')
+    def delete(self, member_id: str = None):
+        """
+        Delete a Member from the repository by their ID.
+        Prompts for the ID if none is given.
+        """
+        if not member_id:
+            member_id = input("Enter the ID of the member to delete: ").strip()
 
-        # Filter out the member to delete
-        filtered = [row for row in rows if row.get('id') != member_id]
+        # Refuse if anything still refers to the member
+        for guard in self.guards:
+            reason = guard(member_id)
+            if reason:
+                print(reason)
+                return
 
-        if len(filtered) == len(rows):
+        # Remove the member's row from storage
+        if not self.table.delete(member_id):
             print(f"No member with ID '{member_id}' found.")
             return
 
-        # Rewrite CSV (header + remaining rows)
-        with open(path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['id', 'name', 'membership_date'])
-            writer.writeheader()
-            writer.writerows(filtered)
-
         print(f"Member with ID '{member_id}' has been deleted.")
 
+    @timed('members.count')
+    def count(self) -> int:
+        """
+        Return how many members are stored.
+        """
+        return len(self.table)
+
+    @timed('members.checkpoint')
+    def checkpoint(self):
+        """
+        Save a snapshot of the members for a fast next start (CSV storage only).
+        """
+        self.table.checkpoint()
@@ -0,0 +1,240 @@
+import cProfile  # Deterministic profiler, run around sampled calls
+import functools  # Keeps the name and docstring of timed methods
+import io  # Collects profile reports as text
+import json  # JSON dump of the metrics
+import os  # Environment switches and profile output files
+import pstats  # Turns profiles into readable reports
+import threading  # Timers and counters are updated from several threads
+import time  # High-resolution timers
+
+# LIBRARY_METRICS=1 times every repository and LibraryService operation.
+# It is read once, when the modules are imported: with it unset the methods
+# are left exactly as written, so instrumentation costs nothing.
+ENABLED = os.environ.get('LIBRARY_METRICS', '') not in ('', '0')
+# LIBRARY_PROFILE=items.get,library.borrow_book runs cProfile around one in
+# every LIBRARY_PROFILE_EVERY calls of the named operations.
+PROFILED = {name.strip() for name in os.environ.get('LIBRARY_PROFILE', '').split(',') if name.strip()}
+PROFILE_EVERY = int(os.environ.get('LIBRARY_PROFILE_EVERY', '10'))
+# Where the profiles are saved when the program exits
+PROFILE_DIR = os.environ.get('LIBRARY_PROFILE_DIR', 'profiles')
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Timer:
+    """
+    Latencies of one operation: call count, total and slowest time, and a
+    histogram of how many calls finished within each bucket.
+    """
+    __slots__ = ('count', 'total', 'slowest', 'buckets')
+
+    def __init__(self):
+        self.count = 0                     # Number of calls
+        self.total = 0                     # Time spent in all calls, in nanoseconds
+        self.slowest = 0                   # Slowest call, in nanoseconds
+        self.buckets = [0] * len(BUCKETS)  # Calls no slower than each bucket bound
+
+    def add(self, elapsed: int):
+        # Record one call that took `elapsed` nanoseconds
+        self.count += 1
+        self.total += elapsed
+        self.slowest = max(self.slowest, elapsed)
+        seconds = elapsed / 1e9
+        for position, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[position] += 1
+                break
+
+    def to_dict(self):
+        # Summary in milliseconds, e.g. for the JSON dump
+        return {
+            'count': self.count,
+            'total_ms': round(self.total / 1e6, 3),
+            'mean_ms': round(self.total / self.count / 1e6, 4) if self.count else None,
+            'max_ms': round(self.slowest / 1e6, 4)
+        }
+
+
+class Metrics:
+    """
+    Collects operation timers, counters (rows read, bytes read and written,
+    index hits and reloads, each per table or file) and sampled profiles,
+    and dumps them as Prometheus text or JSON.
+    """
+    def __init__(self, enabled: bool = False, profiled=(), profile_every: int = 10):
+        self.enabled = enabled              # Counters are only kept while this is True
+        self.profiled = set(profiled)       # Operations that are profiled
+        self.profile_every = max(1, profile_every)  # Profile one call in this many
+        self.timers = {}                    # operation -> Timer
+        self.counters = {}                  # (counter, label) -> value
+        self.profiles = {}                  # operation -> cProfile.Profile
+        self._lock = threading.Lock()       # Held while a timer or counter changes
+        self._profiling = threading.Lock()  # Only one profiler can run at a time
+
+    def observe(self, operation: str, elapsed: int):
+        """
+        Record one call of an operation that took `elapsed` nanoseconds.
+        """
+        with self._lock:
+            timer = self.timers.get(operation)
+            if timer is None:
+                timer = self.timers[operation] = Timer()
+            timer.add(elapsed)
+
+    def add(self, counter: str, label: str, amount: int = 1):
+        """
+        Add to a counter, e.g. add('bytes_written', 'items.csv', 512).
+        """
+        with self._lock:
+            key = (counter, label)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def wrap(self, operation: str, function):
+        """
+        Return `function` wrapped so every call is timed as `operation`, and
+        every profile_every-th call is profiled if the operation is profiled.
+        """
+        profiled = operation in self.profiled
+        calls = [0]
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if profiled:
+                calls[0] += 1
+                if calls[0] % self.profile_every == 0:
+                    return self._profile(operation, function, args, kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(operation, time.perf_counter_ns() - start)
+        return timed
+
+    def _profile(self, operation, function, args, kwargs):
+        # Run one call under the operation's profiler. If another call is being
+        # profiled (in this thread or another) this one is only timed.
+        start = time.perf_counter_ns()
+        try:
+            if not self._profiling.acquire(blocking=False):
+                return function(*args, **kwargs)
+            try:
+                with self._lock:
+                    profile = self.profiles.get(operation)
+                    if profile is None:
+                        profile = self.profiles[operation] = cProfile.Profile()
+                return profile.runcall(function, *args, **kwargs)
+            finally:
+                self._profiling.release()
+        finally:
+            self.observe(operation, time.perf_counter_ns() - start)
+
+    def reset(self):
+        """
+        Forget every timer, counter and profile.
+        """
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.profiles.clear()
+
+    def hit_rates(self) -> dict:
+        """
+        Return, per table, the share of reads served by the in-memory index
+        without reloading it from disk.
+        """
+        rates = {}
+        for (counter, table), hits in self.counters.items():
+            if counter == 'index_hits':
+                total = hits + self.counters.get(('index_reloads', table), 0)
+                rates[table] = round(hits / total, 4)
+        return rates
+
+    def to_dict(self):
+        # Every timer and counter, e.g. for the JSON dump or the HTTP server
+        with self._lock:
+            counters = {}
+            for (counter, label), value in sorted(self.counters.items()):
+                counters.setdefault(counter, {})[label] = value
+            return {
+                'operations': {name: timer.to_dict() for name, timer in sorted(self.timers.items())},
+                'counters': counters,
+                'index_hit_rate': self.hit_rates()
+            }
+
+    def to_json(self) -> str:
+        """
+        Return the metrics as a JSON document.
+        """
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            if self.timers:
+                lines.append('# HELP library_operation_seconds Time spent in each repository and service operation.')
+                lines.append('# TYPE library_operation_seconds histogram')
+            for name, timer in sorted(self.timers.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, timer.buckets):
+                    cumulative += count
+                    lines.append(f'library_operation_seconds_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'library_operation_seconds_bucket{{operation="{name}",le="+Inf"}} {timer.count}')
+                lines.append(f'library_operation_seconds_sum{{operation="{name}"}} {timer.total / 1e9}')
+                lines.append(f'library_operation_seconds_count{{operation="{name}"}} {timer.count}')
+            written = set()
+            for (counter, label), value in sorted(self.counters.items()):
+                if counter not in written:
+                    lines.append(f'# TYPE library_{counter}_total counter')
+                    written.add(counter)
+                lines.append(f'library_{counter}_total{{source="{label}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def profile_report(self, operation: str, limit: int = 20) -> str:
+        """
+        Return the `limit` functions with the most time of their own in the
+        sampled calls of an operation, as pstats text ('' if none were sampled).
+        """
+        profile = self.profiles.get(operation)
+        if profile is None:
+            return ''
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('tottime').print_stats(limit)
+        return out.getvalue()
+
+    def write_profiles(self, directory: str):
+        """
+        Save each operation's profile as <directory>/<operation>.prof, for
+        pstats or a profile viewer.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for operation, profile in list(self.profiles.items()):
+            profile.dump_stats(os.path.join(directory, f'{operation}.prof'))
+
+
+# The metrics of this process
+REGISTRY = Metrics(ENABLED, PROFILED, PROFILE_EVERY)
+
+
+def timed(operation: str):
+    """
+    Decorator that times every call of a method as `operation` when metrics
+    or profiling of that operation are switched on, and otherwise returns the
+    method unchanged.
+    """
+    def decorate(function):
+        if not (ENABLED or operation in PROFILED):
+            return function
+        return REGISTRY.wrap(operation, function)
+    return decorate
+
+
+def count(counter: str, label: str, amount: int = 1):
+    """
+    Add to a counter if metrics are switched on.
+    """
+    if REGISTRY.enabled:
+        REGISTRY.add(counter, label, amount)
@@ -0,0 +1,48 @@
+import argparse  # Module for reading command-line options
+from storage import CsvStorage, ShardedStorage, SqliteStorage  # The storage backends
+from library import LibraryService  # Opens the members, items, loans and holds tables together
+
+
+def migrate(csv_dir: str = None, db_path: str = None, shards: int = 0):
+    """
+    Copy every member, item, loan, borrow count and hold from the CSV files
+    into an SQLite database, or into `shards` CSV shards (see ShardedStorage)
+    if given.
+    Rows whose key already exists in the target are left unchanged, so
+    running the migration twice does not create duplicates.
+    """
+    # Opening a service on each backend opens all its tables on it
+    source = LibraryService(CsvStorage(csv_dir))
+    target = ShardedStorage(shards) if shards else SqliteStorage(db_path)
+    destination = LibraryService(target)
+    where = target.directory if shards else target.path
+    tables = [
+        ('members', source.members_repo.table, destination.members_repo.table),
+        ('items', source.items_repo.table, destination.items_repo.table),
+        ('loans', source.ledger.table, destination.ledger.table),
+        ('borrow counts', source.ledger.borrows, destination.ledger.borrows),
+        ('holds', source.holds.table, destination.holds.table),
+    ]
+    for name, src, dst in tables:
+        # The CSV table already merges any journaled changes into its rows
+        rows = src.rows()
+        # Leave out rows already copied by an earlier run; looked up a shard at a time
+        existing = dst.get_many(map(dst.key_of, rows))
+        rows = [row for row in rows if dst.key_of(row) not in existing]
+        dst.append_many(rows)  # One transaction per table
+        print(f"Imported {len(rows)} {name} into {where} ({len(existing)} already there).")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the csv/*.csv files into an SQLite database '
+                                                 'or into CSV shards.')
+    parser.add_argument('--csv-dir', default=CsvStorage.DIRECTORY, help='directory holding the CSV files')
+    parser.add_argument('--db', default=SqliteStorage.DB_PATH, help='SQLite database file to create or fill')
+    parser.add_argument('--shards', type=int, default=0,
+                        help=f'split the tables into this many shards under {ShardedStorage.DIRECTORY} instead')
+    args = parser.parse_args()
+    migrate(args.csv_dir, args.db, args.shards)
+    if args.shards:
+        print(f"Set LIBRARY_STORAGE=sharded and LIBRARY_SHARDS={args.shards} to use the shards.")
+    else:
+        print("Set LIBRARY_STORAGE=sqlite to use the database.")
@@ -0,0 +1,151 @@
+import argparse  # Module for reading command-line options
+import os  # Position file and replica directory
+import threading  # Follows the feed on a background timer
+import time  # Pause between polls when following from the command line
+from feed import ChangeFeed  # Sequenced changes made on the primary
+from library import LibraryService  # Opens the members, items, loans and holds tables together
+from metrics import timed  # Opt-in timing of catch-ups
+from storage import CsvStorage  # The replica keeps its own CSV files
+
+
+class Replica:
+    """
+    A read-only copy of the library in its own directory (replica/ by
+    default), kept current by applying the change feed of the primary. The
+    sequence number of the last change applied is kept in <directory>/position,
+    so a replica that was stopped catches up from where it left off.
+
+    Readers use the copy like the primary, either in this process through
+    `service` or in any number of other processes with
+    LibraryService(CsvStorage('replica')), and never touch the primary files.
+    Nothing but the replica may write to the copy.
+    """
+    DIRECTORY = 'replica'
+    # Changes read from the feed and applied per batch
+    BATCH_SIZE = 10000
+
+    def __init__(self, feed: ChangeFeed, directory: str = None):
+        self.feed = feed
+        self.directory = directory or self.DIRECTORY
+        self.service = LibraryService(CsvStorage(self.directory))  # The copy, opened like the primary
+        self.tables = {table.name: table for table in (
+            self.service.members_repo.table, self.service.items_repo.table,
+            self.service.ledger.table, self.service.ledger.borrows, self.service.holds.table)}
+        self.position_path = os.path.join(self.directory, 'position')
+        self.position = self._read_position()  # Sequence number of the last change applied
+        self._follower = None                  # Background catch-up timer, if started
+
+    def _read_position(self) -> int:
+        # Sequence number saved by the last catch-up, or 0 for a new replica
+        try:
+            with open(self.position_path, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _save_position(self):
+        # Write to a temporary file first and rename it over the old one
+        tmp_path = self.position_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(self.position))
+        os.replace(tmp_path, self.position_path)
+
+    def bootstrap(self, storage):
+        """
+        Copy every row from the primary (e.g. CsvStorage()) into a new replica,
+        for a library that already had data when the feed was switched on.
+        The feed position is taken first, so changes made during the copy are
+        applied again by the next catch-up, which leaves them unchanged.
+        """
+        position = self.feed.last_seq()
+        source = LibraryService(storage)
+        for table in (source.members_repo.table, source.items_repo.table, source.ledger.table,
+                      source.ledger.borrows, source.holds.table):
+            self._apply_rows(self.tables[table.name], {table.key_of(row): row for row in table.rows()}, [])
+        self.position = position
+        self._save_position()
+
+    @timed('replica.catch_up')
+    def catch_up(self) -> int:
+        """
+        Apply every change made after our position, a batch at a time, and
+        return how many changes were applied.
+        """
+        applied = 0
+        while True:
+            changes = self.feed.read(self.position, self.BATCH_SIZE)
+            if not changes:
+                return applied
+            self._apply(changes)
+            # Saved after the batch: if we stop in between, re-applying it changes nothing
+            self.position = changes[-1].seq
+            self._save_position()
+            applied += len(changes)
+
+    def _apply(self, changes):
+        # Only the last change to each row matters, so a batch becomes at most
+        # one delete, one update and one append per table
+        latest = {}
+        for change in changes:
+            latest.setdefault(change.table, {})[change.key] = change
+        for name, rows in latest.items():
+            table = self.tables.get(name)
+            if table is None:
+                continue  # A table this replica does not keep
+            self._apply_rows(table, {key: change.row for key, change in rows.items() if change.op == 'put'},
+                             [key for key, change in rows.items() if change.op == 'del'])
+
+    @staticmethod
+    def _apply_rows(table, puts: dict, removed: list):
+        # Remove rows, then replace the rows we have and add the ones we do not
+        if removed:
+            table.delete_many(removed)
+        existing = table.get_many(puts)
+        if existing:
+            table.update_many((key, row) for key, row in puts.items() if key in existing)
+        table.append_many(row for key, row in puts.items() if key not in existing)
+
+    def start(self, interval: float = 1.0):
+        """
+        Catch up every `interval` seconds on a background thread, until
+        stop() is called.
+        """
+        def run():
+            self.catch_up()
+            if self._follower is not None:  # Not stopped while we were running
+                self.start(interval)
+        self._follower = threading.Timer(interval, run)
+        self._follower.daemon = True  # Don't keep the program alive just for this
+        self._follower.start()
+
+    def stop(self):
+        """
+        Stop following the feed and fold the replica's journals into its files.
+        """
+        if self._follower is not None:
+            self._follower.cancel()
+            self._follower = None
+        for table in self.tables.values():
+            table.checkpoint()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep a read-only copy of the library current from its change feed.')
+    parser.add_argument('--feed', default=ChangeFeed.PATH, help='change feed of the primary')
+    parser.add_argument('--directory', default=Replica.DIRECTORY, help='directory for the copy')
+    parser.add_argument('--bootstrap', action='store_true',
+                        help=f'first copy every row from {CsvStorage.DIRECTORY}/ (for a new replica)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between catch-ups')
+    args = parser.parse_args()
+    replica = Replica(ChangeFeed(args.feed), args.directory)
+    if args.bootstrap:
+        replica.bootstrap(CsvStorage())
+    print(f"Following {args.feed} from change {replica.position} into {replica.directory}/")
+    try:
+        while True:
+            applied = replica.catch_up()
+            if applied:
+                print(f"Applied {applied} changes, now at {replica.position}.")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        replica.stop()
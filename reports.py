@@ -0,0 +1,323 @@
+import threading  # Keeps report reads and table change hooks from different threads apart
+from collections import Counter  # Counts per status, title, member and day
+from datetime import date  # Due dates are kept as day numbers
+from columns import ItemColumns, LoanColumns, Status  # Array-backed copies for the batch recompute
+from library import day_number  # Due dates are counted by day number
+from typing import Optional  # For type hints indicating a function might return None
+
+
+def _decrement(counter: Counter, key):
+    # Take one off a count, dropping the key when it reaches zero
+    left = counter[key] - 1
+    if left > 0:
+        counter[key] = left
+    else:
+        counter.pop(key, None)
+
+
+class RankedCounter:
+    """
+    Counts per key that also keeps the keys grouped by count, so the keys
+    with the highest counts can be listed without looking at every key.
+    A change of count just moves the key to another group.
+    """
+    def __init__(self, counts=None):
+        self.counts = {}  # key -> count (never zero)
+        self.groups = {}  # count -> {key: None}, in the order keys reached that count
+        self.highest = 0  # Highest count of any key
+        for key, n in (counts or {}).items():
+            self.counts[key] = n
+            self.groups.setdefault(n, {})[key] = None
+            self.highest = max(self.highest, n)
+
+    def __getitem__(self, key) -> int:
+        return self.counts.get(key, 0)
+
+    def _move(self, key, old: int, new: int):
+        # Move a key from the group for one count to the group for another
+        if old:
+            group = self.groups[old]
+            del group[key]
+            if not group:
+                del self.groups[old]
+        if new:
+            self.groups.setdefault(new, {})[key] = None
+            self.counts[key] = new
+            self.highest = max(self.highest, new)
+        else:
+            del self.counts[key]
+        while self.highest and self.highest not in self.groups:
+            self.highest -= 1
+
+    def add(self, key, n: int = 1):
+        """
+        Change a key's count by n (usually 1 or -1).
+        """
+        old = self.counts.get(key, 0)
+        self._move(key, old, max(0, old + n))
+
+    def most_common(self, n: int):
+        """
+        Return the n keys with the highest counts, as (key, count) pairs.
+        """
+        top = []
+        count = self.highest
+        while count and len(top) < n:
+            for key in self.groups.get(count, ()):
+                top.append((key, count))
+                if len(top) == n:
+                    break
+            count -= 1
+        return top
+
+
+class LibraryReports:
+    """
+    Live statistics for dashboards: items by status, titles with the most
+    copies on loan, titles borrowed most often, overdue loans and loans per
+    member.
+
+    The numbers are kept up to date as items and loans change (through the
+    tables' change hooks, so borrow_book, return_book, the batch methods and
+    ItemsRepository.update are all covered), so reading them costs nothing
+    like a scan of the CSV files. When a table is reloaded from disk the
+    numbers are rebuilt in one batch pass over array-backed columns.
+
+    Past loans are counted from the borrow_counts table kept by the
+    LoanLedger, so they survive both returns and restarts.
+    """
+    # Times a rebuild is retried when the tables change while it reads them
+    REBUILD_ATTEMPTS = 5
+
+    def __init__(self, service):
+        self.items = service.items_repo.table  # Items table (title and status of each item)
+        self.loans = service.ledger.table      # Active loans table
+        self.borrows = service.ledger.borrows  # Loans ever made of each item
+        # Held while the counts are read or changed. Never held while reading
+        # a table, as the tables hold their own locks while calling us.
+        self._lock = threading.RLock()
+        self._stale = True                     # Rebuild before the next read
+        self._version = 0                      # Bumped by every change we are told about
+        self._install(Counter(), Counter(), RankedCounter(), Counter(), RankedCounter(), RankedCounter(),
+                      Counter(), 0)
+        self.items.watch(self._on_item_change)
+        self.loans.watch(self._on_loan_change)
+        self.borrows.watch(self._on_borrow_change)
+
+    def _install(self, status_counts, item_loans, title_loans, item_borrows, title_borrows, member_loans,
+                 day_loans, active_loans):
+        self.status_counts = status_counts  # status -> number of items
+        self.item_loans = item_loans        # item ID -> active loans of it
+        self.title_loans = title_loans      # title -> active loans of items with that title
+        self.item_borrows = item_borrows    # item ID -> loans ever made of it
+        self.title_borrows = title_borrows  # title -> loans ever made of items with that title
+        self.member_loans = member_loans    # member ID -> active loans
+        self.day_loans = day_loans          # due day number -> active loans due that day
+        self.active_loans = active_loans    # Number of active loans
+
+    def recompute(self):
+        """
+        Rebuild every count from scratch in one pass over each table. The
+        rows are first copied into flat arrays, so the counting runs in C
+        rather than row by row in Python.
+        """
+        for attempt in range(self.REBUILD_ATTEMPTS):
+            with self._lock:
+                version = self._version
+            items = ItemColumns.from_rows(self.items.iter_rows())
+            loans = LoanColumns.from_rows(self.loans.iter_rows())
+            item_borrows = Counter({row['item_id']: int(row['borrows']) for row in self.borrows.iter_rows()})
+            item_loans = Counter(loans.item_ids)
+            titles = dict(zip(items.ids, items.titles))
+            title_borrows = Counter()
+            for item_id, n in item_borrows.items():
+                if item_id in titles:
+                    title_borrows[titles[item_id]] += n
+            counts = (
+                Counter({str(status): n for status, n in items.status_counts().items() if n}),
+                item_loans,
+                RankedCounter(Counter(titles[item_id] for item_id in loans.item_ids if item_id in titles)),
+                item_borrows,
+                RankedCounter(title_borrows),
+                RankedCounter(loans.loans_per_member()),
+                Counter(loans.due_days),
+                len(loans)
+            )
+            with self._lock:
+                # Only use the counts if nothing changed while we were reading
+                # (a change might be counted twice or not at all), unless the
+                # tables are too busy for that ever to happen
+                if self._version == version or attempt == self.REBUILD_ATTEMPTS - 1:
+                    self._install(*counts)
+                    self._stale = False
+                    return
+
+    def _sync(self):
+        # Pick up changes made by other processes, then rebuild if a table was
+        # reloaded. Called without holding our lock (see __init__).
+        self.items.refresh()
+        self.loans.refresh()
+        self.borrows.refresh()
+        if self._stale:
+            self.recompute()
+
+    def _on_item_change(self, item_id, old, new):
+        # Keep the counts in step with one change to the items table
+        with self._lock:
+            self._version += 1
+            if item_id is None:
+                self._stale = True  # Table reloaded: rebuild before the next read
+                return
+            if old is not None:
+                _decrement(self.status_counts, old['status'])
+            if new is not None:
+                self.status_counts[new['status']] += 1
+            # A renamed item takes its loans, and past loans, to the new title
+            # (an item added or deleted to or from no title, as in recompute)
+            old_title = old['title'] if old is not None else None
+            new_title = new['title'] if new is not None else None
+            if old_title != new_title:
+                for counter, per_item in ((self.title_loans, self.item_loans),
+                                          (self.title_borrows, self.item_borrows)):
+                    n = per_item.get(item_id, 0)
+                    if n and old_title is not None:
+                        counter.add(old_title, -n)
+                    if n and new_title is not None:
+                        counter.add(new_title, n)
+
+    def _on_loan_change(self, key, old, new):
+        # Keep the counts in step with one loan being made, changed or closed.
+        # The titles are looked up first: our lock is never held while reading
+        # a table (see __init__).
+        titles = [self._title_of(row) for row in (old, new)] if key is not None else [None, None]
+        with self._lock:
+            self._version += 1
+            if key is None:
+                self._stale = True  # Table reloaded: rebuild before the next read
+                return
+            if old is not None:
+                self._count_loan(old, titles[0], -1)
+            if new is not None:
+                self._count_loan(new, titles[1], 1)
+
+    def _on_borrow_change(self, item_id, old, new):
+        # Keep the past loan counts in step with an item's borrow count
+        title = self._title_of({'item_id': item_id}) if item_id is not None else None
+        with self._lock:
+            self._version += 1
+            if item_id is None:
+                self._stale = True  # Table reloaded: rebuild before the next read
+                return
+            n = (int(new['borrows']) if new is not None else 0) - (int(old['borrows']) if old is not None else 0)
+            self.item_borrows[item_id] += n
+            if self.item_borrows[item_id] <= 0:
+                del self.item_borrows[item_id]
+            if title is not None:
+                self.title_borrows.add(title, n)
+
+    def _title_of(self, row: Optional[dict]) -> Optional[str]:
+        # Title of the item a loan is for, or None
+        item = self.items.get(row['item_id']) if row is not None else None
+        return item['title'] if item is not None else None
+
+    def _count_loan(self, row: dict, title: Optional[str], n: int):
+        # Add (n=1) or remove (n=-1) one loan from every count it is part of
+        for counter, key in ((self.item_loans, row['item_id']), (self.day_loans, day_number(row['due_date']))):
+            if n > 0:
+                counter[key] += 1
+            else:
+                _decrement(counter, key)
+        if title is not None:
+            self.title_loans.add(title, n)
+        self.member_loans.add(row['borrowed_by'], n)
+        self.active_loans += n
+
+    def items_on_loan(self) -> int:
+        """
+        Return how many items are on loan.
+        """
+        self._sync()
+        with self._lock:
+            return self.status_counts[str(Status.ON_LOAN)]
+
+    def items_by_status(self) -> dict:
+        """
+        Return how many items have each status.
+        """
+        self._sync()
+        with self._lock:
+            return dict(self.status_counts)
+
+    def most_on_loan(self, n: int = 10):
+        """
+        Return the n titles with the most copies on loan right now, as
+        (title, loans) pairs. Returned loans are not counted (see
+        most_borrowed).
+        """
+        self._sync()
+        with self._lock:
+            return self.title_loans.most_common(n)
+
+    def most_borrowed(self, n: int = 10):
+        """
+        Return the n titles borrowed most often, counting every loan ever
+        made (returned or not), as (title, loans) pairs.
+        """
+        self._sync()
+        with self._lock:
+            return self.title_borrows.most_common(n)
+
+    def overdue(self, today: date = None) -> int:
+        """
+        Return how many loans were due back before today.
+        """
+        cutoff = (today or date.today()).toordinal()
+        self._sync()
+        with self._lock:
+            # One entry per distinct due date, not per loan
+            return sum(n for day, n in self.day_loans.items() if day < cutoff)
+
+    def member_activity(self, member_id: str) -> int:
+        """
+        Return how many items the member has on loan.
+        """
+        self._sync()
+        with self._lock:
+            return self.member_loans[member_id]
+
+    def busiest_members(self, n: int = 10):
+        """
+        Return the n members with the most active loans, as (member ID, loans) pairs.
+        """
+        self._sync()
+        with self._lock:
+            return self.member_loans.most_common(n)
+
+    def to_dict(self, today: date = None):
+        # Every headline number at once, e.g. for a dashboard or JSON output
+        return {
+            'items_by_status': self.items_by_status(),
+            'items_on_loan': self.items_on_loan(),
+            'active_loans': self.active_loans,
+            'overdue_loans': self.overdue(today),
+            'most_on_loan': self.most_on_loan(),
+            'most_borrowed': self.most_borrowed(),
+            'busiest_members': self.busiest_members()
+        }
+
+    def print_summary(self):
+        """
+        Print the headline numbers to the console.
+        """
+        stats = self.to_dict()
+        print(f"Items on loan: {stats['items_on_loan']} of {sum(stats['items_by_status'].values())}")
+        print(f"Overdue loans: {stats['overdue_loans']}")
+        print("Titles with the most copies on loan:")
+        for title, loans in stats['most_on_loan']:
+            print(f"  {title}: {loans}")
+        print("Most borrowed titles:")
+        for title, loans in stats['most_borrowed']:
+            print(f"  {title}: {loans}")
+        print("Members with most loans:")
+        for member_id, loans in stats['busiest_members']:
+            print(f"  {member_id}: {loans}")
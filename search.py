@@ -0,0 +1,148 @@
+import bisect  # Binary search in the sorted list of words
+import heapq  # Picks the best few results without sorting every match
+import re  # Regular expressions, used to split text into words
+import threading  # Keeps searches and index updates from different threads apart
+import unicodedata  # Splits accented letters into letter + accent
+
+
+def normalise(text: str) -> str:
+    """
+    Lower-case text and strip accents, so 'Émile' and 'emile' match.
+    """
+    if text.isascii():
+        return text.lower()  # Nothing to strip: skip the slower Unicode path
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text: str):
+    """
+    Split text into normalised words.
+    """
+    return re.findall(r'\w+', normalise(text))
+
+
+class SearchIndex:
+    """
+    An inverted index from words to the items whose title or author contains
+    them. Query words match whole words or the start of words (prefixes), and
+    an item must match every query word. Results are ranked by where the
+    words were found (title counts more than author) and whether they matched
+    whole words.
+    """
+    TITLE_WEIGHT = 2      # Score for a word found in the title
+    AUTHOR_WEIGHT = 1     # Score for a word found in the author
+    PREFIX_FACTOR = 0.5   # Multiplier when a query word only matches the start of a word
+
+    def __init__(self):
+        self._postings = {}   # word -> {item ID: weight}
+        self._words = []      # Every distinct word, sorted, for prefix lookups
+        self._docs = {}       # item ID -> words indexed for it (needed to remove it)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _weights(self, title: str, author: str) -> dict:
+        # Score of each word of an item: title words count more than author words
+        weights = {}
+        for word in tokenize(title):
+            weights[word] = self.TITLE_WEIGHT
+        for word in tokenize(author):
+            weights[word] = weights.get(word, 0) + self.AUTHOR_WEIGHT
+        return weights
+
+    def rebuild(self, items):
+        """
+        Replace the whole index with (item ID, title, author) triples.
+        Faster than add() for many items, as the word list is sorted once.
+        """
+        postings, docs = {}, {}
+        for item_id, title, author in items:
+            weights = self._weights(title, author)
+            for word, weight in weights.items():
+                postings.setdefault(word, {})[item_id] = weight
+            docs[item_id] = tuple(weights)
+        with self._lock:
+            self._postings, self._words, self._docs = postings, sorted(postings), docs
+
+    def add(self, item_id: str, title: str, author: str):
+        """
+        Index an item, replacing whatever was indexed for it before.
+        """
+        weights = self._weights(title, author)
+        with self._lock:
+            self._remove(item_id)
+            for word, weight in weights.items():
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = {}
+                    bisect.insort(self._words, word)
+                postings[item_id] = weight
+            self._docs[item_id] = tuple(weights)
+
+    def remove(self, item_id: str):
+        """
+        Drop an item from the index.
+        """
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        # Remove the item from the postings of every word indexed for it
+        for word in self._docs.pop(item_id, ()):
+            postings = self._postings[word]
+            del postings[item_id]
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+
+    def _expand(self, term: str):
+        # Every indexed word equal to or starting with the term, with its score factor
+        start = bisect.bisect_left(self._words, term)
+        end = bisect.bisect_left(self._words, term + '\U0010ffff')
+        for word in self._words[start:end]:
+            yield self._postings[word], 1.0 if word == term else self.PREFIX_FACTOR
+
+    def search(self, query: str, limit: int = 10):
+        """
+        Return up to `limit` item IDs matching every word of the query, best first.
+        """
+        terms = set(tokenize(query))
+        if not terms or limit <= 0:
+            return []
+        with self._lock:
+            expansions = [list(self._expand(term)) for term in terms]
+            # Start with the most selective word so the candidate set stays small
+            expansions.sort(key=lambda postings: sum(len(p) for p, _ in postings))
+            scores = None
+            for postings in expansions:
+                scores = self._score(postings, scores)
+                if not scores:
+                    return []
+        # Highest score first; ties go to the lower item ID so results are stable
+        return heapq.nsmallest(limit, scores, key=lambda item_id: (-scores[item_id], item_id))
+
+    @staticmethod
+    def _score(postings, scores):
+        # Add one query word's best score to each candidate that matches it.
+        # Candidates that don't match the word are dropped.
+        matched = {}
+        if scores is None or sum(len(p) for p, _ in postings) < len(scores):
+            # Walk the postings of the matching words
+            for items, factor in postings:
+                for item_id, weight in items.items():
+                    if scores is None or item_id in scores:
+                        score = weight * factor
+                        if score > matched.get(item_id, 0):
+                            matched[item_id] = score
+        else:
+            # Fewer candidates than postings: look each candidate up instead
+            for item_id in scores:
+                best = max((items[item_id] * factor for items, factor in postings if item_id in items),
+                           default=0)
+                if best:
+                    matched[item_id] = best
+        if scores is None:
+            return matched
+        return {item_id: scores[item_id] + score for item_id, score in matched.items()}
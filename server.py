@@ -0,0 +1,357 @@
+import argparse  # Module for reading command-line options
+import asyncio  # Serves many connections from one thread
+import json  # Requests and responses are JSON
+from concurrent.futures import ThreadPoolExecutor  # Bounded pool for blocking file and database work
+from contextlib import asynccontextmanager  # Turns a generator into an `async with` block
+from datetime import date  # Cut-off day of overdue requests
+from urllib.parse import parse_qs, urlsplit  # Splits a request target into path and query
+import metrics  # Operation timers and counters for the /metrics endpoint
+from library import LibraryService  # Members, items and loans
+from reports import LibraryReports  # Live statistics for the /stats endpoint
+
+# Reasons sent with each status code we use
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HttpError(Exception):
+    """
+    Raised while handling a request to send an error response instead.
+    """
+    def __init__(self, status: int, message: str):
+        self.status = status    # HTTP status code
+        self.message = message  # Sent to the client as {"error": message}
+        super().__init__(message)
+
+
+class RecordLocks:
+    """
+    One asyncio lock per record, created when first needed and dropped when
+    nobody holds or waits for it. Changes to the same record run one at a
+    time in the order they arrived; changes to different records run at once.
+    """
+    def __init__(self):
+        self._locks = {}  # key -> [lock, number of requests holding or waiting for it]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+class LibraryServer:
+    """
+    Serves the library as JSON over HTTP/1.1, for kiosks and the web catalogue.
+
+        GET  /items/<id>              one item
+        GET  /items?q=<words>&limit=  search titles and authors
+        GET  /items?status=&author=&after=&limit=
+                                      list items, a page at a time
+        GET  /members/<id>            one member
+        GET  /members?joined_from=&joined_to=&after=&limit=
+                                      list members, a page at a time
+        POST /borrow  {"item_id": ..., "member_id": ...}
+        POST /return  {"item_id": ..., "member_id": ...}
+        POST /renew   {"item_id": ..., "member_id": ...}
+        GET  /overdue?as_of=YYYY-MM-DD&offset=&limit=
+                                      loans past their due date, earliest due first
+        POST /holds   {"item_id": ..., "member_id": ...}
+                                      join the waitlist for an item that is out
+        GET  /holds/<item id>         the member it is set aside for, and the waitlist
+        GET  /stats                   dashboard numbers (see reports.py)
+        GET  /metrics?format=prometheus|json
+                                      operation timers and counters (see metrics.py)
+
+    Connections are handled by asyncio on one thread. Lookups by ID are
+    answered straight from the in-memory index when the storage keeps one
+    (CSV storage), while the check for changes made by other processes runs
+    on a bounded thread pool, so such a change shows up a lookup later.
+    Everything else that may block on files or the database runs on that
+    pool. Borrows and returns of the same item are applied one at a time, in
+    the order they arrived.
+    """
+    WORKERS = 8              # Threads for blocking work
+    PAGE_SIZE = 100          # Default (and largest) page for list requests
+    MAX_BODY = 64 * 1024     # Largest request body accepted, in bytes
+    BACKLOG = 4096           # Connections the OS may queue before we accept them
+
+    def __init__(self, service: LibraryService = None, workers: int = None):
+        self.service = service or LibraryService()
+        self.pool = ThreadPoolExecutor(max_workers=workers or self.WORKERS)
+        self.locks = RecordLocks()
+        self._refreshing = set()  # Tables with a refresh on the thread pool
+        self.reports = LibraryReports(self.service)
+        self.routes = {
+            ('GET', 'items'): self.get_items,
+            ('GET', 'members'): self.get_members,
+            ('POST', 'borrow'): self.borrow,
+            ('POST', 'return'): self.return_item,
+            ('POST', 'renew'): self.renew,
+            ('GET', 'overdue'): self.get_overdue,
+            ('POST', 'holds'): self.place_hold,
+            ('GET', 'holds'): self.get_holds,
+            ('GET', 'stats'): self.get_stats,
+            ('GET', 'metrics'): self.get_metrics,
+        }
+
+    async def run_blocking(self, function, *args):
+        # Run blocking work on the thread pool and wait for it without blocking the loop
+        return await asyncio.get_running_loop().run_in_executor(self.pool, function, *args)
+
+    async def read(self, table, key):
+        # Look up one row. A table that keeps its rows in memory answers
+        # straight away from what it has, without touching the files on the
+        # loop; the check for other processes' writes (an os.stat, and a reload
+        # if they wrote) runs on the thread pool for the next lookup.
+        if table.IN_MEMORY and table.loaded:
+            self._refresh_soon(table)
+            return table.peek(key)
+        return await self.run_blocking(table.get, key)
+
+    def _refresh_soon(self, table):
+        # Refresh the table on the thread pool, unless a refresh is already under way
+        if table in self._refreshing:
+            return
+        self._refreshing.add(table)
+        future = asyncio.get_running_loop().run_in_executor(self.pool, table.refresh)
+        future.add_done_callback(lambda done: (self._refreshing.discard(table), done.exception()))
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080):
+        """
+        Build the search index and start listening. Returns the asyncio server.
+        """
+        # An empty search builds the index, so the first real search is fast;
+        # the same goes for the statistics
+        await self.run_blocking(self.service.items_repo.search, '')
+        await self.run_blocking(self.reports.recompute)
+        return await asyncio.start_server(self.handle, host, port, backlog=self.BACKLOG)
+
+    def close(self):
+        """
+        Stop the worker threads, fold journaled changes into the CSV files
+        and save the snapshots.
+        """
+        self.pool.shutdown(wait=True)
+        self.service.members_repo.checkpoint()
+        self.service.items_repo.checkpoint()
+        self.service.ledger.compact()
+        self.service.holds.checkpoint()
+        if metrics.PROFILED:
+            metrics.REGISTRY.write_profiles(metrics.PROFILE_DIR)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve the requests of one connection until the client closes it.
+        """
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break  # Client closed the connection
+                method, target, headers, body = request
+                status, payload = await self.dispatch(method, target, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self.write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HttpError as e:
+            # The request could not be read, so the connection can't be reused
+            self.write_response(writer, e.status, {'error': e.message}, keep_alive=False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # Client went away mid-request
+        finally:
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader):
+        # Read one request: (method, target, headers, body), or None at end of stream
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, 'malformed request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400, 'bad Content-Length')
+        if length > self.MAX_BODY:
+            raise HttpError(413, 'request body too large')
+        body = await reader.readexactly(length) if length > 0 else b''
+        return method.upper(), target, headers, body
+
+    @staticmethod
+    def write_response(writer, status: int, payload, keep_alive: bool = True):
+        # Send one response: JSON, or plain text if the payload is a string
+        if isinstance(payload, str):
+            body, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            body, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+        head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+    async def dispatch(self, method: str, target: str, body: bytes):
+        """
+        Route one request to its handler. Returns (status, JSON payload).
+        """
+        url = urlsplit(target)
+        parts = [part for part in url.path.split('/') if part]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if not parts or parts[0] not in {name for _, name in self.routes}:
+                raise HttpError(404, f"no such resource '{url.path}'")
+            handler = self.routes.get((method, parts[0]))
+            if handler is None:
+                raise HttpError(405, f"{method} not allowed on '{url.path}'")
+            return 200, await handler(parts[1:], query, body)
+        except HttpError as e:
+            return e.status, {'error': e.message}
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+
+    def _page(self, query):
+        # Offset and size of the page a list request asks for
+        try:
+            offset = max(0, int(query.get('offset', 0)))
+            limit = min(self.PAGE_SIZE, max(1, int(query.get('limit', self.PAGE_SIZE))))
+        except ValueError:
+            raise HttpError(400, 'offset and limit must be numbers')
+        return offset, limit
+
+    async def get_items(self, parts, query, body):
+        repo = self.service.items_repo
+        if parts:
+            row = await self.read(repo.table, parts[0])
+            if row is None:
+                raise HttpError(404, f"no item '{parts[0]}'")
+            return row
+        if 'q' in query:
+            _, limit = self._page(query)
+            items = await self.run_blocking(repo.search, query['q'], limit)
+            return [item.to_dict() for item in items]
+        offset, limit = self._page(query)
+        return await self.run_blocking(self._list, repo.iter_items, query.get('after'), {
+            'status': query.get('status'), 'author': query.get('author'), 'offset': offset, 'limit': limit})
+
+    async def get_members(self, parts, query, body):
+        repo = self.service.members_repo
+        if parts:
+            row = await self.read(repo.table, parts[0])
+            if row is None:
+                raise HttpError(404, f"no member '{parts[0]}'")
+            return row
+        offset, limit = self._page(query)
+        return await self.run_blocking(self._list, repo.iter_members, query.get('after'), {
+            'joined_from': query.get('joined_from'), 'joined_to': query.get('joined_to'),
+            'offset': offset, 'limit': limit})
+
+    @staticmethod
+    def _list(iterate, after, filters):
+        # One page of records, and the cursor to pass as `after` for the next page
+        try:
+            records = [record.to_dict() for record in iterate(after=after, **filters)]
+        except KeyError:
+            raise HttpError(400, f"unknown cursor '{after}'")
+        last = records[-1]['id'] if len(records) == filters['limit'] else None
+        return {'records': records, 'next': last}
+
+    async def get_stats(self, parts, query, body):
+        # May refresh the tables from disk first, so not run on the event loop
+        return await self.run_blocking(self.reports.to_dict)
+
+    async def get_metrics(self, parts, query, body):
+        # Prometheus scrapes the text format; the JSON is for people and scripts
+        if query.get('format', 'prometheus') == 'json':
+            return metrics.REGISTRY.to_dict()
+        return metrics.REGISTRY.to_prometheus()
+
+    async def borrow(self, parts, query, body):
+        return await self._transaction(self.service.borrow_many, body)
+
+    async def return_item(self, parts, query, body):
+        return await self._transaction(self.service.return_many, body)
+
+    async def renew(self, parts, query, body):
+        return await self._transaction(lambda pairs: [self.service.renew_loan(*pair) for pair in pairs], body)
+
+    async def get_overdue(self, parts, query, body):
+        try:
+            as_of = date.fromisoformat(query['as_of']) if 'as_of' in query else None
+        except ValueError:
+            raise HttpError(400, 'as_of must be a date (YYYY-MM-DD)')
+        offset, limit = self._page(query)
+        records = await self.run_blocking(self.service.find_overdue, as_of)
+        return {'records': [record.to_dict() for record in records[offset:offset + limit]],
+                'total': len(records)}
+
+    async def place_hold(self, parts, query, body):
+        return await self._transaction(lambda pairs: [self.service.request_hold(*pair) for pair in pairs], body)
+
+    async def get_holds(self, parts, query, body):
+        if not parts:
+            raise HttpError(404, 'expected /holds/<item id>')
+        holds = self.service.holds
+        return await self.run_blocking(lambda: {
+            'ready_for': holds.ready_for(parts[0]), 'waiting': holds.waitlist(parts[0])})
+
+    async def _transaction(self, apply, body: bytes):
+        # Run one borrow or return while holding the item's lock
+        try:
+            request = json.loads(body or b'{}')
+            pair = (str(request['item_id']), str(request['member_id']))
+        except (ValueError, TypeError, KeyError):
+            raise HttpError(400, 'expected a JSON object with item_id and member_id')
+        async with self.locks.hold(pair[0]):
+            result, = await self.run_blocking(apply, [pair])
+        if not result.ok:
+            status = 404 if 'not found' in result.message else 409
+            raise HttpError(status, result.message)
+        return result.to_dict()
+
+
+async def serve(host: str, port: int, workers: int = None):
+    """
+    Run the server until interrupted.
+    """
+    server = LibraryServer(workers=workers)
+    server.service.start_housekeeping()
+    listener = await server.start(host, port)
+    print(f"Serving the library on http://{host}:{port}/")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.service.stop_housekeeping()
+        server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the library as a JSON HTTP API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None, help='threads for blocking work')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        print("Goodbye!")
@@ -0,0 +1,1647 @@
+import csv  # Module for reading and writing CSV files
+import io   # In-memory text streams, used to parse journal lines
+import itertools  # Slices a stream of rows into a page
+import json  # Changes waiting to be published to the feed
+import marshal  # Fast binary format for the index snapshots
+import mmap  # Snapshots are mapped into memory rather than read into a buffer
+import os   # Module for file and directory operations
+import sqlite3  # Built-in SQLite database engine
+import struct  # Length field in the snapshot file header
+import sys  # sys.intern shares one copy of values that repeat across rows
+import threading  # Locks and timers for background compaction
+import zlib  # crc32 spreads keys over shards the same way in every process
+from bisect import bisect_left, bisect_right  # Finds a key in a snapshot's sorted key blocks
+from abc import ABC, abstractmethod  # Backends must provide every Table operation
+from concurrent.futures import ThreadPoolExecutor  # Runs catalogue-wide reads on every shard at once
+from contextlib import ExitStack, contextmanager  # Turns a generator into a `with` block
+from feed import ChangeFeed  # Optional log of every change, for replicas
+from metrics import count  # Opt-in counters of rows and bytes read and written
+from typing import Optional  # For type hints indicating a function might return None
+
+try:
+    import fcntl  # Unix file locks, used to keep writers in different processes apart
+except ImportError:
+    fcntl = None  # Not available on Windows: writers are only kept apart within a process
+
+# First bytes of an index snapshot file; bumped if the layout changes
+SNAPSHOT_MAGIC = b'LIBSNAP2'
+
+
+class Table(ABC):
+    """
+    The operations every storage backend provides for one table of records.
+    Rows are plain dicts keyed by column name; each row is identified by the
+    value of its key column, or by a tuple of values for a composite key.
+    A backend must implement every abstract method; one that does not cannot
+    be created (TypeError).
+    """
+    # True if reads are answered from memory rather than by disk I/O, so a
+    # caller such as the HTTP server may serve them without a worker thread
+    IN_MEMORY = False
+
+    @abstractmethod
+    def get(self, key) -> Optional[dict]:
+        """
+        Return the row with the given key, or None if there is no such row.
+        """
+
+    @property
+    def loaded(self) -> bool:
+        """
+        True once peek() can answer from memory without reading any file.
+        """
+        return False
+
+    def peek(self, key) -> Optional[dict]:
+        """
+        Return the row with the given key as this table last saw it, without
+        checking for changes made elsewhere (call refresh() for those).
+        """
+        return self.get(key)
+
+    @abstractmethod
+    def find(self, column: str, value: str):
+        """
+        Return the rows whose column holds the given value.
+        """
+
+    def get_many(self, keys) -> dict:
+        """
+        Look up several keys at once. Returns a dict of key -> row for the keys that exist.
+        """
+        found = {}
+        for key in keys:
+            row = self.get(key)
+            if row is not None:
+                found[key] = row
+        return found
+
+    @abstractmethod
+    def rows(self):
+        """
+        Return all rows in the order they were added.
+        """
+
+    def iter_rows(self):
+        """
+        Yield all rows in the order they were added.
+        """
+        return iter(self.rows())
+
+    def scan(self, after=None, offset: int = 0, limit: int = None, equal: dict = None, between: dict = None):
+        """
+        Return an iterator over the rows in the order they were added, read
+        lazily and keeping only rows whose
+        columns hold the values in `equal` (column -> value) and lie within
+        the ranges in `between` (column -> (low, high), both inclusive, either
+        may be None). The first `offset` matching rows are skipped and at most
+        `limit` are yielded.
+
+        For cursor-based paging, pass the key of the last row of the previous
+        page as `after`; the scan then starts just after that row. KeyError is
+        raised if there is no row with that key (e.g. it was deleted since).
+        """
+        if after is not None and self.get(after) is None:
+            raise KeyError(after)
+        rows = self.iter_rows()
+        if after is not None:
+            # Walk up to the cursor row; the page starts with the row after it
+            rows = itertools.dropwhile(lambda row: self.key_of(row) != after, rows)
+            next(rows, None)
+        return _limit(_matching(rows, equal, between), offset, limit)
+
+    @abstractmethod
+    def __len__(self):
+        """
+        Return the number of rows.
+        """
+
+    def append(self, row: dict):
+        """
+        Add a new row.
+        """
+        self.append_many([row])
+
+    @abstractmethod
+    def append_many(self, rows):
+        """
+        Add several new rows in one write.
+        """
+
+    def update(self, key, changes: dict, expected: dict = None) -> bool:
+        """
+        Change some fields of the row with the given key.
+        If `expected` is given (column -> value), the change is only made if
+        the row still holds those values; otherwise ConflictError is raised.
+        Returns False if there is no such row.
+        """
+        return self.update_many([(key, changes)], {key: expected} if expected else None) == 1
+
+    @abstractmethod
+    def update_many(self, updates, expected: dict = None) -> int:
+        """
+        Apply several (key, changes) updates in one write. `expected`
+        optionally maps keys to the column values their rows must still hold;
+        if any row doesn't, nothing is written and ConflictError is raised.
+        Returns the number of rows that were found and changed.
+        """
+
+    def delete(self, key) -> bool:
+        """
+        Remove the row with the given key.
+        Returns False if there is no such row.
+        """
+        return self.delete_many([key]) == 1
+
+    @abstractmethod
+    def delete_many(self, keys) -> int:
+        """
+        Remove several rows in one write. Returns the number of rows removed.
+        """
+
+    @abstractmethod
+    def exclusive(self):
+        """
+        Return a context manager that holds this table's writer lock across
+        several reads and writes, keeping every other writer (thread or
+        process) out until the block ends. Writes made inside it are applied
+        as usual. Several tables are locked by nesting their blocks, always
+        in the same order.
+        """
+
+    def checkpoint(self):
+        """
+        Make sure every change is stored in its final place on disk.
+        """
+
+    def refresh(self):
+        """
+        Pick up changes made by other processes (or other connections).
+        """
+
+    def watch(self, callback):
+        """
+        Call callback(key, old_row, new_row) for every change this table sees,
+        whether it was made here or picked up from disk. old_row is None for a
+        new row and new_row is None for a deleted one. callback(None, None, None)
+        means the table was reloaded and any row may have changed.
+        """
+        self._watchers.append(callback)
+
+    def _notify(self, key, old, new):
+        # Tell every watcher about one change
+        for callback in self._watchers:
+            callback(key, old, new)
+
+
+class ConflictError(Exception):
+    """
+    Raised by a compare-and-set update when a row no longer holds the values
+    the caller expected, because someone else changed it first.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)  # Keys of the rows that had changed
+        super().__init__(f"Changed by someone else: {', '.join(map(str, self.keys))}")
+
+
+class RowIndex:
+    """
+    The rows of one table held in memory: a dict from key to row, plus
+    optional secondary indexes from a column value to the keys holding it.
+    Rows are never changed in place; an update puts a new dict in.
+
+    The order of the rows is also kept as a list with each key's position in
+    it, so a scan can start at any row (or any offset) without walking the
+    rows before it. A deleted row leaves a hole (None) in the list until
+    enough holes have built up to be worth closing.
+
+    Values of the `shared` columns (statuses, member IDs, dates, ...) repeat
+    across many rows, so each row put in holds the one interned copy of them.
+    """
+    # Holes in the row order are closed once there are this many, and they
+    # make up a quarter of the list
+    MAX_HOLES = 1024
+
+    def __init__(self, key_of, columns=(), shared=()):
+        self.key_of = key_of                            # Function giving a row's key
+        self.shared = tuple(shared)                     # Columns whose values are interned
+        self.rows = {}                                  # key -> row dict, in file order
+        self.by = {column: {} for column in columns}    # column -> value -> {key: None}
+        self.on_change = None                           # Called with (key, old, new) after a change
+        self.order = []                                 # Keys in file order (None for deleted rows)
+        self.positions = {}                             # key -> position in self.order
+        self.holes = 0                                  # Number of None entries in self.order
+
+    @classmethod
+    def restore(cls, key_of, rows: dict, by: dict, shared=()) -> 'RowIndex':
+        """
+        Rebuild an index from the rows and secondary indexes of a saved one.
+        """
+        index = cls(key_of, shared=shared)
+        index.rows = rows
+        index.by = by
+        # A saved index has no holes, so its row order is the order of the dict
+        index.order = list(rows)
+        index.positions = dict(zip(index.order, range(len(index.order))))
+        return index
+
+    def put(self, row: dict, replace: bool = True):
+        """
+        Add a row, or replace the row with the same key if `replace` is True.
+        """
+        for column in self.shared:
+            row[column] = sys.intern(row[column])
+        key = self.key_of(row)
+        old = self.rows.get(key)
+        if old is not None:
+            if not replace:
+                return
+            self._unindex(key, old)
+        else:
+            # A new row goes at the end; a replaced one keeps its place
+            self.order.append(key)
+            self.positions[key] = len(self.order) - 1
+        # Assigning over the old row means a reader never sees the key missing
+        self.rows[key] = row
+        for column, index in self.by.items():
+            index.setdefault(row[column], {})[key] = None
+        if self.on_change:
+            self.on_change(key, old, row)
+
+    def pop(self, key):
+        """
+        Remove and return the row with the given key (None if there is none).
+        """
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self._unindex(key, row)
+            self.order[self.positions.pop(key)] = None
+            self.holes += 1
+            if self.holes >= self.MAX_HOLES and self.holes * 4 >= len(self.order):
+                self._close_holes()
+            if self.on_change:
+                self.on_change(key, row, None)
+        return row
+
+    def _close_holes(self):
+        # Rebuild the row order without deleted rows. The new list is swapped
+        # in whole, so a reader still walking the old one is not disturbed.
+        order = list(self.rows)
+        self.positions = {key: position for position, key in enumerate(order)}
+        self.order = order
+        self.holes = 0
+
+    def scan(self, after=None, offset: int = 0):
+        """
+        Yield rows in file order, starting just after the row with key
+        `after` (KeyError if there is none), or at the `offset`-th row.
+        """
+        order = self.order
+        if after is not None:
+            position = self.positions[after]
+            if position >= len(order) or order[position] != after:
+                # The holes were closed between reading order and positions
+                order = self.order
+                position = order.index(after)
+            start = position + 1
+        else:
+            start = 0
+        if offset and not self.holes:
+            # No deleted rows before us: the offset is a position
+            start, offset = start + offset, 0
+        for position in range(start, len(order)):
+            key = order[position]
+            row = self.rows.get(key) if key is not None else None
+            if row is None:
+                continue  # Deleted (possibly while we were scanning)
+            if offset:
+                offset -= 1
+                continue
+            yield row
+
+    def _unindex(self, key, row):
+        # Remove a row's key from every secondary index
+        for column, index in self.by.items():
+            keys = index.get(row[column])
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    index.pop(row[column], None)
+
+    def find(self, column: str, value: str):
+        """
+        Return the rows whose column holds the given value.
+        """
+        if column in self.by:
+            # list() copies the keys in one step, so a writer can't change them mid-loop
+            return [self.rows[key] for key in list(self.by[column].get(value, ())) if key in self.rows]
+        return [row for row in list(self.rows.values()) if row[column] == value]
+
+
+class CsvTable(Table):
+    """
+    Keeps the rows of a CSV file in an in-memory index keyed by one column
+    (or a tuple of columns), so lookups by key do not have to re-read the
+    whole file. Extra columns can be given secondary indexes for find().
+
+    The index is built once and kept current by our own writes. It is only
+    rebuilt when the file's modification time, size or inode shows that another
+    process (or another repository object) has changed the file.
+
+    If a journal path is given, changes are not written into the CSV file
+    straight away. Each change is appended to the journal as one line and
+    merged into the index when it is read. A checkpoint later folds the journal
+    into the CSV file by writing a temporary file and renaming it over the old one.
+
+    Writers hold an fcntl lock on <path>.lock (on systems that have fcntl), so
+    several processes can share the files. Readers never take that lock: files
+    are only ever appended to or atomically replaced, so a reader always sees
+    a consistent version, and a new index is swapped in only once complete.
+
+    If a change feed is given, every change written here is also published
+    to it (see feed.py) before the writer lock is released. The changes are
+    first written to <path>.outbox and only cleared from it once published,
+    so a writer that crashes in between leaves them behind: the next writer
+    publishes those that reached the table and drops those that did not.
+    (A crash just after publishing can publish a change twice, which
+    leaves a replica unchanged.)
+
+    If a snapshot path is given, the index is also saved there in marshal
+    format at every checkpoint (never by a read that reloaded the file). The
+    snapshot records the CSV file's (mtime, size, inode) and how far into the
+    journal it goes; when those still match, the next start maps the snapshot into
+    memory and replays only newer journal lines instead of parsing the CSV
+    file. A snapshot that does not match is ignored (and later replaced).
+
+    The rows are saved in blocks of SNAPSHOT_BLOCK that decode on their own,
+    along with the keys in sorted order (in blocks too, with the first key
+    of each block in the header). Until the index is loaded, get() finds
+    its key by binary search and decodes just the two blocks it needs, and
+    the first such lookup starts loading the whole index in the background,
+    so a lookup right after start-up does not wait for every row.
+    """
+    IN_MEMORY = True
+    # Rows per separately decoded block of a snapshot
+    SNAPSHOT_BLOCK = 1024
+
+    def __init__(self, path: str, fieldnames: list, key='id',
+                 journal_path: str = None, checkpoint_every: int = 1000, indexes=(),
+                 snapshot_path: str = None, upgrade=None, feed: ChangeFeed = None, shared=()):
+        self.path = path                    # Location of the CSV file
+        self.name = os.path.splitext(os.path.basename(path))[0]  # Table name, for metrics
+        self.fieldnames = list(fieldnames)  # Column names, in file order
+        self.key = key                      # Column (or tuple of columns) used as the index key
+        self.journal_path = journal_path    # Append-only change log (None = rewrite the CSV)
+        self.checkpoint_every = checkpoint_every  # Journal lines allowed before a checkpoint
+        self.snapshot_path = snapshot_path  # Saved copy of the index (None = always parse the CSV)
+        self.feed = feed                    # Change feed our writes are published to, if any
+        self.outbox_path = path + '.outbox' # Changes written but not yet published to the feed
+        self.lock_path = path + '.lock'     # File that writers lock across processes
+        self._indexes = tuple(indexes)      # Columns with a secondary index
+        self._shared = tuple(shared)        # Columns whose repeated values are interned in memory
+        self._index = RowIndex(self.key_of, self._indexes, self._shared)
+        self._stamp = None                  # (mtime, size, inode, device) of the file the index was built from
+        self._journal_id = None             # Identity of the journal file we have read
+        self._journal_offset = 0            # Bytes of the journal already merged into the index
+        self._pending = 0                   # Journal lines not yet folded into the CSV file
+        self._saved = None                  # (stamp, journal offset) the snapshot was saved at
+        self._mapped = None                 # (stamp, header, mapping, payload offset) get() reads before loading
+        self._loader = None                 # Thread loading the index after such a get()
+        self._lock = threading.RLock()      # Held by the thread refreshing or changing the index
+        self._lock_file = None              # Open lock file while we hold the fcntl lock
+        self._compactor = None              # Background checkpoint timer, if started
+        self._compactor_lock = threading.Lock()  # Held while the timer is replaced or stopped
+        self._watchers = []                 # Callbacks told about every change (see watch())
+        # Ensure the directory for the CSV file exists
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # If the CSV file doesn't exist yet, create it with a header row
+        if not os.path.exists(self.path):
+            self._write_file(self.path, self.fieldnames, [])
+        # The journal has an extra 'op' column: 'put' stores a whole row, 'del' removes one
+        if self.journal_path and not os.path.exists(self.journal_path):
+            self._write_file(self.journal_path, self._journal_fields(), [])
+        # Files written before columns were added to the table get them now
+        self._upgrade_files(upgrade)
+        # Publish what a crashed writer left unpublished before anyone reads the feed on
+        if self.feed is not None and os.path.exists(self.outbox_path) and os.path.getsize(self.outbox_path):
+            with self._exclusive():
+                pass
+
+    def _journal_fields(self):
+        return ['op'] + self.fieldnames
+
+    @staticmethod
+    def _header(path):
+        # Return the column names in the first line of a CSV file
+        with open(path, newline='', encoding='utf-8') as f:
+            return next(csv.reader(f), [])
+
+    def _upgrade_files(self, upgrade):
+        # Rewrite the CSV file and journal if their header lacks some of our
+        # columns, filling each row in with upgrade(row) (or leaving the new
+        # columns blank). Files with columns we do not know are left alone.
+        files = [(self.path, self.fieldnames)]
+        if self.journal_path:
+            files.append((self.journal_path, self._journal_fields()))
+        for path, fields in files:
+            if self._header(path) == fields:
+                continue  # The usual case: nothing to do and no lock taken
+            with open(self.lock_path, 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    with open(path, newline='', encoding='utf-8') as f:
+                        reader = csv.DictReader(f)
+                        header = reader.fieldnames or []
+                        if header == fields or not set(header) < set(fields):
+                            continue  # Upgraded by another process meanwhile, or not ours to change
+                        # Skip a line a crashed writer cut short, as _load does
+                        rows = [row for row in reader if None not in row.values()]
+                    if upgrade is not None:
+                        rows = [upgrade(row) for row in rows]
+                    self._write_file(path, fields, rows)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def key_of(self, row: dict):
+        """
+        Return the key value of a row: a string, or a tuple for a composite key.
+        """
+        if isinstance(self.key, str):
+            return row[self.key]
+        return tuple(row[column] for column in self.key)
+
+    @staticmethod
+    def _file_stamp(path):
+        # Modification time (in nanoseconds), size and inode identify a version
+        # of the file: a checkpoint's rename gives it a new inode even when the
+        # rewrite has the same size and lands within one mtime tick
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+    @contextmanager
+    def _exclusive(self):
+        # Keep other threads and other processes out while we change the files,
+        # and start from the latest version of them
+        with self._lock:
+            if self._lock_file is not None:
+                yield  # Already held further up the call stack
+                return
+            with open(self.lock_path, 'a') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                self._lock_file = f
+                try:
+                    self.refresh()
+                    if self.feed is not None:
+                        self._recover_outbox()
+                    yield
+                finally:
+                    self._lock_file = None
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def exclusive(self):
+        return self._exclusive()
+
+    def _current(self) -> RowIndex:
+        # Return the index for reading, bringing it up to date first. If another
+        # thread is busy changing it we don't wait: its index is still
+        # consistent. Only an index that was never loaded is waited for.
+        if self._lock.acquire(blocking=self._stamp is None):
+            try:
+                self.refresh()
+            finally:
+                self._lock.release()
+        return self._index
+
+    def refresh(self):
+        """
+        Bring the index up to date with the files on disk.
+        The CSV file is only re-read if it changed since we last read or wrote
+        it; new journal lines written by others are merged in on top.
+        """
+        with self._lock:
+            stamp = self._file_stamp(self.path)
+            if stamp != self._stamp:
+                count('index_reloads', self.name)
+                self._load(stamp)
+            elif self.journal_path:
+                st = os.stat(self.journal_path)
+                if (st.st_ino, st.st_dev) != self._journal_id or st.st_size < self._journal_offset:
+                    # The journal was replaced by a checkpoint we did not make
+                    count('index_reloads', self.name)
+                    self._load(stamp)
+                else:
+                    count('index_hits', self.name)
+                    if st.st_size > self._journal_offset:
+                        self._replay_journal(self._index)
+            else:
+                count('index_hits', self.name)
+
+    def _load(self, stamp):
+        # Read the whole CSV file (and journal) into a new index, or start
+        # from the snapshot if it was saved from this version of the files
+        index = self._load_snapshot(stamp)
+        parsed = index is None
+        if parsed:
+            index = RowIndex(self.key_of, self._indexes, self._shared)
+            with open(self.path, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    if None in row.values():
+                        continue  # A row cut short by a writer that crashed or is still writing
+                    # Keep the first row for each key, matching the old linear scan
+                    index.put(row, replace=False)
+            count('rows_read', self.name, len(index.rows))
+            count('bytes_read', os.path.basename(self.path), stamp[1])
+            if self.journal_path:
+                st = os.stat(self.journal_path)
+                self._journal_id = (st.st_ino, st.st_dev)
+                self._journal_offset = 0
+                self._pending = 0
+        if self.journal_path:
+            # Apply every change recorded since the last checkpoint (or snapshot)
+            self._replay_journal(index)
+        # Swap the new index in at once so readers never see a half-built one
+        index.on_change = self._index.on_change
+        self._index = index
+        # Use the stamp taken before reading: if the file changed while we
+        # were reading it, the next refresh will notice and read it again
+        self._stamp = stamp
+        # No snapshot is saved here: a reload can be triggered by any reader,
+        # and writing one would hold that reader up. checkpoint() saves it.
+        self._notify(None, None, None)
+
+    def _snapshot_header(self, stamp):
+        # What a snapshot must record to be usable with this version of the CSV file
+        return {'fieldnames': self.fieldnames, 'key': self.key, 'indexes': list(self._indexes),
+                'stamp': stamp}
+
+    def _open_snapshot(self, stamp):
+        # Map the snapshot file and return (header, mapping, payload offset) if
+        # it matches the CSV file and journal as they are now, otherwise None
+        if not self.snapshot_path:
+            return None
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None  # No snapshot yet (or an empty file)
+        try:
+            if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError('not a snapshot')
+            start = len(SNAPSHOT_MAGIC) + 8
+            length, = struct.unpack_from('<Q', data, len(SNAPSHOT_MAGIC))
+            header = marshal.loads(data[start:start + length])
+            if {name: header.get(name) for name in ('fieldnames', 'key', 'indexes', 'stamp')} \
+                    != self._snapshot_header(stamp):
+                raise ValueError('saved from another version of the file')
+            if len(data) != start + length + header['size']:
+                raise ValueError('cut short')
+            if self.journal_path:
+                st = os.stat(self.journal_path)
+                if (st.st_ino, st.st_dev) != header['journal_id'] or st.st_size < header['journal_offset']:
+                    raise ValueError('saved from another journal')
+        except (ValueError, EOFError, TypeError, KeyError, struct.error):
+            data.close()
+            return None
+        return header, data, start + length
+
+    def _load_snapshot(self, stamp) -> Optional[RowIndex]:
+        # Rebuild the index from a matching snapshot, or return None
+        snapshot = self._open_snapshot(stamp)
+        if snapshot is None:
+            return None
+        header, data, start = snapshot
+        rows = {}
+        try:
+            with memoryview(data) as view:
+                # marshal reads straight from the mapped pages
+                bounds = header['rows']
+                for block in range(len(bounds) - 1):
+                    keys, values = marshal.loads(view[start + bounds[block]:start + bounds[block + 1]])
+                    rows.update(zip(keys, values))
+                by = marshal.loads(view[start + header['keys'][-1]:])
+            count('bytes_read', os.path.basename(self.snapshot_path), len(data))
+        except (ValueError, EOFError, TypeError):
+            return None  # Damaged, e.g. by a crash while it was being written
+        finally:
+            data.close()
+        if self.journal_path:
+            self._journal_id = tuple(header['journal_id'])
+            self._journal_offset = header['journal_offset']
+            self._pending = header['pending']
+        self._saved = (stamp, self._journal_offset)
+        return RowIndex.restore(self.key_of, rows, by, self._shared)
+
+    def _save_snapshot(self):
+        # Write the index to the snapshot file. Called with self._lock held, so
+        # the rows don't change while they are written out.
+        rows, size = self._index.rows, self.SNAPSHOT_BLOCK
+        keys = list(rows)
+        # The rows in file order, then their keys in sorted order with each
+        # key's row number, both in blocks that decode on their own
+        row_blocks = [marshal.dumps((keys[i:i + size], [rows[key] for key in keys[i:i + size]]))
+                      for i in range(0, len(keys), size)]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        key_blocks = [marshal.dumps(([keys[n] for n in order[i:i + size]], order[i:i + size]))
+                      for i in range(0, len(order), size)]
+        by = marshal.dumps(self._index.by)
+        bounds = list(itertools.accumulate(map(len, row_blocks + key_blocks), initial=0))
+        header = dict(self._snapshot_header(self._stamp), journal_id=self._journal_id,
+                      journal_offset=self._journal_offset, pending=self._pending,
+                      count=len(rows), rows=bounds[:len(row_blocks) + 1], keys=bounds[len(row_blocks):],
+                      first_keys=[keys[n] for n in order[::size]], size=bounds[-1] + len(by))
+        header = marshal.dumps(header)
+        # Processes sharing the directory each write their own temporary file
+        tmp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + struct.pack('<Q', len(header)) + header)
+            f.writelines(row_blocks + key_blocks + [by])
+            count('bytes_written', os.path.basename(self.snapshot_path), f.tell())
+        os.replace(tmp_path, self.snapshot_path)
+        self._saved = (self._stamp, self._journal_offset)
+
+    def _replay_journal(self, index: RowIndex):
+        # Read the journal from where we stopped last time
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            data = f.read()
+        # Only use complete lines; a writer may be half way through the last one
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return
+        count('bytes_read', os.path.basename(self.journal_path), end)
+        reader = csv.reader(io.StringIO(data[:end].decode('utf-8'), newline=''))
+        fields = self._journal_fields()
+        for values in reader:
+            if values == fields or len(values) != len(fields):
+                continue  # Header row, or what is left of a line a crashed writer cut short
+            op, row = values[0], dict(zip(self.fieldnames, values[1:]))
+            if op == 'put':
+                index.put(row)
+            elif op == 'del':
+                index.pop(self.key_of(row))
+            self._pending += 1
+        self._journal_offset += end
+
+    def watch(self, callback):
+        with self._lock:
+            super().watch(callback)
+            self._index.on_change = self._notify
+
+    def get(self, key) -> Optional[dict]:
+        """
+        Return the row with the given key, or None if there is no such row.
+        The returned dict belongs to the index and must not be modified.
+        """
+        if self._stamp is None:
+            found = self._lookup_snapshot(key)
+            if found is not None:
+                return found[0]
+        return self._current().rows.get(key)
+
+    def _lookup_snapshot(self, key):
+        # Before the index is loaded, look the key up in the snapshot and
+        # return (row or None,), as long as the snapshot matches the files as
+        # they are now and covers the whole journal; otherwise return None.
+        # The first lookup starts loading the index in the background.
+        stamp = self._file_stamp(self.path)
+        mapped = self._mapped
+        if mapped is None or mapped[0] != stamp:
+            snapshot = self._open_snapshot(stamp)
+            if snapshot is None:
+                return None
+            mapped = self._mapped = (stamp,) + snapshot
+        _, header, data, start = mapped
+        if self.journal_path and os.path.getsize(self.journal_path) != header['journal_offset']:
+            return None  # Changes since the snapshot: only the loaded index has them
+        if self._loader is None:
+            self._loader = threading.Thread(target=self._load_quietly, daemon=True)
+            self._loader.start()
+        try:
+            with memoryview(data) as view:
+                block = bisect_right(header['first_keys'], key) - 1
+                if block < 0:
+                    return (None,)
+                bounds = header['keys']
+                keys, numbers = marshal.loads(view[start + bounds[block]:start + bounds[block + 1]])
+                i = bisect_left(keys, key)
+                if i == len(keys) or keys[i] != key:
+                    return (None,)
+                block, i = divmod(numbers[i], self.SNAPSHOT_BLOCK)
+                bounds = header['rows']
+                return (marshal.loads(view[start + bounds[block]:start + bounds[block + 1]])[1][i],)
+        except (ValueError, EOFError, TypeError, IndexError):
+            return None  # Damaged: the loaded index will tell
+
+    def _load_quietly(self):
+        # Load the index on the background thread started by _lookup_snapshot()
+        try:
+            self._current()
+        except OSError:
+            pass  # The files went away; whoever reads the table next will see why
+        self._mapped = None  # The index answers from now on
+
+    @property
+    def loaded(self) -> bool:
+        return self._stamp is not None
+
+    def peek(self, key) -> Optional[dict]:
+        # No os.stat and no reload: just the index as it stands
+        return self._index.rows.get(key)
+
+    def get_many(self, keys) -> dict:
+        """
+        Look up several keys against one refreshed copy of the index.
+        """
+        rows = self._current().rows
+        found = {}
+        for key in keys:
+            row = rows.get(key)
+            if row is not None:
+                found[key] = row
+        return found
+
+    def find(self, column: str, value: str):
+        """
+        Return the rows whose column holds the given value, using the
+        secondary index for that column if there is one.
+        """
+        index = self._current()
+        if column not in index.by:
+            count('rows_scanned', self.name, len(index.rows))
+        return index.find(column, value)
+
+    def rows(self):
+        """
+        Return all rows in file order.
+        """
+        rows = list(self._current().rows.values())
+        count('rows_scanned', self.name, len(rows))
+        return rows
+
+    def scan(self, after=None, offset: int = 0, limit: int = None, equal: dict = None, between: dict = None):
+        """
+        Return an iterator over matching rows in file order (see Table.scan). The start
+        of the page is found through the index's row positions, so a page
+        deep into the file costs no more than the first one.
+        """
+        index = self._current()
+        if after is not None and after not in index.positions:
+            raise KeyError(after)
+        equal = equal or {}
+        indexed = [column for column in equal if column in index.by]
+        if indexed:
+            # Only visit the rows the secondary index lists, in file order
+            keys = list(index.by[indexed[0]].get(equal[indexed[0]], ()))
+            start = -1 if after is None else index.positions[after]
+            keys = sorted((p, key) for p, key in ((index.positions.get(key), key) for key in keys)
+                          if p is not None and p > start)
+            rows = (index.rows.get(key) for _, key in keys)
+            rows = (row for row in rows if row is not None)
+        elif not between and not equal:
+            # No filter: the offset can be found by position too
+            return _limit(index.scan(after, offset), 0, limit)
+        else:
+            rows = index.scan(after)
+        return _limit(_matching(rows, equal, between), offset, limit)
+
+    def __len__(self):
+        with self._lock:
+            if self._stamp is None:
+                # Not read yet: a snapshot that covers the whole journal knows
+                # the count without its rows being loaded
+                snapshot = self._open_snapshot(self._file_stamp(self.path))
+                if snapshot is not None:
+                    header, data, _ = snapshot
+                    data.close()
+                    if not self.journal_path or os.path.getsize(self.journal_path) == header['journal_offset']:
+                        return header['count']
+        return len(self._current().rows)
+
+    def append_many(self, rows):
+        """
+        Add new rows to the end of the journal (or the file) and to the index,
+        opening the file only once. Rows whose key is already stored, or
+        repeated in the batch, are skipped, as the SQLite backend does.
+
+        A batch large enough to reach the checkpoint threshold by itself (a
+        bulk import) goes straight to the end of the CSV file instead, after
+        folding in the journal so that nothing in it can refer to these rows.
+        """
+        rows = [dict(row) for row in rows]
+        with self._exclusive():
+            index = self._index.rows
+            new = {}
+            for row in rows:
+                key = self.key_of(row)
+                if key not in index and key not in new:
+                    new[key] = row
+            rows = list(new.values())
+            if not rows:
+                return
+            self._stage([('put', row) for row in rows])
+            if self.journal_path and self._pending + len(rows) < self.checkpoint_every:
+                for row in rows:
+                    self._index.put(row)
+                self._log([('put', row) for row in rows])
+            else:
+                self._fold_journal()
+                size = self._stamp[1]
+                self._append(self.path, self.fieldnames, rows)
+                self._stamp = self._file_stamp(self.path)
+                count('bytes_written', os.path.basename(self.path), self._stamp[1] - size)
+                for row in rows:
+                    self._index.put(row)
+            self._publish([('put', row) for row in rows])
+
+    def update_many(self, updates, expected: dict = None) -> int:
+        """
+        Apply several (key, changes) updates with a single journal append
+        (or a single rewrite of the CSV file).
+        `expected` optionally maps keys to the column values their rows must
+        still hold. If any row doesn't, nothing is written and ConflictError
+        lists every such key.
+        Returns the number of rows that were found and changed.
+        """
+        updates = list(updates)
+        with self._exclusive():
+            rows = self._index.rows
+            if expected:
+                conflicts = [key for key, values in expected.items()
+                             if not _holds(rows.get(key), values)]
+                if conflicts:
+                    raise ConflictError(conflicts)
+            entries = []
+            for key, changes in updates:
+                row = rows.get(key)
+                if row is None:
+                    continue
+                # Put in a new row (re-indexed in case an indexed column changed)
+                self._index.put(dict(row, **changes))
+                entries.append(('put', rows[key]))
+            if entries:
+                self._stage(entries)
+                self._write_changes(entries)
+                self._publish(entries)
+            return len(entries)
+
+    def delete_many(self, keys) -> int:
+        """
+        Remove several rows with a single journal append (or a single rewrite
+        of the CSV file). Returns the number of rows removed.
+        """
+        with self._exclusive():
+            entries = []
+            for key in keys:
+                row = self._index.pop(key)
+                if row is not None:
+                    entries.append(('del', row))  # A tombstone line; the row goes at the next checkpoint
+            if entries:
+                self._stage(entries)
+                self._write_changes(entries)
+                self._publish(entries)
+            return len(entries)
+
+    def _stage(self, entries):
+        # Write (op, row) changes to the outbox before they are written to the table
+        if self.feed is not None:
+            with open(self.outbox_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps([op, row], separators=(',', ':')) + '\n' for op, row in entries)
+
+    def _publish(self, entries):
+        # Publish (op, row) changes just written to the change feed, if any,
+        # and clear the outbox. Called with the writer lock held, so the feed
+        # has them in write order.
+        if self.feed is not None:
+            self.feed.publish(self.name, [(op, self.key_of(row), row) for op, row in entries])
+            open(self.outbox_path, 'w').close()
+
+    def _recover_outbox(self):
+        # Publish the changes a crashed writer left in the outbox, if they
+        # reached the table. Called with the writer lock held and the index
+        # refreshed, so the table holds either all of them or only some of
+        # them, in order.
+        try:
+            with open(self.outbox_path, 'rb') as f:
+                lines = f.read().split(b'\n')
+        except FileNotFoundError:
+            return
+        entries = []
+        for line in lines:
+            try:
+                op, row = json.loads(line)
+            except ValueError:
+                continue  # The end of the file, or a line the crash cut short
+            current = self._index.rows.get(self.key_of(row))
+            if (op == 'put' and current is not None and _same_row(current, row, self.fieldnames)) or \
+                    (op == 'del' and current is None):
+                entries.append((op, row))
+        if entries:
+            self._publish(entries)
+        elif lines != [b'']:
+            open(self.outbox_path, 'w').close()
+
+    def _write_changes(self, entries):
+        # Journaled tables append one line per change; others rewrite the file
+        if self.journal_path:
+            self._log(entries)
+        else:
+            self._rewrite()
+
+    def _log(self, entries):
+        # Append (op, row) changes to the journal and remember how far we have read
+        size = self._journal_offset
+        self._append(self.journal_path, self._journal_fields(),
+                     [dict(row, op=op) for op, row in entries])
+        self._journal_offset = os.path.getsize(self.journal_path)
+        count('bytes_written', os.path.basename(self.journal_path), self._journal_offset - size)
+        self._pending += len(entries)
+        if self._pending >= self.checkpoint_every:
+            # Not a full checkpoint: saving the snapshot here would hold up the
+            # change that happened to cross the threshold
+            self._fold_journal()
+
+    def checkpoint(self):
+        """
+        Fold the journal into the CSV file and start a new, empty journal,
+        then save a snapshot of the index if the saved one is out of date.
+        """
+        if not self.journal_path and not self.snapshot_path:
+            return
+        with self._exclusive():
+            self._fold_journal()
+            if self.snapshot_path and self._saved != (self._stamp, self._journal_offset):
+                self._save_snapshot()
+
+    def _fold_journal(self):
+        # Rewrite the CSV file with the journaled changes and empty the journal
+        with self._exclusive():
+            if not self.journal_path or self._pending == 0:
+                return  # Nothing to fold in
+            self._rewrite()
+            self._write_file(self.journal_path, self._journal_fields(), [])
+            st = os.stat(self.journal_path)
+            self._journal_id = (st.st_ino, st.st_dev)
+            self._journal_offset = st.st_size
+            self._pending = 0
+
+    def start_compactor(self, interval: float = 60.0):
+        """
+        Run checkpoint() every `interval` seconds on a background thread,
+        until stop_compactor() is called.
+        """
+        def run():
+            self.checkpoint()
+            with self._compactor_lock:
+                if self._compactor is threading.current_thread():  # Not stopped while we were running
+                    schedule()
+
+        def schedule():
+            self._compactor = threading.Timer(interval, run)
+            self._compactor.daemon = True  # Don't keep the program alive just for this
+            self._compactor.start()
+
+        with self._compactor_lock:
+            schedule()
+
+    def stop_compactor(self):
+        """
+        Stop the background checkpoint timer.
+        """
+        with self._compactor_lock:
+            compactor, self._compactor = self._compactor, None
+        if compactor is not None:
+            compactor.cancel()
+            compactor.join()  # Let a checkpoint already under way finish
+
+    def _rewrite(self):
+        # Write the header and every indexed row back to the CSV file
+        self._write_file(self.path, self.fieldnames, self._index.rows.values())
+        self._stamp = self._file_stamp(self.path)
+
+    @staticmethod
+    def _append(path, fieldnames, rows):
+        # Append rows to a CSV file, first cutting off what a crashed writer
+        # left of a line. Finishing it off instead would turn it into a change
+        # whenever it happened to be cut after the right number of fields.
+        # Called with the writer lock held, so nobody else is still writing it.
+        with open(path, 'r+b') as f:
+            _truncate_partial_line(f)
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=fieldnames).writerows(rows)
+
+    @staticmethod
+    def _write_file(path, fieldnames, rows):
+        # Write to a temporary file first and rename it over the old one, so a
+        # crash part way through never leaves a half-written file behind
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+            count('bytes_written', os.path.basename(path), os.fstat(f.fileno()).st_size)
+        os.replace(tmp_path, path)
+
+
+def _same_row(row: dict, other: dict, fieldnames) -> bool:
+    # True if two rows hold the same values as they would be written to CSV
+    def text(value):
+        return '' if value is None else str(value)
+    return all(text(row.get(name)) == text(other.get(name)) for name in fieldnames)
+
+
+def _truncate_partial_line(f):
+    # Cut an open binary file back to the end of its last complete line
+    end = f.seek(0, os.SEEK_END)
+    position = end
+    while position > 0:
+        start = max(0, position - 64 * 1024)
+        f.seek(start)
+        chunk = f.read(position - start)
+        if position == end and chunk.endswith(b'\n'):
+            return  # The usual case: nothing left behind
+        newline = chunk.rfind(b'\n')
+        if newline >= 0:
+            f.truncate(start + newline + 1)
+            return
+        position = start
+    f.truncate(0)
+
+
+def _holds(row: Optional[dict], values: dict) -> bool:
+    # True if the row exists and holds every expected column value
+    return row is not None and all(row[column] == value for column, value in values.items())
+
+
+def _matching(rows, equal: dict = None, between: dict = None):
+    # Keep the rows that hold every value in `equal` and lie in every range in `between`
+    equal = equal or {}
+    ranges = [(column, low, high) for column, (low, high) in (between or {}).items()]
+    for row in rows:
+        if all(row[column] == value for column, value in equal.items()) and all(
+                (low is None or row[column] >= low) and (high is None or row[column] <= high)
+                for column, low, high in ranges):
+            yield row
+
+
+def _limit(rows, offset: int = 0, limit: int = None):
+    # Skip `offset` rows, then yield at most `limit` (all if None)
+    stop = None if limit is None else offset + limit
+    return itertools.islice(rows, offset, stop)
+
+
+class SqliteTable(Table):
+    """
+    Stores rows in an SQLite table with the key column(s) as its primary key,
+    so lookups, updates and deletes are indexed point queries in a transaction.
+    Extra columns listed in `indexes` get their own SQLite index for find().
+
+    The connection may be shared by several threads: every use of it holds
+    `lock`, so one thread's transaction never picks up another's statements.
+    """
+    def __init__(self, conn: sqlite3.Connection, name: str, fieldnames: list, key='id', indexes=(),
+                 lock=None, upgrade=None):
+        self.conn = conn                    # Connection shared by all tables of one database
+        self._lock = lock or threading.RLock()  # Held while using the connection
+        self.name = name                    # Table name in the database
+        self.fieldnames = list(fieldnames)  # Column names
+        self.key = key                      # Primary key column (or tuple of columns)
+        key_columns = [key] if isinstance(key, str) else list(key)
+        columns = ', '.join(f'"{f}"' for f in self.fieldnames)
+        definitions = ', '.join(f'"{f}" TEXT' for f in self.fieldnames)
+        primary_key = ', '.join(f'"{k}"' for k in key_columns)
+        match_key = ' AND '.join(f'"{k}" = ?' for k in key_columns)
+        with self.conn:
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{name}" ({definitions}, PRIMARY KEY ({primary_key}))'
+            )
+            # A table created before columns were added gets them now
+            existing = {info[1] for info in self.conn.execute(f'PRAGMA table_info("{name}")')}
+            added = [f for f in self.fieldnames if f not in existing]
+            for column in added:
+                self.conn.execute(f'ALTER TABLE "{name}" ADD COLUMN "{column}" TEXT DEFAULT \'\'')
+            if added and upgrade is not None:
+                # Fill the new columns in for the rows that were already there
+                rows = self.conn.execute(f'SELECT rowid, {columns} FROM "{name}"').fetchall()
+                assignments = ', '.join(f'"{f}" = ?' for f in self.fieldnames)
+                self.conn.executemany(
+                    f'UPDATE "{name}" SET {assignments} WHERE rowid = ?',
+                    ([row[f] for f in self.fieldnames] + [rowid]
+                     for rowid, row in ((values[0], upgrade(dict(zip(self.fieldnames, values[1:]))))
+                                        for values in rows)))
+            for column in indexes:
+                self.conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{name}_{column}" ON "{name}" ("{column}")'
+                )
+        # SQL text is built once so sqlite3 can reuse its prepared statements
+        self._select_one = f'SELECT {columns} FROM "{name}" WHERE {match_key}'
+        self._select_all = f'SELECT {columns} FROM "{name}" ORDER BY rowid'
+        self._select_page = f'SELECT {columns} FROM "{name}" {{}} ORDER BY rowid LIMIT ? OFFSET ?'
+        self._select_rowid = f'SELECT rowid FROM "{name}" WHERE {match_key}'
+        self._select_where = f'SELECT {columns} FROM "{name}" WHERE "{{}}" = ? ORDER BY rowid'
+        self._count = f'SELECT COUNT(*) FROM "{name}"'
+        self._insert = (f'INSERT OR IGNORE INTO "{name}" ({columns}) '
+                        f'VALUES ({", ".join("?" for _ in self.fieldnames)})')
+        self._delete = f'DELETE FROM "{name}" WHERE {match_key}'
+        self._match_key = match_key
+        self._updates = {}                  # Field names being changed -> UPDATE statement
+        self._watchers = []                 # Callbacks told about every change (see watch())
+        self._data_version = self._version()
+
+    def _version(self):
+        # SQLite bumps this number whenever another connection commits a change
+        with self._lock:
+            return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def key_of(self, row: dict):
+        """
+        Return the key value of a row: a string, or a tuple for a composite key.
+        """
+        if isinstance(self.key, str):
+            return row[self.key]
+        return tuple(row[column] for column in self.key)
+
+    def refresh(self):
+        # Our own commits don't change data_version, so a change means someone
+        # else wrote to the database and watchers must start again
+        with self._lock:
+            version = self._version()
+            if version != self._data_version:
+                self._data_version = version
+                self._notify(None, None, None)
+
+    def _key_params(self, key):
+        # A single key becomes one parameter; a composite key one per column
+        return [key] if isinstance(self.key, str) else list(key)
+
+    def get(self, key) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute(self._select_one, self._key_params(key)).fetchone()
+            return dict(zip(self.fieldnames, row)) if row else None
+
+    def find(self, column: str, value: str):
+        with self._lock:
+            if column not in self.fieldnames:
+                raise KeyError(column)
+            sql = self._select_where.format(column)
+            return [dict(zip(self.fieldnames, row)) for row in self.conn.execute(sql, (value,))]
+
+    def rows(self):
+        with self._lock:
+            return [dict(zip(self.fieldnames, row)) for row in self.conn.execute(self._select_all)]
+
+    def iter_rows(self):
+        with self._lock:
+            cursor = self.conn.execute(self._select_all)
+        return self._stream(cursor)
+
+    def _stream(self, cursor):
+        # Stream rows from the cursor instead of building a list, taking the
+        # lock for one batch at a time so other threads are not held up
+        while True:
+            with self._lock:
+                batch = cursor.fetchmany(1000)
+            if not batch:
+                return
+            count('rows_read', self.name, len(batch))
+            for row in batch:
+                yield dict(zip(self.fieldnames, row))
+
+    def scan(self, after=None, offset: int = 0, limit: int = None, equal: dict = None, between: dict = None):
+        """
+        Return an iterator over matching rows in rowid order (see Table.scan).
+        The filters, the cursor and the page bounds all become part of the
+        query, so SQLite seeks to the page with its indexes.
+        """
+        where, params = [], []
+        for column, value in (equal or {}).items():
+            where.append(f'"{self._column(column)}" = ?')
+            params.append(value)
+        for column, (low, high) in (between or {}).items():
+            if low is not None:
+                where.append(f'"{self._column(column)}" >= ?')
+                params.append(low)
+            if high is not None:
+                where.append(f'"{self._column(column)}" <= ?')
+                params.append(high)
+        with self._lock:
+            if after is not None:
+                row = self.conn.execute(self._select_rowid, self._key_params(after)).fetchone()
+                if row is None:
+                    raise KeyError(after)
+                where.append('rowid > ?')
+                params.append(row[0])
+            sql = self._select_page.format('WHERE ' + ' AND '.join(where) if where else '')
+            cursor = self.conn.execute(sql, params + [-1 if limit is None else limit, offset])
+        return self._stream(cursor)
+
+    def _column(self, column):
+        # Only known column names are put into SQL text
+        if column not in self.fieldnames:
+            raise KeyError(column)
+        return column
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute(self._count).fetchone()[0]
+
+    def append_many(self, rows):
+        # Keep the first row for each key, like the CSV backend
+        with self._lock:
+            rows = [{f: row.get(f, '') for f in self.fieldnames} for row in rows]
+            if not self._watchers:
+                with self._transaction():
+                    self.conn.executemany(self._insert, ([row[f] for f in self.fieldnames] for row in rows))
+                return
+            # Insert one at a time so watchers only hear about rows that were added
+            added = []
+            with self._transaction():
+                for row in rows:
+                    if self.conn.execute(self._insert, [row[f] for f in self.fieldnames]).rowcount:
+                        added.append(row)
+            for row in added:
+                self._notify(self.key_of(row), None, row)
+
+    @contextmanager
+    def exclusive(self):
+        # One write transaction, begun at once so other processes' writers
+        # wait for it; every table of the database shares it
+        with self._lock:
+            if self.conn.in_transaction:
+                yield  # Opened by another table of this database further up
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
+    @contextmanager
+    def _transaction(self):
+        # A transaction for one change, or a savepoint inside the transaction
+        # exclusive() holds, so a change that fails is still undone on its own
+        if not self.conn.in_transaction:
+            with self.conn:
+                yield
+            return
+        self.conn.execute('SAVEPOINT change')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK TO change')
+            self.conn.execute('RELEASE change')
+            raise
+        self.conn.execute('RELEASE change')
+
+    def _update_sql(self, fields, expected_fields=()):
+        # Build (once per combination of fields) the UPDATE statement that
+        # changes `fields` on rows that still hold the expected values
+        sql = self._updates.get((fields, expected_fields))
+        if sql is None:
+            assignments = ', '.join(f'"{f}" = ?' for f in fields)
+            where = ''.join(f' AND "{f}" = ?' for f in expected_fields)
+            sql = f'UPDATE "{self.name}" SET {assignments} WHERE {self._match_key}{where}'
+            self._updates[(fields, expected_fields)] = sql
+        return sql
+
+    def update_many(self, updates, expected: dict = None) -> int:
+        # Every update runs inside one transaction, which is rolled back if
+        # any row no longer holds its expected values
+        with self._lock:
+            expected = expected or {}
+            changed = 0
+            conflicts = []
+            notes = []                          # (key, old, new) to tell watchers after the commit
+            with self._transaction():
+                for key, changes in updates:
+                    old = self.get(key) if self._watchers else None
+                    fields = tuple(changes)
+                    values = expected.get(key, {})
+                    expected_fields = tuple(values)
+                    cursor = self.conn.execute(
+                        self._update_sql(fields, expected_fields),
+                        [changes[f] for f in fields] + self._key_params(key) + [values[f] for f in expected_fields]
+                    )
+                    if cursor.rowcount == 0 and values:
+                        conflicts.append(key)
+                    elif cursor.rowcount and old is not None:
+                        notes.append((key, old, dict(old, **changes)))
+                    changed += cursor.rowcount
+                if conflicts:
+                    raise ConflictError(conflicts)
+            for note in notes:
+                self._notify(*note)
+            return changed
+
+    def delete_many(self, keys) -> int:
+        with self._lock:
+            if not self._watchers:
+                with self._transaction():
+                    cursor = self.conn.executemany(self._delete, (self._key_params(key) for key in keys))
+                return cursor.rowcount
+            # Look each row up first so watchers can be told what was removed
+            removed = []
+            with self._transaction():
+                for key in keys:
+                    old = self.get(key)
+                    if old is not None and self.conn.execute(self._delete, self._key_params(key)).rowcount:
+                        removed.append((key, old))
+            for key, old in removed:
+                self._notify(key, old, None)
+            return len(removed)
+
+    def checkpoint(self):
+        # Copy committed changes from the write-ahead log into the database file
+        with self._lock:
+            self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+class CsvStorage:
+    """
+    Keeps each table in its own CSV file inside a directory, with a snapshot
+    of its index in <name>.snapshot for fast start-up (see CsvTable). If a
+    ChangeFeed is given, every change to every table is published to it.
+    """
+    DIRECTORY = 'csv'
+
+    def __init__(self, directory: str = None, snapshots: bool = True, feed: ChangeFeed = None):
+        self.directory = directory or self.DIRECTORY
+        self.snapshots = snapshots  # Save and load index snapshots
+        self.feed = feed            # Change feed shared by all tables, if any
+
+    def table(self, name: str, fieldnames: list, key='id', journal: bool = False,
+              checkpoint_every: int = 1000, indexes=(), upgrade=None, shared=()) -> CsvTable:
+        """
+        Open the table stored in <directory>/<name>.csv, optionally with a
+        journal of changes in <directory>/<name>.journal.csv. If the files
+        were written before some of the columns existed, they are added and
+        each old row is filled in with upgrade(row), if given. Values of the
+        `shared` columns are interned in memory, as they repeat across rows.
+        """
+        path = os.path.join(self.directory, f'{name}.csv')
+        journal_path = os.path.join(self.directory, f'{name}.journal.csv') if journal else None
+        snapshot_path = os.path.join(self.directory, f'{name}.snapshot') if self.snapshots else None
+        return CsvTable(path, fieldnames, key, journal_path=journal_path,
+                        checkpoint_every=checkpoint_every, indexes=indexes, snapshot_path=snapshot_path,
+                        upgrade=upgrade, feed=self.feed, shared=shared)
+
+
+class SqliteStorage:
+    """
+    Keeps every table in one SQLite database file, using write-ahead logging
+    so readers are not blocked while a change is being written, even by
+    another process.
+    """
+    DB_PATH = os.path.join('csv', 'library.db')
+
+    def __init__(self, path: str = None):
+        self.path = path or self.DB_PATH
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Wait up to 30 seconds for another process's write to finish. The
+        # connection may be used from worker threads (e.g. by the HTTP server);
+        # the tables take `lock` around every use of it.
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def table(self, name: str, fieldnames: list, key='id', journal: bool = False,
+              checkpoint_every: int = 1000, indexes=(), upgrade=None, shared=()) -> SqliteTable:
+        """
+        Open (creating if needed) the table with the given name, adding any
+        columns it lacks and filling them in with upgrade(row), if given.
+        The journal and shared options only apply to CSV storage (which keeps
+        the rows in memory) and are ignored here.
+        """
+        return SqliteTable(self.conn, name, fieldnames, key, indexes, self.lock, upgrade)
+
+
+def hash_shard(value: str, shards: int) -> int:
+    """
+    Return the shard a key value belongs to: crc32 of the value modulo the
+    number of shards, which (unlike hash()) is the same in every process.
+    """
+    return zlib.crc32(value.encode('utf-8')) % shards
+
+
+class ShardedTable(Table):
+    """
+    One table split across several CsvTables (the shards), each with its own
+    files, lock, journal and index. A row lives in the shard that
+    shard_of(value, number of shards) picks for the first column of its key,
+    so the loans and holds of an item sit in the same shard as the item.
+
+    Reads and writes of given keys go straight to their shard, so writers
+    working on different shards never wait for each other. Reads of the
+    whole table (rows, find, filtered scans, checkpoints) run on every shard
+    at once on a thread pool and the results are merged, shard by shard.
+    """
+    IN_MEMORY = True
+
+    def __init__(self, shards: list, shard_of=hash_shard, pool: ThreadPoolExecutor = None):
+        self.shards = shards                # CsvTable of each shard
+        self.shard_of = shard_of            # (key value, number of shards) -> shard number
+        self.pool = pool or ThreadPoolExecutor(max_workers=len(shards))  # Runs the fan-out reads
+        self.name = shards[0].name          # Table name, for metrics
+        self.fieldnames = shards[0].fieldnames  # Column names
+        self.key = shards[0].key            # Column (or tuple of columns) used as the key
+        self._holder = None                 # Thread holding every shard's lock through exclusive(), if any
+
+    def key_of(self, row: dict):
+        return self.shards[0].key_of(row)
+
+    def _shard_number(self, key) -> int:
+        # Composite keys are placed by their first column
+        return self.shard_of(key if isinstance(key, str) else key[0], len(self.shards))
+
+    def _group(self, entries, key_of) -> dict:
+        # Split entries into lists per shard number, keeping their order
+        groups = {}
+        for entry in entries:
+            groups.setdefault(self._shard_number(key_of(entry)), []).append(entry)
+        return groups
+
+    def _fan_out(self, function, shards=None):
+        # Call function(shard) on every shard (or the given ones) at once and
+        # return the results in shard order
+        shards = self.shards if shards is None else shards
+        if len(shards) == 1 or self._holder == threading.get_ident():
+            # Inside exclusive() the shard locks belong to this thread, so a
+            # pool thread writing to a shard would wait for them forever
+            return [function(shard) for shard in shards]
+        return list(self.pool.map(function, shards))
+
+    def get(self, key) -> Optional[dict]:
+        return self.shards[self._shard_number(key)].get(key)
+
+    @property
+    def loaded(self) -> bool:
+        return all(shard.loaded for shard in self.shards)
+
+    def peek(self, key) -> Optional[dict]:
+        return self.shards[self._shard_number(key)].peek(key)
+
+    def get_many(self, keys) -> dict:
+        found = {}
+        for number, group in self._group(keys, lambda key: key).items():
+            found.update(self.shards[number].get_many(group))
+        return found
+
+    def find(self, column: str, value: str):
+        if column == (self.key if isinstance(self.key, str) else self.key[0]):
+            # Rows are placed by this column, so they are all in one shard
+            return self.shards[self._shard_number(value)].find(column, value)
+        return list(itertools.chain.from_iterable(self._fan_out(lambda shard: shard.find(column, value))))
+
+    def rows(self):
+        """
+        Return all rows, shard by shard, each shard's in the order they were added.
+        """
+        return list(itertools.chain.from_iterable(self._fan_out(lambda shard: shard.rows())))
+
+    def scan(self, after=None, offset: int = 0, limit: int = None, equal: dict = None, between: dict = None):
+        """
+        Return an iterator over matching rows, shard by shard (see Table.scan).
+        A cursor continues in the shard of its row. A filtered scan asks every
+        remaining shard for its first offset + limit matches at once, so
+        sparse matches are found in parallel; an unfiltered one reads the
+        shards in turn and stops as soon as the page is full.
+        """
+        first = 0
+        if after is not None:
+            first = self._shard_number(after)
+            if self.shards[first].get(after) is None:
+                raise KeyError(after)
+        shards = self.shards[first:]
+
+        def part(shard):
+            # The cursor only applies to its own shard; the others start at their beginning
+            cursor = after if shard is shards[0] else None
+            return shard.scan(cursor, 0, None if limit is None else offset + limit, equal, between)
+
+        if (equal or between) and limit is not None:
+            parts = self._fan_out(lambda shard: list(part(shard)), shards)
+        else:
+            parts = map(part, shards)
+        return _limit(itertools.chain.from_iterable(parts), offset, limit)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def append_many(self, rows):
+        groups = self._group(rows, self.key_of)
+        self._fan_out(lambda number: self.shards[number].append_many(groups[number]), list(groups))
+
+    def update_many(self, updates, expected: dict = None) -> int:
+        """
+        Apply updates shard by shard, one write per shard. When `expected`
+        covers several shards, all of their locks are taken first (always in
+        shard order, so two such updates cannot deadlock) and every row is
+        checked before anything is written, so a ConflictError still means
+        that nothing changed.
+        """
+        groups = self._group(updates, lambda update: update[0])
+        expected = expected or {}
+        if len(groups) <= 1:
+            return sum(self.shards[number].update_many(group, expected or None)
+                       for number, group in groups.items())
+        with ExitStack() as locks:
+            for number in sorted(groups):
+                locks.enter_context(self.shards[number].exclusive())
+            conflicts = [key for key, values in expected.items() if not _holds(self.get(key), values)]
+            if conflicts:
+                raise ConflictError(conflicts)
+            return sum(self.shards[number].update_many(group) for number, group in groups.items())
+
+    def delete_many(self, keys) -> int:
+        return sum(self.shards[number].delete_many(group)
+                   for number, group in self._group(keys, lambda key: key).items())
+
+    @contextmanager
+    def exclusive(self):
+        # Every shard's lock, in shard order like a cross-shard update_many
+        with ExitStack() as locks:
+            for shard in self.shards:
+                locks.enter_context(shard.exclusive())
+            holder, self._holder = self._holder, threading.get_ident()
+            try:
+                yield
+            finally:
+                self._holder = holder
+
+    def checkpoint(self):
+        self._fan_out(lambda shard: shard.checkpoint())
+
+    def refresh(self):
+        for shard in self.shards:
+            shard.refresh()
+
+    def watch(self, callback):
+        for shard in self.shards:
+            shard.watch(callback)
+
+    def start_compactor(self, interval: float = 60.0):
+        for shard in self.shards:
+            shard.start_compactor(interval)
+
+    def stop_compactor(self):
+        for shard in self.shards:
+            shard.stop_compactor()
+
+
+class ShardedStorage:
+    """
+    Splits every table across several CSV directories, <directory>/0,
+    <directory>/1, ... (see ShardedTable). By default rows are spread by a
+    hash of their key; pass shard_of(value, shards) to place them some other
+    way, e.g. to keep each branch's items together by their ID prefix.
+    The number and placement of shards must stay the same for a directory.
+    A ChangeFeed, if given, is shared by all shards, so it numbers changes
+    across the whole library.
+    """
+    DIRECTORY = os.path.join('csv', 'shards')
+
+    def __init__(self, shards: int = 4, directory: str = None, shard_of=None, snapshots: bool = True,
+                 feed: ChangeFeed = None):
+        self.directory = directory or self.DIRECTORY
+        self.storages = [CsvStorage(os.path.join(self.directory, str(n)), snapshots, feed) for n in range(shards)]
+        self.shard_of = shard_of or hash_shard
+        # Shared by every table, one thread per shard
+        self.pool = ThreadPoolExecutor(max_workers=shards, thread_name_prefix='shard')
+
+    def table(self, name: str, fieldnames: list, key='id', journal: bool = False,
+              checkpoint_every: int = 1000, indexes=(), upgrade=None, shared=()) -> ShardedTable:
+        """
+        Open the table in every shard directory (see CsvStorage.table).
+        """
+        return ShardedTable([storage.table(name, fieldnames, key, journal, checkpoint_every, indexes, upgrade,
+                                           shared)
+                             for storage in self.storages], self.shard_of, self.pool)
+
+
+def open_storage():
+    """
+    Return the storage backend chosen by the LIBRARY_STORAGE environment
+    variable: 'csv' (the default), 'sqlite' or 'sharded'. LIBRARY_DB overrides
+    where the SQLite database file is kept, and LIBRARY_SHARDS sets the
+    number of shards (default 4). LIBRARY_FEED=1 publishes every change to
+    the CSV tables to csv/changes.log (or LIBRARY_FEED=<path> to that file);
+    it cannot be combined with SQLite, and ValueError is raised if it is.
+    """
+    backend = os.environ.get('LIBRARY_STORAGE', 'csv').lower()
+    feed = os.environ.get('LIBRARY_FEED', '0')
+    if backend == 'sqlite':
+        if feed not in ('', '0'):
+            raise ValueError("LIBRARY_FEED needs CSV storage: SQLite tables do not publish their changes")
+        return SqliteStorage(os.environ.get('LIBRARY_DB'))
+    feed = ChangeFeed(None if feed == '1' else feed) if feed not in ('', '0') else None
+    if backend == 'sharded':
+        return ShardedStorage(int(os.environ.get('LIBRARY_SHARDS', '4')), feed=feed)
+    return CsvStorage(feed=feed)
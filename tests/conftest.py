@@ -0,0 +1,28 @@
+import pytest
+from library import LibraryService
+from members import Member
+from storage import SqliteStorage
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Repositories use paths relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(params=['csv', 'sqlite'])
+def open_service(request, workdir):
+    return lambda: LibraryService(SqliteStorage() if request.param == 'sqlite' else None)
+
+
+@pytest.fixture
+def stocked_service(open_service):
+    # Open a service holding the given items and members (Alice and Bob unless others are given)
+    def stocked(items, members=None):
+        service = open_service()
+        service.members_repo.add_many(members or [Member('M001', 'Alice', '2024-01-10'),
+                                                  Member('M002', 'Bob', '2024-02-12')])
+        service.items_repo.add_many(items)
+        return service
+    return stocked
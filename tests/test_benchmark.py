@@ -0,0 +1,45 @@
+import pytest
+from benchmark import compare, run_size
+from data_initialiser import DataInitialiser, SyntheticData
+from library import LibraryService
+
+
+def test_synthetic_data_is_seeded(workdir):
+    first = [item.to_dict() for item in SyntheticData(seed=7).items(50, on_loan=5)]
+    assert first == [item.to_dict() for item in SyntheticData(seed=7).items(50, on_loan=5)]
+    assert first != [item.to_dict() for item in SyntheticData(seed=8).items(50, on_loan=5)]
+
+    service = LibraryService()
+    DataInitialiser.seed_synthetic(service, 50, loans=5, seed=7, chunk_size=20)
+    assert (service.members_repo.count(), service.items_repo.count()) == (50, 50)
+    # Every generated loan is for an item that is on loan
+    loans = [(row['item_id'], row['borrowed_by']) for row in service.ledger.table.rows()]
+    assert [item_id for item_id, _ in loans] == [f'B{n:07}' for n in range(5)]
+    assert service.items_repo.get('B0000004').status == 'on_loan'
+
+
+def test_borrow_and_return_without_prompting(workdir, monkeypatch):
+    service = LibraryService()
+    DataInitialiser.seed_synthetic(service, 10, loans=0)
+    monkeypatch.setattr('builtins.input', lambda _: pytest.fail('prompted'))
+
+    service.borrow_book('M0000001', 'B0000002')
+    assert service.ledger.items_for_member('M0000001') == ['B0000002']
+    service.return_book('B0000002', 'M0000001')
+    assert service.items_repo.get('B0000002').status == 'available'
+
+
+def test_run_size_reports_every_operation():
+    result = run_size(200, ops=20, slow_ops=2)
+    assert result['size'] == 200
+    borrow = result['operations']['library.borrow_book']
+    assert borrow['count'] == 20 and borrow['p50_ms'] <= borrow['p99_ms']
+    assert result['operations']['members.delete']['count'] == 2
+
+    # A report compared with itself shows no regressions; a slower one does
+    report = {'results': [result]}
+    assert compare(report, report) == []
+    slower = {'results': [dict(result, operations={'items.get': dict(
+        result['operations']['items.get'], p99_ms=result['operations']['items.get']['p99_ms'] * 2 + 1)})]}
+    regressions = compare(report, slower)
+    assert len(regressions) == 1 and regressions[0].startswith('items.get at 200 rows')
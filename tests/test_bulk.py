@@ -0,0 +1,61 @@
+import csv
+import pytest
+from bulk import BulkExporter, BulkLoader, validate_item, validate_member
+from items import Item, ItemsRepository
+from members import MembersRepository
+
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def test_import_validates_and_skips_duplicates(workdir):
+    repo = ItemsRepository()
+    repo.add(Item('B001', '1984', 'George Orwell'))
+    write_csv(workdir / 'source.csv', ['id', 'title', 'author', 'status'], [
+        ['B001', '1984', 'George Orwell', ''],      # Already stored
+        ['B002', 'Emma', 'Jane Austen', ''],
+        ['B003', '', 'Nobody', ''],                 # No title
+        ['B004', 'Dune', 'Frank Herbert', 'lost'],  # Unknown status
+        ['B005', 'Ulysses', 'James Joyce', 'on_loan'],
+        ['B002', 'Emma', 'Jane Austen', ''],        # Repeated in a later chunk
+    ])
+    progress = []
+
+    stats = BulkLoader(repo, validate_item, chunk_size=2,
+                       progress=lambda s: progress.append(s.rows_read)).load(workdir / 'source.csv')
+
+    assert (stats.rows_read, stats.rows_written, stats.rows_rejected, stats.rows_duplicate) == (6, 2, 2, 2)
+    assert stats.errors == [(3, 'missing title'), (4, "unknown status 'lost'")]
+    assert progress == [2, 4, 6]
+    assert repo.count() == 3
+    assert ItemsRepository().get('B005').status == 'on_loan'
+
+
+def test_export_round_trips_members(workdir):
+    write_csv(workdir / 'source.csv', ['id', 'name', 'membership_date'],
+              [[f'M{n:03}', f'Member {n}', '2024-01-10'] for n in range(7)] + [['M999', 'Late', '10/01/2024']])
+    repo = MembersRepository()
+    loaded = BulkLoader(repo, validate_member, chunk_size=3).load(workdir / 'source.csv')
+    assert loaded.rows_written == 7
+
+    exported = BulkExporter(repo, chunk_size=3).export(workdir / 'out.csv')
+
+    assert exported.rows_written == 7
+    rows = list(csv.DictReader(open(workdir / 'out.csv', encoding='utf-8')))
+    assert [r['id'] for r in rows] == [f'M{n:03}' for n in range(7)]
+
+
+def test_export_round_trips_items_in_every_status(workdir):
+    ItemsRepository().add_many([Item('B001', '1984', 'George Orwell'),
+                                Item('B002', 'Emma', 'Jane Austen', 'on_loan'),
+                                Item('B003', 'Persuasion', 'Jane Austen', 'on_hold')])
+    BulkExporter(ItemsRepository()).export(workdir / 'items_out.csv')
+
+    (workdir / 'csv').rename(workdir / 'old')
+    loaded = BulkLoader(ItemsRepository(), validate_item).load(workdir / 'items_out.csv')
+    assert (loaded.rows_written, loaded.rows_rejected) == (3, 0)
+    assert ItemsRepository().get('B003').status == 'on_hold'
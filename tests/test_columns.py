@@ -0,0 +1,39 @@
+from datetime import date
+import pytest
+from columns import ItemColumns, LoanColumns, Status
+from items import Item
+from library import LoanRecord
+
+
+def test_models_have_no_instance_dict():
+    item = Item('B001', '1984', 'George Orwell')
+    with pytest.raises(AttributeError):
+        item.colour = 'red'
+    # Repeated values share one string object
+    assert Item('B002', 'Animal Farm', ''.join(['George ', 'Orwell'])).author is item.author
+    assert LoanRecord('B001', 'M001', '2024-03-01').to_dict()['borrowed_by'] == 'M001'
+
+
+def test_item_columns_count_and_filter_by_status():
+    rows = [
+        {'id': 'B001', 'title': '1984', 'author': 'George Orwell', 'status': 'on_loan'},
+        {'id': 'B002', 'title': 'Animal Farm', 'author': 'George Orwell', 'status': 'available'},
+        {'id': 'B003', 'title': 'Emma', 'author': 'Jane Austen', 'status': 'on_loan'},
+    ]
+    columns = ItemColumns.from_rows(rows)
+
+    assert len(columns) == 3
+    assert columns.status_counts() == {Status.AVAILABLE: 1, Status.ON_LOAN: 2, Status.ON_HOLD: 0}
+    assert columns.ids_with_status(Status.ON_LOAN) == ['B001', 'B003']
+    assert columns.author_counts()['George Orwell'] == 2
+    assert columns.item(1).to_dict() == rows[1]
+
+
+def test_loan_columns_compare_dates_as_numbers():
+    rows = [LoanRecord('B001', 'M001', '2024-03-01').to_dict(),
+            LoanRecord('B002', 'M001', '2024-04-15').to_dict(),
+            LoanRecord('B003', 'M002', '2024-02-10').to_dict()]
+    columns = LoanColumns.from_rows(rows)
+
+    assert columns.loans_per_member() == {'M001': 2, 'M002': 1}
+    assert columns.borrowed_before(date(2024, 3, 2)) == [('B001', 'M001'), ('B003', 'M002')]
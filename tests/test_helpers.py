@@ -1,10 +1,11 @@
 import csv
 import pytest
-from members import Helper
+from members import Member, MembersRepository
 
 def test_add_and_list(tmp_path, capsys, monkeypatch):
     # 1. Set up temporary CSV file
-    file = tmp_path / 'members.csv'
+    (tmp_path / 'csv').mkdir()
+    file = tmp_path / 'csv' / 'members.csv'
     with open(file, 'w', newline='') as f:
         writer = csv.writer(f)
         writer.writerow(['id','name','membership_date'])
@@ -12,14 +13,15 @@ def test_add_and_list(tmp_path, capsys, monkeypatch):
     # 2. Change working directory to tmp_path
     monkeypatch.chdir(tmp_path)
 
-    # 3. Simulate user input for add_member()
+    # 3. Simulate user input for the 'Add member' menu option
     inputs = iter(['M100','TestUser','2025-05-15'])
     monkeypatch.setattr('builtins.input', lambda _: next(inputs))
-    Helper.add_member()
+    repo = MembersRepository()
+    repo.add(Member(input('ID: '), input('Name: '), input('Date (YYYY-MM-DD): ')))
 
-    # 4. Capture output from list_members()
-    Helper.list_members()
+    # 4. Capture output from list()
+    repo.list()
     captured = capsys.readouterr()
 
     # 5. Assert expected output
-    assert 'M100: TestUser (2025-05-15)' in captured.out
\ No newline at end of file
+    assert 'M100: TestUser (2025-05-15)' in captured.out
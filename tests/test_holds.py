@@ -0,0 +1,83 @@
+from datetime import date, timedelta
+import pytest
+import threading
+from holds import HoldQueue
+from items import Item
+from members import Member
+
+
+@pytest.fixture
+def service(stocked_service):
+    # Four members, so that a waitlist can form behind the one who has the book
+    service = stocked_service([Item('B001', '1984', 'George Orwell')],
+                              [Member(f'M00{n}', name, '2024-01-10')
+                               for n, name in enumerate(['Alice', 'Bob', 'Carol', 'Dan'], start=1)])
+    service.borrow_many([('B001', 'M001')])
+    return service
+
+
+def test_waitlist_is_first_come_first_served(service, capsys):
+    assert service.request_hold('B001', 'M002').message.endswith('(position 1).')
+    assert service.request_hold('B001', 'M003').message.endswith('(position 2).')
+    assert not service.request_hold('B001', 'M003').ok  # Already waiting
+    assert not service.request_hold('B001', 'M001').ok  # Already has it
+    notices = []
+    service.holds.listen(notices.append)
+
+    # The return sets the book aside for the first member in line
+    service.return_book('B001', 'M001')
+    assert service.items_repo.get('B001').status == 'on_hold'
+    assert [hold.member_id for hold in notices] == ['M002']
+    assert 'on hold for member M002' in capsys.readouterr().out
+    assert service.holds.waitlist('B001') == ['M003']
+
+    # Only that member can borrow it, after which their hold is gone
+    assert [r.ok for r in service.borrow_many([('B001', 'M004'), ('B001', 'M002')])] == [False, True]
+    assert service.holds.get('B001', 'M002') is None
+    service.return_many([('B001', 'M002')])
+    assert service.holds.ready_for('B001') == 'M003'
+
+
+def test_uncollected_hold_expires_to_next_member_then_shelf(service):
+    service.request_hold('B001', 'M002')
+    service.request_hold('B001', 'M003')
+    service.return_book('B001', 'M001')
+    later = date.today() + timedelta(days=HoldQueue.HOLD_DAYS + 1)
+
+    assert service.expire_holds(later) == 1
+    assert service.holds.ready_for('B001') == 'M003'
+    assert service.expire_holds(later) == 0  # The new hold runs until later + HOLD_DAYS
+    assert service.expire_holds(later + timedelta(days=HoldQueue.HOLD_DAYS + 1)) == 1
+    assert service.holds.ready_for('B001') is None
+    assert service.items_repo.get('B001').status == 'available'
+
+
+def test_housekeeping_expires_holds_nobody_borrows(service):
+    service.request_hold('B001', 'M002')
+    service.request_hold('B001', 'M003')
+    service.return_book('B001', 'M001')
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    service.holds.table.update(('B001', 'M002'), {'ready_until': yesterday})
+    passed_on = threading.Event()
+    service.holds.listen(lambda hold: passed_on.set())
+
+    service.start_housekeeping(0.01)
+    try:
+        assert passed_on.wait(5)
+    finally:
+        service.stop_housekeeping()
+    assert service.holds.ready_for('B001') == 'M003'
+
+
+def test_holds_survive_restart(service, open_service):
+    for member_id in ['M004', 'M002', 'M003']:
+        service.request_hold('B001', member_id)
+    service.return_book('B001', 'M001')
+
+    reopened = open_service()
+    assert reopened.holds.ready_for('B001') == 'M004'
+    assert reopened.holds.waitlist('B001') == ['M002', 'M003']
+    assert reopened.holds.position('B001', 'M003') == 2
+    assert service.cancel_hold('B001', 'M004')
+    # The other service's waitlist follows the table
+    assert reopened.holds.ready_for('B001') == 'M002'
@@ -0,0 +1,94 @@
+import pytest
+import threading
+from holds import Hold
+from integrity import IntegrityChecker
+from items import Item
+from library import LoanRecord
+from members import Member
+
+
+@pytest.fixture
+def service(stocked_service):
+    return stocked_service([Item(f'B00{n}', f'Book {n}', 'Author') for n in range(1, 7)])
+
+
+def test_check_finds_and_repair_fixes_every_kind(service):
+    service.borrow_many([('B001', 'M001'), ('B002', 'M001')])
+    loans, items = service.ledger.table, service.items_repo.table
+    # Crashes and careless edits, written straight to the tables
+    loans.append(LoanRecord('B003', 'M009', '2024-03-01').to_dict())  # Unknown member, item not on loan
+    loans.append(LoanRecord('B099', 'M001', '2024-03-01').to_dict())  # Unknown item
+    loans.append(LoanRecord('B004', 'M002', '2024-03-01').to_dict())  # Return cut short
+    items.update('B005', {'status': 'on_loan'})                        # Borrow cut short
+    items.update('B006', {'status': 'on_hold'})                        # Set aside for nobody
+    service.holds.table.append(Hold('B002', 'M009', '2024-03-01').to_dict())
+    loans.append(LoanRecord('B002', 'M002', '2024-03-01').to_dict())  # Lent twice
+
+    checker = IntegrityChecker(service)
+    problems = checker.check()
+    assert sorted(p.kind for p in problems) == [
+        'hold_without_member', 'item_lent_twice', 'item_on_hold_without_hold', 'item_on_loan_without_loan',
+        'loan_of_item_not_on_loan', 'loan_of_item_not_on_loan', 'loan_without_item', 'loan_without_member']
+
+    fixed = checker.repair(problems)
+    assert len(fixed) == 7
+    assert [p.kind for p in checker.check()] == ['item_lent_twice']  # Left for a person
+    assert service.items_repo.get('B005').status == 'available'
+    assert service.items_repo.get('B006').status == 'available'
+    assert service.ledger.get('B004', 'M002') is None
+    assert service.ledger.get('B001', 'M001') is not None
+
+
+def test_guards_refuse_delete_and_borrow(service, capsys):
+    service.borrow_many([('B001', 'M001')])
+    service.members_repo.delete('M001')
+    assert 'still has 1 book(s) on loan' in capsys.readouterr().out
+    assert service.members_repo.get('M001') is not None
+
+    # A loan left behind by a return cut short keeps the item from being lent again
+    service.ledger.add(LoanRecord('B002', 'M001', '2024-03-01'))
+    assert not service.borrow_many([('B002', 'M002')])[0].ok
+
+    service.return_many([('B001', 'M001')])
+    service.ledger.remove('B002', 'M001')
+    service.members_repo.delete('M001')
+    assert service.members_repo.get('M001') is None
+
+
+def test_repair_keeps_other_writers_out_until_done(service):
+    service.items_repo.table.update('B005', {'status': 'on_loan'})  # Borrow cut short
+    checker = IntegrityChecker(service)
+    repair = checker._repair
+    writer = threading.Thread(target=service.borrow_many, args=([('B003', 'M001')],))
+
+    def repair_while_a_desk_borrows(problems):
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()  # Waiting for the repair's locks
+        assert service.ledger.get('B003', 'M001') is None
+        return repair(problems)
+    checker._repair = repair_while_a_desk_borrows
+
+    assert [p.kind for p in checker.repair()] == ['item_on_loan_without_loan']
+    writer.join()
+    assert service.ledger.get('B003', 'M001') is not None
+    assert checker.check() == []
+
+
+def test_repair_skips_problems_fixed_since_the_check(service):
+    loans, items = service.ledger.table, service.items_repo.table
+    loans.append(LoanRecord('B001', 'M003', '2024-03-01').to_dict())  # Unknown member
+    service.holds.table.append(Hold('B002', 'M003', '2024-03-01').to_dict())
+    items.update('B003', {'status': 'on_hold'})                        # Set aside for nobody
+    checker = IntegrityChecker(service)
+    problems = checker.check()
+    assert len(problems) == 4
+
+    # A desk sorts everything out before the repair runs
+    service.members_repo.add(Member('M003', 'Carol', '2024-03-01'))
+    items.update('B001', {'status': 'on_loan'})
+    items.update('B003', {'status': 'available'})
+
+    assert checker.repair(problems) == []
+    assert service.ledger.get('B001', 'M003') is not None
+    assert service.holds.get('B002', 'M003') is not None
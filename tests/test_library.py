@@ -0,0 +1,71 @@
+import pytest
+from items import Item
+from members import Member
+from library import LibraryService
+
+
+@pytest.fixture
+def service(workdir):
+    service = LibraryService()
+    service.members_repo.add(Member('M001', 'Alice', '2024-01-10'))
+    service.members_repo.add(Member('M002', 'Bob', '2024-02-12'))
+    service.items_repo.add(Item('B001', '1984', 'George Orwell'))
+    service.items_repo.add(Item('B002', 'Emma', 'Jane Austen'))
+    return service
+
+
+def answer(monkeypatch, *replies):
+    # Feed the given replies to input() prompts in order
+    replies = iter(replies)
+    monkeypatch.setattr('builtins.input', lambda _: next(replies))
+
+
+def test_borrow_and_return_keep_member_index(service, monkeypatch, tmp_path):
+    answer(monkeypatch, 'M001', 'B001', 'M001', 'B002')
+    service.borrow_book()
+    service.borrow_book()
+    assert sorted(service.ledger.items_for_member('M001')) == ['B001', 'B002']
+    assert service.ledger.items_for_member('M002') == []
+
+    answer(monkeypatch, 'B001', 'M001')
+    service.return_book()
+    assert service.ledger.items_for_member('M001') == ['B002']
+    assert service.items_repo.get('B001').status == 'available'
+
+    # The return is a tombstone line in the journal until compaction
+    journal = (tmp_path / 'csv' / 'library.journal.csv').read_text().splitlines()
+    assert journal[-1].startswith('del,B001,M001,')
+    service.ledger.compact()
+    loans = (tmp_path / 'csv' / 'library.csv').read_text().splitlines()
+    assert [line.split(',')[:2] for line in loans[1:]] == [['B002', 'M001']]
+
+
+def test_return_by_wrong_member_is_rejected(service, monkeypatch, capsys):
+    answer(monkeypatch, 'M001', 'B001', 'B001', 'M002')
+    service.borrow_book()
+    service.return_book()
+
+    assert 'Loan record not found.' in capsys.readouterr().out
+    assert service.items_repo.get('B001').status == 'on_loan'
+    # A fresh service reading the files sees the same loan
+    assert LibraryService().ledger.items_for_member('M001') == ['B001']
+
+
+def test_borrow_many_and_return_many(service, tmp_path):
+    journal = tmp_path / 'csv' / 'library.journal.csv'
+    before = len(journal.read_text().splitlines())
+
+    results = service.borrow_many([('B001', 'M001'), ('B002', 'M002'),
+                                   ('B001', 'M002'), ('B009', 'M001'), ('B002', 'M009')])
+    assert [r.ok for r in results] == [True, True, False, False, False]
+    assert [r.message for r in results[2:]] == ['Book is not available.', 'Book not found.',
+                                                'Member not found.']
+    assert len(journal.read_text().splitlines()) == before + 2
+    assert service.items_repo.get('B002').status == 'on_loan'
+
+    results = service.return_many([('B001', 'M002'), ('B001', 'M001'), ('B001', 'M001')])
+    assert [r.to_dict()['message'] for r in results] == [
+        'Loan record not found.', 'Book B001 returned by member M001.', 'Book is already available.']
+    assert service.items_repo.get('B001').status == 'available'
+    assert service.ledger.items_for_member('M001') == []
+    assert service.ledger.items_for_member('M002') == ['B002']
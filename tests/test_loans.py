@@ -0,0 +1,74 @@
+import csv
+import sqlite3
+from datetime import date, timedelta
+import pytest
+from items import Item
+from library import LoanLedger, LoanRecord
+from storage import CsvStorage, SqliteStorage
+
+
+@pytest.fixture
+def service(stocked_service):
+    return stocked_service([Item(f'B00{n}', f'Book {n}', 'Author') for n in range(1, 5)])
+
+
+def test_find_overdue_returns_loans_past_due_earliest_first(service, open_service):
+    service.ledger.add_many([LoanRecord('B001', 'M001', '2024-03-10'),
+                             LoanRecord('B002', 'M002', '2024-03-01'),
+                             LoanRecord('B003', 'M001', '2024-04-01')])
+    assert service.find_overdue(date(2024, 3, 15)) == []
+    assert [r.item_id for r in service.find_overdue(date(2024, 3, 25))] == ['B002', 'B001']
+
+    # The index follows new loans and returns without being rebuilt
+    service.ledger.add(LoanRecord('B004', 'M002', '2024-02-01'))
+    service.ledger.remove('B001', 'M001')
+    overdue = service.find_overdue(date(2024, 3, 25))
+    assert [(r.item_id, r.due_date) for r in overdue] == [('B004', '2024-02-15'), ('B002', '2024-03-15')]
+    assert len(service.ledger.due) == 3
+
+    # Another process sees the same loans
+    assert [r.item_id for r in open_service().find_overdue(date(2025, 1, 1))] == ['B004', 'B002', 'B003']
+
+
+def test_renewals_move_due_date_up_to_the_limit(service):
+    today = date.today()
+    service.borrow_many([('B001', 'M001')])
+    due = (today + timedelta(days=LoanRecord.LOAN_DAYS)).isoformat()
+    assert service.ledger.get('B001', 'M001').due_date == due
+
+    result = service.renew_loan('B001', 'M001')
+    # Renewing before the due date extends from the due date, not from today
+    renewed = (today + timedelta(days=2 * LoanRecord.LOAN_DAYS)).isoformat()
+    assert (result.ok, result.message) == (True, f"Loan of book B001 to member M001 renewed until {renewed}.")
+    assert service.ledger.get('B001', 'M001').renewals == 1
+    assert service.renew_loan('B001', 'M001').ok
+    assert not service.renew_loan('B001', 'M001').ok  # MAX_RENEWALS reached
+    assert service.renew_loan('B002', 'M001').message == "Loan record not found."
+
+    # Nobody can renew a book other members are waiting for
+    service.borrow_many([('B002', 'M001')])
+    service.request_hold('B002', 'M002')
+    assert service.renew_loan('B002', 'M001').message == "Other members are waiting for this book."
+    assert service.find_overdue(today + timedelta(days=LoanRecord.LOAN_DAYS + 1))[0].item_id == 'B002'
+
+
+def test_old_loans_table_gets_due_dates(workdir):
+    (workdir / 'csv').mkdir()
+    with open('csv/library.csv', 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows([['item_id', 'borrowed_by', 'loan_date'], ['B001', 'M001', '2024-03-01']])
+    with open('csv/library.journal.csv', 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows([['op', 'item_id', 'borrowed_by', 'loan_date'],
+                                 ['put', 'B002', 'M001', '2024-03-05'], ['del', 'B001', 'M001', '']])
+    conn = sqlite3.connect('csv/library.db')
+    with conn:
+        conn.execute('CREATE TABLE library (item_id TEXT, borrowed_by TEXT, loan_date TEXT, '
+                     'PRIMARY KEY (item_id, borrowed_by))')
+        conn.execute("INSERT INTO library VALUES ('B003', 'M002', '2024-03-02')")
+    conn.close()
+
+    ledger = LoanLedger(CsvStorage())
+    assert ledger.get('B001', 'M001') is None  # The journaled return still applies
+    assert (ledger.get('B002', 'M001').due_date, ledger.get('B002', 'M001').renewals) == ('2024-03-19', 0)
+    with open('csv/library.csv', newline='', encoding='utf-8') as f:
+        assert next(csv.reader(f)) == LoanLedger.FIELDNAMES
+    assert LoanLedger(SqliteStorage()).get('B003', 'M002').due_date == '2024-03-16'
@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import metrics
+from members import Member, MembersRepository
+from metrics import Metrics
+from storage import CsvStorage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_timers_and_dumps():
+    registry = Metrics(enabled=True, profiled=['double'], profile_every=1)
+    double = registry.wrap('double', lambda x: x * 2)
+    assert [double(n) for n in range(3)] == [0, 2, 4]
+    registry.add('bytes_written', 'items.csv', 100)
+    registry.add('index_hits', 'items', 3)
+    registry.add('index_reloads', 'items')
+
+    stats = registry.to_dict()
+    assert stats['operations']['double']['count'] == 3
+    assert stats['counters'] == {'bytes_written': {'items.csv': 100}, 'index_hits': {'items': 3},
+                                 'index_reloads': {'items': 1}}
+    assert stats['index_hit_rate'] == {'items': 0.75}
+    text = registry.to_prometheus()
+    assert 'library_operation_seconds_count{operation="double"} 3' in text
+    assert 'library_operation_seconds_bucket{operation="double",le="+Inf"} 3' in text
+    assert 'library_bytes_written_total{source="items.csv"} 100' in text
+    assert 'function calls' in registry.profile_report('double')
+
+
+def test_disabled_leaves_methods_alone(monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', False)
+    function = lambda: None
+    assert metrics.timed('nothing')(function) is function
+
+
+def test_storage_counters(workdir, monkeypatch):
+    monkeypatch.setattr(metrics.REGISTRY, 'enabled', True)
+    monkeypatch.setattr(metrics.REGISTRY, 'counters', {})
+    repo = MembersRepository(CsvStorage(snapshots=False))
+    repo.add(Member('M001', 'Alice', '2024-01-10'))
+    repo.get('M001')
+    MembersRepository(CsvStorage(snapshots=False)).get('M001')
+
+    counters = metrics.REGISTRY.to_dict()['counters']
+    assert counters['bytes_written']['members.csv'] > 0
+    assert counters['rows_read']['members'] == 1  # Only the second repository parsed a row
+    assert counters['index_hits']['members'] >= 1
+
+
+def test_environment_switch_times_operations(tmp_path):
+    # LIBRARY_METRICS is read at import time, so this runs in a fresh interpreter
+    script = ("from library import LibraryService; from data_initialiser import DataInitialiser; "
+              "import metrics; service = LibraryService(); "
+              "DataInitialiser.seed_members(service.members_repo); DataInitialiser.seed_items(service.items_repo); "
+              "service.borrow_book('M001', 'B001'); print(metrics.REGISTRY.to_json())")
+    env = dict(os.environ, LIBRARY_METRICS='1', PYTHONPATH=ROOT, LIBRARY_STORAGE='csv')
+    out = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    stats = json.loads(out[out.index('{'):])
+    assert stats['operations']['library.borrow_book']['count'] == 1
+    assert stats['operations']['items.update']['count'] == 1
+    assert stats['counters']['bytes_written']['library.csv'] > 0
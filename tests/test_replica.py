@@ -0,0 +1,98 @@
+import pytest
+from feed import ChangeFeed
+from items import Item
+from library import LibraryService
+from members import Member
+from replica import Replica
+from storage import CsvStorage, open_storage
+
+
+@pytest.fixture
+def service(workdir):
+    service = LibraryService(CsvStorage(feed=ChangeFeed()))
+    service.members_repo.add_many([Member('M001', 'Alice', '2024-01-10'), Member('M002', 'Bob', '2024-02-12')])
+    service.items_repo.add_many([Item(f'B00{n}', f'Book {n}', 'Author') for n in range(1, 6)])
+    return service
+
+
+def test_feed_numbers_every_change_and_reads_from_any_point(service):
+    service.borrow_book('M001', 'B001')
+    service.return_book('B001', 'M001')
+    service.members_repo.delete('M002')
+    feed = ChangeFeed()
+    changes = feed.read()
+    assert [c.seq for c in changes] == list(range(1, 14)) and feed.last_seq() == 13
+    assert [(c.table, c.op) for c in changes[7:]] == [
+        ('items', 'put'), ('library', 'put'), ('borrow_counts', 'put'), ('items', 'put'), ('library', 'del'),
+        ('members', 'del')]
+    assert changes[8].key == ('B001', 'M001') and changes[10].row['status'] == 'available'
+    for after in range(14):
+        assert [c.seq for c in feed.read(after, limit=3)] == list(range(after + 1, min(after + 4, 14)))
+
+    # A line cut short by a crashed writer is skipped, and numbering carries on
+    with open(feed.path, 'ab') as f:
+        f.write(b'{"seq":14,"tab')
+    assert feed.last_seq() == 13 and feed.read(13) == []
+    service.items_repo.add(Item('B009', 'Book 9', 'Author'))
+    assert [c.seq for c in feed.read(12)] == [13, 14] and feed.read(13)[0].key == 'B009'
+
+
+def test_replica_catches_up_and_resumes(service, tmp_path):
+    replica = Replica(ChangeFeed())
+    assert replica.catch_up() == 7
+    service.borrow_many([('B001', 'M001'), ('B002', 'M002')])
+    service.return_many([('B002', 'M002')])
+    service.items_repo.table.update('B003', {'title': 'Renamed'})
+    assert replica.catch_up() == 9 and replica.position == 16
+    replica.stop()
+
+    # Readers in another process open the copy without touching csv/
+    reader = LibraryService(CsvStorage('replica'))
+    assert reader.items_repo.get('B003').title == 'Renamed'
+    assert reader.ledger.items_for_member('M001') == ['B001']
+    assert reader.items_repo.get('B002').status == 'available'
+
+    # A restarted replica carries on from its saved position
+    service.members_repo.delete('M002')
+    restarted = Replica(ChangeFeed())
+    assert restarted.position == 16 and restarted.catch_up() == 1
+    assert restarted.service.members_repo.get('M002') is None
+
+
+def test_bootstrap_copies_data_from_before_the_feed(workdir):
+    LibraryService(CsvStorage()).items_repo.add(Item('B001', 'Old book', 'Author'))
+    service = LibraryService(CsvStorage(feed=ChangeFeed()))
+    service.items_repo.add(Item('B002', 'New book', 'Author'))
+
+    replica = Replica(ChangeFeed())
+    replica.bootstrap(CsvStorage())
+    assert replica.catch_up() == 0
+    assert sorted(row['id'] for row in replica.service.items_repo.table.rows()) == ['B001', 'B002']
+
+
+def test_changes_a_crash_kept_from_the_feed_are_published_later(service, monkeypatch):
+    feed = ChangeFeed()
+    published = feed.last_seq()
+
+    # The writer dies after writing the item, before publishing it
+    def crash(self, table, changes):
+        raise SystemExit('killed')
+    with monkeypatch.context() as patched, pytest.raises(SystemExit):
+        patched.setattr(ChangeFeed, 'publish', crash)
+        service.items_repo.table.update('B001', {'status': 'on_loan'})
+    # ... and another one before writing anything
+    with open('csv/members.csv.outbox', 'w', encoding='utf-8') as f:
+        f.write('["put",{"id":"M009","name":"Nobody","membership_date":"2024-01-01"}]\n')
+
+    # The next process to open the tables publishes what reached them
+    LibraryService(CsvStorage(feed=ChangeFeed()))
+    changes = feed.read(published)
+    assert [(c.table, c.key, c.row['status']) for c in changes] == [('items', 'B001', 'on_loan')]
+    assert LibraryService(CsvStorage()).members_repo.get('M009') is None
+
+
+def test_feed_cannot_be_used_with_sqlite(monkeypatch):
+    monkeypatch.setenv('LIBRARY_STORAGE', 'sqlite')
+    monkeypatch.setenv('LIBRARY_FEED', '1')
+    with pytest.raises(ValueError):
+        open_storage()
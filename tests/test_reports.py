@@ -0,0 +1,74 @@
+from datetime import date
+import pytest
+from items import Item
+from library import LoanRecord
+from reports import LibraryReports
+
+
+@pytest.fixture
+def service(stocked_service):
+    return stocked_service([Item('B001', '1984', 'George Orwell'),
+                            Item('B002', '1984', 'George Orwell'),
+                            Item('B003', 'Emma', 'Jane Austen')])
+
+
+def test_counts_follow_borrows_and_returns(service, capsys):
+    reports = LibraryReports(service)
+    assert reports.items_on_loan() == 0
+
+    service.borrow_many([('B001', 'M001'), ('B002', 'M002'), ('B003', 'M001')])
+    service.return_book('B003', 'M001')
+    assert reports.items_on_loan() == 2
+    assert reports.most_on_loan(1) == [('1984', 2)]
+    assert dict(reports.busiest_members()) == {'M001': 1, 'M002': 1}
+    assert reports.to_dict()['active_loans'] == 2
+
+    # A renamed item takes its loan to the new title
+    service.items_repo.table.update('B002', {'title': 'Nineteen Eighty-Four'})
+    assert dict(reports.most_on_loan()) == {'1984': 1, 'Nineteen Eighty-Four': 1}
+
+    # The incremental counts match a rebuild from scratch (ties may come in another order)
+    def counts():
+        return {name: dict(value) if isinstance(value, list) else value
+                for name, value in reports.to_dict().items()}
+    incremental = counts()
+    reports.recompute()
+    assert counts() == incremental
+
+
+def test_most_borrowed_counts_returned_loans_across_restarts(service, open_service):
+    reports = LibraryReports(service)
+    for member_id in ['M001', 'M002', 'M001']:
+        service.borrow_many([('B003', member_id)])
+        service.return_many([('B003', member_id)])
+    service.borrow_many([('B001', 'M001'), ('B002', 'M002')])
+    assert reports.most_borrowed() == [('Emma', 3), ('1984', 2)]
+    assert not service.borrow_many([('B001', 'M002')])[0].ok  # A refused borrow is not counted
+    assert reports.most_borrowed(1) == [('Emma', 3)]
+
+    # Counted in the borrow_counts table, so another process (or a restart) sees them too
+    reopened = LibraryReports(open_service())
+    assert reopened.most_borrowed() == [('Emma', 3), ('1984', 2)]
+    service.borrow_many([('B003', 'M002')])
+    assert reopened.most_borrowed(1) == [('Emma', 4)]
+
+
+def test_overdue_counts_loans_by_date(service):
+    service.ledger.add_many([LoanRecord('B001', 'M001', '2024-03-01'),
+                             LoanRecord('B002', 'M002', '2024-03-20')])
+    reports = LibraryReports(service)
+    assert reports.overdue(date(2024, 3, 25)) == 1
+    assert reports.overdue(date(2024, 4, 30)) == 2
+    service.ledger.remove('B001', 'M001')
+    assert reports.overdue(date(2024, 4, 30)) == 1
+    assert reports.member_activity('M002') == 1
+
+
+def test_changes_made_elsewhere_are_picked_up(service, open_service):
+    reports = LibraryReports(service)
+    assert reports.items_on_loan() == 0
+    # A second front desk borrows a book through its own tables
+    other = open_service()
+    other.borrow_book('M001', 'B003')
+    assert reports.items_on_loan() == 1
+    assert reports.member_activity('M001') == 1
@@ -0,0 +1,76 @@
+import pytest
+from items import Item, ItemsRepository
+from search import SearchIndex, tokenize
+from storage import SqliteStorage
+
+
+@pytest.fixture
+def repo(workdir):
+    repo = ItemsRepository()
+    repo.add_many([
+        Item('B001', '1984', 'George Orwell'),
+        Item('B002', 'To Kill a Mockingbird', 'Harper Lee'),
+        Item('B003', 'Les Misérables', 'Victor Hugo'),
+        Item('B004', 'Animal Farm', 'George Orwell'),
+        Item('B005', 'George', 'Alex Gino'),
+    ])
+    return repo
+
+
+def test_tokenize_ignores_case_and_accents():
+    assert tokenize('Les MISÉRABLES, Émile!') == ['les', 'miserables', 'emile']
+
+
+def test_prefix_and_accent_insensitive_search(repo):
+    assert [i.id for i in repo.search('mock')] == ['B002']
+    assert [i.id for i in repo.search('miserables')] == ['B003']
+    assert [i.id for i in repo.search('orwell farm')] == ['B004']
+    assert repo.search('orwell dickens') == []
+
+
+def test_title_matches_rank_above_author_matches(repo):
+    assert [i.id for i in repo.search('george')] == ['B005', 'B001', 'B004']
+    assert [i.id for i in repo.search('george', limit=1)] == ['B005']
+
+
+def test_index_follows_add_update_and_other_writers(repo):
+    assert repo.search('dune') == []
+    repo.add(Item('B006', 'Dune', 'Frank Herbert'))
+    assert [i.id for i in repo.search('dun')] == ['B006']
+
+    # Another repository (e.g. another process) lends a book: status is current
+    other = ItemsRepository()
+    item = other.get('B006')
+    item.status = 'on_loan'
+    other.update(item)
+    assert repo.search('dune')[0].status == 'on_loan'
+
+    other.add(Item('B007', 'Dune Messiah', 'Frank Herbert'))
+    assert [i.id for i in repo.search('dune')] == ['B006', 'B007']
+
+
+def test_rebuild_keeps_items_added_while_it_reads(repo, monkeypatch):
+    # Another thread adds an item after the rebuild has read the table
+    read_rows = repo.table.iter_rows
+    def iter_rows():
+        yield from read_rows()
+        if not repo.get('B006'):
+            repo.add(Item('B006', 'Dune', 'Frank Herbert'))
+    monkeypatch.setattr(repo.table, 'iter_rows', iter_rows)
+    assert [i.id for i in repo.search('dune')] == ['B006']
+
+
+def test_search_on_sqlite_storage(tmp_path):
+    repo = ItemsRepository(SqliteStorage(str(tmp_path / 'library.db')))
+    repo.add(Item('B001', 'Émile', 'Jean-Jacques Rousseau'))
+    assert [i.id for i in repo.search('emile')] == ['B001']
+    repo.add(Item('B002', 'The Social Contract', 'Jean-Jacques Rousseau'))
+    assert [i.id for i in repo.search('rousseau')] == ['B001', 'B002']
+
+
+def test_remove_drops_unused_words():
+    index = SearchIndex()
+    index.add('B001', 'Dune', 'Frank Herbert')
+    index.remove('B001')
+    assert index.search('dune') == []
+    assert len(index) == 0
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import pytest
+import threading
+from items import Item, ItemsRepository
+from server import LibraryServer
+from storage import CsvStorage, SqliteStorage
+
+
+async def request(port, method, path, body=None):
+    # Send one request on a new connection and return (status, JSON body)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode() if body is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(data)}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+
+def serve(service, scenario):
+    # Start a server on a free port, run the scenario against it, then stop
+    async def main():
+        server = LibraryServer(service, workers=4)
+        listener = await server.start('127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            return await scenario(port)
+        finally:
+            listener.close()
+            await listener.wait_closed()
+            server.close()
+    return asyncio.run(main())
+
+
+@pytest.fixture
+def service(stocked_service):
+    return stocked_service([Item('B001', '1984', 'George Orwell'),
+                            Item('B002', 'To Kill a Mockingbird', 'Harper Lee')])
+
+
+def test_get_search_and_list(service):
+    async def scenario(port):
+        assert await request(port, 'GET', '/items/B001') == (
+            200, {'id': 'B001', 'title': '1984', 'author': 'George Orwell', 'status': 'available'})
+        assert (await request(port, 'GET', '/members/M009'))[0] == 404
+        status, found = await request(port, 'GET', '/items?q=mock')
+        assert [item['id'] for item in found] == ['B002']
+        status, page = await request(port, 'GET', '/members?limit=1')
+        assert [member['id'] for member in page['records']] == ['M001']
+        status, page = await request(port, 'GET', f"/members?limit=1&after={page['next']}")
+        assert [member['id'] for member in page['records']] == ['M002']
+        status, page = await request(port, 'GET', '/items?status=on_loan')
+        assert page == {'records': [], 'next': None}
+        assert (await request(port, 'DELETE', '/items/B001'))[0] == 405
+        assert (await request(port, 'POST', '/borrow', {'item_id': 'B001'}))[0] == 400
+        status, stats = await request(port, 'GET', '/stats')
+        assert stats['items_by_status'] == {'available': 2} and stats['active_loans'] == 0
+        status, dump = await request(port, 'GET', '/metrics?format=json')
+        assert status == 200 and set(dump) == {'operations', 'counters', 'index_hit_rate'}
+        assert (await request(port, 'POST', '/renew', {'item_id': 'B001', 'member_id': 'M001'}))[0] == 404
+        assert (await request(port, 'GET', '/overdue?as_of=soon'))[0] == 400
+        await request(port, 'POST', '/borrow', {'item_id': 'B002', 'member_id': 'M002'})
+        status, renewed = await request(port, 'POST', '/renew', {'item_id': 'B002', 'member_id': 'M002'})
+        assert status == 200 and renewed['ok']
+        status, overdue = await request(port, 'GET', '/overdue?as_of=2999-01-01')
+        assert overdue['total'] == 1 and overdue['records'][0]['renewals'] == '1'
+    serve(service, scenario)
+
+
+def test_concurrent_borrows_of_one_item_succeed_once(service):
+    async def scenario(port):
+        borrows = [request(port, 'POST', '/borrow', {'item_id': 'B001', 'member_id': member_id})
+                   for member_id in ['M001', 'M002'] * 10]
+        statuses = [status for status, _ in await asyncio.gather(*borrows)]
+        assert sorted(statuses) == [200] + [409] * 19
+
+        status, loaned = await request(port, 'GET', '/items/B001')
+        assert loaned['status'] == 'on_loan'
+        winner = 'M001' if service.ledger.get('B001', 'M001') else 'M002'
+        assert (await request(port, 'POST', '/return', {'item_id': 'B001', 'member_id': winner}))[0] == 200
+        assert (await request(port, 'POST', '/borrow', {'item_id': 'B001', 'member_id': 'M002'}))[0] == 200
+        # M001 joins the waitlist and gets the book set aside when M002 returns it
+        assert (await request(port, 'POST', '/holds', {'item_id': 'B001', 'member_id': 'M001'}))[0] == 200
+        assert (await request(port, 'POST', '/return', {'item_id': 'B001', 'member_id': 'M002'}))[0] == 200
+        assert await request(port, 'GET', '/holds/B001') == (200, {'ready_for': 'M001', 'waiting': []})
+        assert (await request(port, 'POST', '/borrow', {'item_id': 'B001', 'member_id': 'M002'}))[0] == 409
+        assert (await request(port, 'POST', '/borrow', {'item_id': 'B001', 'member_id': 'M001'}))[0] == 200
+    serve(service, scenario)
+    assert service.ledger.items_for_member('M001') == ['B001']
+
+
+def test_lookups_leave_file_checks_to_the_pool(service):
+    table = service.items_repo.table
+    threads = []
+    refresh = table.refresh
+
+    def recording_refresh():
+        threads.append(threading.current_thread())
+        refresh()
+    table.refresh = recording_refresh
+
+    async def scenario(port):
+        # Another process changes an item behind the server's back
+        other = ItemsRepository(CsvStorage() if table.IN_MEMORY else SqliteStorage())
+        other.update(Item('B001', '1984', 'George Orwell', 'on_loan'))
+        for _ in range(50):
+            status, item = await request(port, 'GET', '/items/B001')
+            if item['status'] == 'on_loan':
+                break
+            await asyncio.sleep(0.01)
+        assert item['status'] == 'on_loan'
+        assert threads and threading.current_thread() not in threads  # Never on the event loop
+    serve(service, scenario)
@@ -0,0 +1,360 @@
+import csv
+import os
+import pytest
+import threading
+from items import Item, ItemsRepository
+from members import Member, MembersRepository
+from library import LibraryService, LoanRecord
+from migrate import migrate
+from storage import ConflictError, CsvStorage, CsvTable, SqliteStorage, Table
+
+
+def test_get_uses_index_after_own_writes(workdir):
+    repo = ItemsRepository()
+    repo.add(Item('B001', '1984', 'George Orwell'))
+    repo.add(Item('B002', 'Emma', 'Jane Austen'))
+
+    item = repo.get('B002')
+    assert (item.title, item.status) == ('Emma', 'available')
+
+    item.status = 'on_loan'
+    repo.update(item)
+    assert repo.get('B002').status == 'on_loan'
+    assert repo.get('B003') is None
+
+
+def test_index_rebuilt_when_file_changes_elsewhere(workdir):
+    repo = MembersRepository()
+    repo.add(Member('M001', 'Alice', '2024-01-10'))
+    assert repo.get('M002') is None
+
+    # Another writer appends directly to the CSV file
+    with open(workdir / 'csv' / 'members.csv', 'a', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(['M002', 'Bob', '2024-02-12'])
+
+    assert repo.get('M002').name == 'Bob'
+
+
+def test_same_size_rewrite_within_one_mtime_tick_is_noticed(workdir):
+    repo = MembersRepository()
+    repo.add(Member('M001', 'Alice', '2024-01-10'))
+    repo.checkpoint()
+    path = workdir / 'csv' / 'members.csv'
+    st = os.stat(path)
+    assert repo.get('M001').name == 'Alice'
+
+    # Another process renames a rewrite of the same size over the file, and
+    # the clock has not moved on
+    replacement = workdir / 'members.new'
+    replacement.write_bytes(path.read_bytes().replace(b'Alice', b'Alize'))
+    os.utime(replacement, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(replacement, path)
+
+    assert repo.get('M001').name == 'Alize'
+    assert MembersRepository().get('M001').name == 'Alize'  # Not from the stale snapshot
+
+
+def test_two_repositories_see_each_others_changes(workdir):
+    first = MembersRepository()
+    second = MembersRepository()
+    first.add(Member('M001', 'Alice', '2024-01-10'))
+    assert second.get('M001').name == 'Alice'
+
+    second.delete('M001')
+    assert first.get('M001') is None
+
+
+def test_status_updates_go_to_journal_until_checkpoint(workdir):
+    repo = ItemsRepository()
+    repo.add(Item('B001', '1984', 'George Orwell'))
+    repo.checkpoint()
+    items_csv = (workdir / 'csv' / 'items.csv').read_text()
+
+    item = repo.get('B001')
+    item.status = 'on_loan'
+    repo.update(item)
+
+    # The CSV file is untouched; the change is one journal line
+    assert (workdir / 'csv' / 'items.csv').read_text() == items_csv
+    journal = (workdir / 'csv' / 'items.journal.csv').read_text().splitlines()
+    assert journal[1:] == ['put,B001,1984,George Orwell,on_loan']
+    # Other readers merge the journal on read
+    assert ItemsRepository().get('B001').status == 'on_loan'
+
+    repo.checkpoint()
+    assert 'B001,1984,George Orwell,on_loan' in (workdir / 'csv' / 'items.csv').read_text()
+    assert len((workdir / 'csv' / 'items.journal.csv').read_text().splitlines()) == 1
+    assert ItemsRepository().get('B001').status == 'on_loan'
+
+
+def test_partial_journal_line_is_ignored(workdir):
+    repo = ItemsRepository()
+    repo.add(Item('B001', '1984', 'George Orwell'))
+    # A writer died half way through appending a line
+    with open(workdir / 'csv' / 'items.journal.csv', 'a', encoding='utf-8') as f:
+        f.write('put,B001,1984,George Orw')
+
+    assert ItemsRepository().get('B001').status == 'available'
+
+    # The next writer starts on a fresh line and the broken one is skipped
+    item = repo.get('B001')
+    item.status = 'on_loan'
+    repo.update(item)
+    assert ItemsRepository().get('B001').status == 'on_loan'
+
+
+def test_partial_line_with_every_field_is_not_replayed(workdir):
+    repo = ItemsRepository()
+    repo.add_many([Item('B001', '1984', 'George Orwell'), Item('B002', 'Emma', 'Jane Austen')])
+    repo.update(Item('B001', '1984', 'George Orwell', 'on_loan'))
+    # Cut short part way through the last field, so it still has five fields
+    with open(workdir / 'csv' / 'items.journal.csv', 'a', encoding='utf-8') as f:
+        f.write('put,B001,1984,George Orwell,availa')
+
+    # A write from another repository drops the broken line instead of finishing it
+    ItemsRepository().update(Item('B002', 'Emma', 'Jane Austen', 'on_loan'))
+    assert ItemsRepository().get('B001').status == 'on_loan'
+    assert 'put,B001,1984,George Orwell,availa' not in (workdir / 'csv' / 'items.journal.csv').read_text().splitlines()
+
+
+def test_checkpoint_triggered_by_threshold(workdir, monkeypatch):
+    monkeypatch.setattr(ItemsRepository, 'CHECKPOINT_EVERY', 3)
+    repo = ItemsRepository()
+    for n in range(3):
+        repo.add(Item(f'B00{n}', f'Title {n}', 'Author'))
+
+    rows = list(csv.DictReader(open(workdir / 'csv' / 'items.csv', encoding='utf-8')))
+    assert [r['id'] for r in rows] == ['B000', 'B001', 'B002']
+
+
+def test_append_skips_stored_keys_whatever_the_journal_holds(workdir):
+    table = ItemsRepository().table
+    table.append_many([{'id': 'B001', 'title': '1984', 'author': 'George Orwell', 'status': 'available'}])
+    for pending in (False, True):
+        if pending:
+            table.update('B001', {'status': 'on_loan'})
+        else:
+            table.checkpoint()
+        table.append_many([{'id': 'B001', 'title': 'Other', 'author': 'Someone', 'status': 'available'},
+                           {'id': f'B00{2 + pending}', 'title': 'Emma', 'author': 'Jane Austen',
+                            'status': 'available'}])
+        assert table.get('B001')['title'] == '1984'
+        assert ItemsRepository().table.get('B001')['title'] == '1984'
+    assert len(table) == 3
+
+
+def test_sqlite_backend_behaves_like_csv(workdir):
+    storage = SqliteStorage(str(workdir / 'library.db'))
+    repo = MembersRepository(storage)
+    repo.add(Member('M001', 'Alice', '2024-01-10'))
+    repo.add(Member('M002', 'Bob', '2024-02-12'))
+
+    repo.update(Member('M002', 'Robert', '2024-02-12'))
+    repo.delete('M001')
+
+    assert repo.get('M001') is None
+    assert repo.get('M002').name == 'Robert'
+    assert repo.count() == 1
+    # Nothing is written to the CSV directory
+    assert not (workdir / 'csv').exists()
+
+
+def test_migrate_copies_csv_files_into_sqlite(workdir):
+    service = LibraryService(CsvStorage())
+    service.members_repo.add(Member('M001', 'Alice', '2024-01-10'))
+    service.items_repo.add(Item('B001', '1984', 'George Orwell', 'on_loan'))
+    service.ledger.add(LoanRecord('B001', 'M001', '2024-03-01'))
+    service.holds.place('B001', 'M002')
+
+    migrate(db_path=str(workdir / 'library.db'))
+    migrate(db_path=str(workdir / 'library.db'))  # Running it again adds nothing
+
+    migrated = LibraryService(SqliteStorage(str(workdir / 'library.db')))
+    assert migrated.items_repo.get('B001').status == 'on_loan'
+    assert migrated.members_repo.count() == 1
+    assert migrated.ledger.items_for_member('M001') == ['B001']
+    assert migrated.holds.waitlist('B001') == ['M002']
+
+
+def test_incomplete_backend_fails_when_created():
+    class ReadOnlyTable(Table):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        ReadOnlyTable()
+
+
+def test_sqlite_composite_key_and_secondary_index(workdir):
+    service = LibraryService(SqliteStorage(str(workdir / 'library.db')))
+    service.ledger.add(LoanRecord('B001', 'M001', '2024-03-01'))
+    service.ledger.add(LoanRecord('B002', 'M001', '2024-03-02'))
+    service.ledger.add(LoanRecord('B003', 'M002', '2024-03-02'))
+
+    assert service.ledger.remove('B001', 'M001')
+    assert not service.ledger.remove('B001', 'M001')
+    assert service.ledger.items_for_member('M001') == ['B002']
+    assert service.ledger.get('B003', 'M002').loan_date == '2024-03-02'
+
+
+def test_compare_and_set_update_detects_other_writer(workdir):
+    first = ItemsRepository()
+    first.add(Item('B001', '1984', 'George Orwell'))
+    second = ItemsRepository()
+
+    # Both front desks see the book as available
+    mine, theirs = first.get('B001'), second.get('B001')
+    theirs.status = 'on_loan'
+    assert second.update(theirs, expected_status='available')
+
+    mine.status = 'on_loan'
+    assert not first.update(mine, expected_status='available')
+    with pytest.raises(ConflictError) as conflict:
+        first.update_many([mine], expected_status='available')
+    assert conflict.value.keys == ['B001']
+
+
+def _borrow_in_process(directory, item_ids, member_id):
+    # Runs in a child process: borrow every item in turn for one member
+    import os
+    os.chdir(directory)
+    service = LibraryService()
+    for item_id in item_ids:
+        service.borrow_many([(item_id, member_id)])
+
+
+def test_concurrent_processes_do_not_lose_updates(workdir):
+    import multiprocessing
+    service = LibraryService()
+    service.members_repo.add_many(Member(f'M{n}', f'Member {n}', '2024-01-10') for n in range(4))
+    service.items_repo.add_many(Item(f'B{n:03}', f'Title {n}', 'Author') for n in range(80))
+    item_ids = [f'B{n:03}' for n in range(80)]
+
+    # Four processes race to borrow the same 80 items
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_borrow_in_process, args=(str(workdir), item_ids, f'M{n}'))
+               for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # Every item was lent exactly once and every status change survived
+    service = LibraryService()
+    assert all(item.status == 'on_loan' for item in service.items_repo.get_many(item_ids).values())
+    borrowed = [item for n in range(4) for item in service.ledger.items_for_member(f'M{n}')]
+    assert sorted(borrowed) == item_ids
+
+
+@pytest.mark.parametrize('backend', ['csv', 'sqlite'])
+def test_paging_with_filters_and_cursor(workdir, monkeypatch, backend):
+    from storage import RowIndex
+    monkeypatch.setattr(RowIndex, 'MAX_HOLES', 2)
+    storage = SqliteStorage(str(workdir / 'library.db')) if backend == 'sqlite' else CsvStorage()
+    items = ItemsRepository(storage)
+    items.add_many(Item(f'B{n:02}', f'Title {n}', 'Orwell' if n % 3 == 0 else 'Austen',
+                        'on_loan' if n % 2 else 'available') for n in range(12))
+
+    first = list(items.iter_items(limit=5))
+    assert [i.id for i in first] == ['B00', 'B01', 'B02', 'B03', 'B04']
+    assert [i.id for i in items.iter_items(limit=3, after=first[-1].id)] == ['B05', 'B06', 'B07']
+    assert [i.id for i in items.iter_items(offset=10)] == ['B10', 'B11']
+    assert [i.id for i in items.iter_items(status='on_loan', author='Orwell')] == ['B03', 'B09']
+    assert [i.id for i in items.iter_items(author='Orwell', offset=1, limit=2)] == ['B03', 'B06']
+
+    # Deleted rows are skipped, and enough of them are cleared out of the row order
+    for item_id in ['B01', 'B02', 'B03', 'B08']:
+        items.table.delete(item_id)
+    assert [i.id for i in items.iter_items(offset=2, limit=3)] == ['B05', 'B06', 'B07']
+    assert [i.id for i in items.iter_items(after='B06')] == ['B07', 'B09', 'B10', 'B11']
+    with pytest.raises(KeyError):
+        list(items.iter_items(after='B02'))
+
+    members = MembersRepository(storage)
+    members.add_many([Member('M1', 'Alice', '2024-01-10'), Member('M2', 'Bob', '2024-02-12'),
+                      Member('M3', 'Chen', '2024-03-30')])
+    assert [m.id for m in members.iter_members(joined_from='2024-02-01')] == ['M2', 'M3']
+    assert [m.id for m in members.iter_members('2024-01-01', '2024-02-12')] == ['M1', 'M2']
+
+
+def test_paging_uses_secondary_index(workdir):
+    service = LibraryService()
+    service.ledger.add_many(LoanRecord(f'B{n}', f'M{n % 2}', '2024-03-01') for n in range(6))
+    table = service.ledger.table
+    assert [row['item_id'] for row in table.scan(equal={'borrowed_by': 'M1'})] == ['B1', 'B3', 'B5']
+    assert [row['item_id'] for row in table.scan(after=('B1', 'M1'), equal={'borrowed_by': 'M1'}, limit=1)] == ['B3']
+
+
+def test_snapshot_replaces_csv_parse_until_file_changes(workdir, monkeypatch):
+    service = LibraryService(CsvStorage())
+    service.members_repo.add_many([Member('M001', 'Alice', '2024-01-10'), Member('M002', 'Bob', '2024-02-12')])
+    service.ledger.add_many([LoanRecord('B1', 'M001', '2024-03-01'), LoanRecord('B2', 'M002', '2024-03-01')])
+    service.members_repo.checkpoint()
+    service.ledger.compact()
+    # Changes after the snapshot stay in the journal and are replayed on top of it
+    service.ledger.remove('B1', 'M001')
+
+    # A fresh start must not parse the CSV files while the snapshots match
+    def no_parse(*args, **kwargs):
+        raise AssertionError('CSV file parsed')
+    with monkeypatch.context() as patch:
+        patch.setattr(csv, 'DictReader', no_parse)
+        fresh = LibraryService(CsvStorage())
+        assert fresh.members_repo.count() == 2
+        assert fresh.members_repo.get('M002').name == 'Bob'
+        assert fresh.ledger.items_for_member('M002') == ['B2']
+        assert fresh.ledger.get('B1', 'M001') is None
+
+    # Another writer appends to the CSV file, so the snapshot no longer matches
+    with open(workdir / 'csv' / 'members.csv', 'a', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(['M003', 'Carol', '2024-04-01'])
+    snapshot = workdir / 'csv' / 'members.snapshot'
+    saved = snapshot.read_bytes()
+    reader = LibraryService(CsvStorage())
+    assert reader.members_repo.get('M003').name == 'Carol'
+    # The reader that parsed the file leaves saving a new snapshot to the next checkpoint
+    assert snapshot.read_bytes() == saved
+    reader.members_repo.checkpoint()
+    assert snapshot.read_bytes() != saved
+
+
+def test_broken_snapshot_is_ignored(workdir):
+    repo = MembersRepository(CsvStorage())
+    repo.add(Member('M001', 'Alice', '2024-01-10'))
+    repo.checkpoint()
+    snapshot = workdir / 'csv' / 'members.snapshot'
+    snapshot.write_bytes(snapshot.read_bytes()[:-10])  # Cut short by a crash
+    assert MembersRepository(CsvStorage()).get('M001').name == 'Alice'
+
+
+def test_repeated_values_are_shared_in_memory(workdir):
+    repo = ItemsRepository(CsvStorage())
+    repo.add_many([Item('B001', '1984', 'George Orwell'), Item('B002', 'Animal Farm', 'George Orwell')])
+    repo.table.checkpoint()
+    # Another writer journals a row, so rows come from the file, the journal and the snapshot
+    other = ItemsRepository(CsvStorage())
+    other.add(Item('B003', 'Homage to Catalonia', ''.join(['George ', 'Orwell'])))
+    for table in (repo.table, ItemsRepository(CsvStorage()).table):
+        rows = [table.get(item_id) for item_id in ('B001', 'B002', 'B003')]
+        assert len({id(row['author']) for row in rows}) == 1
+        assert len({id(row['status']) for row in rows}) == 1
+
+
+def test_lookup_before_loading_reads_only_the_snapshot(workdir, monkeypatch):
+    repo = MembersRepository(CsvStorage())
+    monkeypatch.setattr(CsvTable, 'SNAPSHOT_BLOCK', 2)  # Several blocks even for a few rows
+    repo.add_many([Member(f'M00{n}', f'Member {n}', '2024-01-10') for n in (5, 1, 4, 2, 3)])
+    repo.checkpoint()
+
+    fresh = MembersRepository(CsvStorage())
+    loaded = threading.Event()
+    monkeypatch.setattr(fresh.table, '_load_quietly', loaded.wait)  # Hold the background load back
+    assert [fresh.get(f'M00{n}').name for n in range(1, 6)] == [f'Member {n}' for n in range(1, 6)]
+    assert fresh.get('M000') is None and fresh.get('M009') is None
+    assert not fresh.table.loaded
+    loaded.set()
+
+    # Once the file has changed since the snapshot, the index is loaded instead
+    repo.delete('M003')
+    other = MembersRepository(CsvStorage())
+    assert other.get('M003') is None and other.table.loaded